@@ -1,6 +1,11 @@
-from . import fisher
-from . import gparameters
-from . import images
-from . import models
-from . import readfits
+"""Submodules are imported when first accessed, so importing a light one (e.g. registry) does
+not import galsim and numpy through the others."""
+import importlib
 
+__all__ = ['blends', 'convergence', 'exposures', 'fisher', 'gparameters', 'images', 'models', 'parameterizations', 'readfits', 'registry', 'shared', 'store', 'surrogates']
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,220 @@
+"""Fisher analysis of blends over many separations of their galaxies without rendering them again.
+
+Every parameter belongs to one galaxy and the image of a blend is the sum of the images of its
+galaxies, so the derivative images of the blend with respect to the parameters of a galaxy are
+those of the galaxy alone, and the second derivatives with respect to parameters of two different
+galaxies are exactly 0. Moving a galaxy only translates its images. A :class:`SeparationScan`
+renders the image, derivatives and second derivatives of each galaxy once, centered in a padded
+stamp, and obtains them at any position by shifting them with a phase in Fourier space (which
+handles subpixel shifts) and cropping the stamp of the blend, from which the fisher analysis of
+the blend is assembled as usual.
+
+The Fourier shifts are exact for images sampled well enough (band limited), the error of the
+shifts of each galaxy is estimated against a direct rendering at a half pixel offset, see
+:attr:`SeparationScan.interpolation_errors`, and :meth:`SeparationScan.check` compares the whole
+analysis with a directly rendered one.
+"""
+import math
+from copy import deepcopy
+
+import numpy as np
+
+from . import fisher
+from . import gparameters
+from . import images
+
+
+def _shift_stack(transform, shape, dx, dy):
+    """Return the images (last two axes) whose real fft is transform shifted by dx, dy pixels."""
+    ky = np.fft.fftfreq(shape[0])[:, None]
+    kx = np.fft.rfftfreq(shape[1])[None, :]
+    phase = np.exp(-2j * np.pi * (ky * dy + kx * dx))
+    return np.fft.irfft2(transform * phase, s=shape)
+
+
+class SeparationScan(object):
+    """Fisher analysis of the galaxies in g_parameters with any of them moved, see the module
+    docstring.
+
+    Args:
+        g_parameters(:class:`analysis.gparameters.GParameters`): Parameters of the galaxies, the
+            positions (x0, y0) are the default ones of :meth:`get_fisher`.
+        image_renderer(:class:`analysis.images.ImageRenderer`): Object used to render the blend,
+            its mask is applied to the shifted images.
+        snr(float): S/N ratio of the first galaxy, used to compute the variance of the noise at
+            each position as in :class:`analysis.fisher.Fisher`.
+        var_noise(float or :class:`np.array`): optional, variance (or variance map) of the noise
+            used instead of snr.
+        max_offset(float): Largest distance (arcsecs) of a galaxy from the center of the stamp in
+            x or y, by default half the size of the stamp. The galaxies are rendered in stamps
+            padded by this much so the shifts never wrap around.
+
+    Attributes:
+        galaxy_stacks(dict): From the id of each galaxy to the array with its image, derivatives
+            and second derivatives (in the order of :attr:`galaxy_names`) centered in the padded stamp.
+        galaxy_names(dict): From the id of each galaxy to the names of its fit parameters.
+        interpolation_errors(dict): From the id of each galaxy to the relative (L2) error of its
+            image shifted by half a pixel in x and y with respect to a direct rendering.
+        num_renders(int): Number of images rendered to set up the scan.
+    """
+
+    def __init__(self, g_parameters, image_renderer, snr=None, var_noise=None, max_offset=None):
+        if snr is None and var_noise is None:
+            raise ValueError('Need to specify either snr or var_noise.')
+        if image_renderer.bounds is not None:
+            raise ValueError('Separation scans need a renderer without bounds.')
+
+        self.g_parameters = g_parameters
+        self.image_renderer = image_renderer
+        self.snr = snr
+        self.var_noise = var_noise
+        self.pixel_scale = image_renderer.pixel_scale
+        self.shape = image_renderer.stamp.array.shape
+
+        if max_offset is None:
+            max_offset = max(self.shape) * self.pixel_scale / 2
+        self.max_offset = max_offset
+        pad = int(math.ceil(max_offset / self.pixel_scale)) + 1
+        self.padded_shape = (self.shape[0] + 2 * pad, self.shape[1] + 2 * pad)
+        self.padded_renderer = images.ImageRenderer(pixel_scale=self.pixel_scale, nx=self.padded_shape[1],
+                                                    ny=self.padded_shape[0], cache=image_renderer.cache,
+                                                    method=image_renderer.method, gsparams=image_renderer.gsparams)
+
+        # the center of galsim stamps (use_true_center=False) is at index n // 2 of each axis.
+        self.crop = tuple(slice(p // 2 - n // 2, p // 2 - n // 2 + n) for p, n in zip(self.padded_shape, self.shape))
+
+        self.galaxy_stacks = {}
+        self.galaxy_names = {}
+        self.transforms = {}
+        self.interpolation_errors = {}
+        self.num_renders = 0
+        for gal_id, params in g_parameters.id_params.items():
+            self._add_galaxy(gal_id, params)
+
+        self.param_names = gparameters.ParameterIndex(g_parameters, image_renderer).names
+        self._shifted = {}
+
+    def _add_galaxy(self, gal_id, params):
+        centered = deepcopy(params)
+        centered['x0'] = 0.
+        centered['y0'] = 0.
+
+        # the derivatives of the galaxy alone, with the steps the blend uses for its parameters.
+        fish = fisher.Fisher(gparameters.GParameters(id_params={gal_id: centered}), self.padded_renderer,
+                             snr=None, var_noise=1.)
+        names = fish.param_names
+        num_params = len(names)
+        stack = np.concatenate([fish.image.array[None].astype(np.float64),
+                                fish.get_derivatives_stack(),
+                                fish.get_second_derivatives_stack().reshape((num_params ** 2,) + self.padded_shape)])
+        self.galaxy_names[gal_id] = names
+        self.galaxy_stacks[gal_id] = stack
+        self.transforms[gal_id] = np.fft.rfft2(stack)
+        self.num_renders += 1 + 2 * num_params + 4 * num_params ** 2
+
+        # estimate of the error of the fourier shifts.
+        moved = deepcopy(centered)
+        moved['x0'] = moved['y0'] = self.pixel_scale / 2
+        direct = self.padded_renderer.get_image(gparameters.get_galaxy_model(moved)).array
+        shifted = _shift_stack(self.transforms[gal_id][0], self.padded_shape, .5, .5)
+        self.interpolation_errors[gal_id] = float(np.linalg.norm(shifted - direct) / np.linalg.norm(direct))
+        self.num_renders += 1
+
+    def get_shifted_stack(self, gal_id, x0, y0):
+        """Return the stack of gal_id (see :attr:`galaxy_stacks`) with the galaxy at x0, y0 in
+        the stamp of the blend. The stacks of the last positions of each galaxy are kept, so
+        galaxies that do not move in a scan are not shifted again."""
+        if max(abs(x0), abs(y0)) > self.max_offset:
+            raise ValueError(f'Galaxy {gal_id} is further than max_offset from the center of the stamp.')
+
+        key = (x0, y0)
+        if self._shifted.get(gal_id, (None,))[0] != key:
+            shifted = _shift_stack(self.transforms[gal_id], self.padded_shape, x0 / self.pixel_scale,
+                                   y0 / self.pixel_scale)
+            self._shifted[gal_id] = (key, shifted[(slice(None),) + self.crop])
+        return self._shifted[gal_id][1]
+
+    def get_fisher(self, positions=None):
+        """Return the :class:`analysis.fisher.Fisher` analysis of the blend with the galaxies at
+        positions, without rendering any image.
+
+        Args:
+            positions(dict): From the id of a galaxy to its new position (x0, y0) in arcsecs, the
+                galaxies not included keep their position in g_parameters.
+
+        Returns:
+            A :class:`analysis.fisher.Fisher` with the same attributes as a rendered one.
+        """
+        positions = positions or {}
+        id_params = deepcopy(self.g_parameters.id_params)
+        for gal_id, (x0, y0) in positions.items():
+            id_params[gal_id]['x0'] = x0
+            id_params[gal_id]['y0'] = y0
+        g_parameters = gparameters.GParameters(id_params=id_params)
+
+        num_params = len(self.param_names)
+        position = {name: i for i, name in enumerate(self.param_names)}
+        image = np.zeros(self.shape)
+        galaxy_images = []
+        derivatives = np.zeros((num_params,) + self.shape)
+        second_derivatives = np.zeros((num_params, num_params) + self.shape)
+        for gal_id, params in id_params.items():
+            stack = self.get_shifted_stack(gal_id, params['x0'], params['y0'])
+            names = self.galaxy_names[gal_id]
+            indices = [position[name] for name in names]
+            image += stack[0]
+            galaxy_images.append(stack[0])
+            derivatives[indices] = stack[1:1 + len(names)]
+            second_derivatives[np.ix_(indices, indices)] = stack[1 + len(names):].reshape(
+                (len(names), len(names)) + self.shape)
+
+        mask = self.image_renderer.mask
+        if mask is not None:
+            image[mask] = 0.
+            galaxy_images = [np.where(mask, 0., galaxy_image) for galaxy_image in galaxy_images]
+
+        fisher_image = deepcopy(self.image_renderer.stamp)
+        fisher_image.array[:] = image
+        var_noise = self.var_noise
+        snrs = None
+        if var_noise is None:
+            # the noise gives the first galaxy (alone) the S/N ratio snr, as in the constructor of Fisher.
+            var_noise = np.sum(galaxy_images[0] ** 2) / self.snr ** 2
+            if g_parameters.num_galaxies > 1:
+                snrs = [self.snr] + [math.sqrt(np.sum(galaxy_image ** 2) / var_noise)
+                                     for galaxy_image in galaxy_images[1:]]
+
+        return fisher.Fisher.from_stacks(g_parameters, self.image_renderer, self.snr, derivatives, second_derivatives,
+                                         var_noise=var_noise, image=fisher_image, snrs=snrs)
+
+    def scan(self, gal_id, offsets, axis='x0'):
+        """Return list with the fisher analysis of the blend with galaxy gal_id moved to each of
+        offsets (arcsecs) along axis ('x0' or 'y0'), keeping its position along the other one."""
+        params = self.g_parameters.id_params[gal_id]
+        fishers = []
+        for offset in offsets:
+            x0, y0 = (offset, params['y0']) if axis == 'x0' else (params['x0'], offset)
+            fishers.append(self.get_fisher({gal_id: (x0, y0)}))
+        return fishers
+
+    def check(self, positions=None):
+        """Compare the analysis at positions with a directly rendered :class:`analysis.fisher.Fisher`.
+
+        Returns:
+            A dictionary with the largest relative difference of the elements of the fisher
+            matrix (relative to the geometric mean of the diagonal elements), and the largest
+            difference of the biases in units of the fisher errors.
+        """
+        fish = self.get_fisher(positions)
+        direct = fisher.Fisher(fish.g_parameters, self.image_renderer, self.snr, var_noise=self.var_noise)
+
+        fisher_array = fish.matrix_to_numpy_array(fish.fisher_matrix)
+        direct_array = direct.matrix_to_numpy_array(direct.fisher_matrix)
+        diagonal = np.sqrt(np.abs(np.diag(direct_array)))
+        sigmas = np.sqrt(np.array([direct.covariance_matrix[param, param] for param in direct.param_names]))
+        biases = np.array([fish.biases[param] for param in direct.param_names])
+        direct_biases = np.array([direct.biases[param] for param in direct.param_names])
+        return {
+            'fisher': float(np.max(np.abs(fisher_array - direct_array) / np.outer(diagonal, diagonal))),
+            'biases': float(np.max(np.abs(biases - direct_biases) / sigmas)),
+        }
@@ -0,0 +1,246 @@
+"""Convergence of the fisher analysis with the steps of the numerical derivatives.
+
+A :class:`StepLadder` computes the derivative images with the default steps (see
+:func:`defaults.get_steps`) multiplied by each of a ladder of factors halving from one to the
+next, and the fisher analysis at every rung. The images are rendered at the shifts of every rung
+once: the center image is shared by all of them and the diagonal second derivative of a rung uses
+the images at twice its steps, which are those of the first derivatives of the rung above.
+
+Central differences have errors of order h^2, so two consecutive rungs give a Richardson
+extrapolation D = (4 D(h / 2) - D(h)) / 3 of each derivative image. The extrapolation of the pair
+of rungs that agrees best with the pair above is the reference against which the error of every
+rung is measured, and the difference between the extrapolations of the two pairs estimates the
+error of the reference itself. The report of a project is printed by :mod:`steps`.
+"""
+import itertools
+
+import numpy as np
+
+from . import fisher
+from . import gparameters
+from .. import defaults
+
+
+class StepLadder(object):
+    """Fisher analysis of the galaxies in g_parameters at a ladder of derivative steps.
+
+    Args:
+        g_parameters(:class:`analysis.gparameters.GParameters`): Parameters of the galaxies.
+        image_renderer(:class:`analysis.images.ImageRenderer`): Object used to render the galaxies.
+        snr(float): S/N ratio of the first galaxy, as in :class:`analysis.fisher.Fisher`.
+        var_noise(float or :class:`np.array`): optional, variance (or variance map) of the noise
+            used instead of snr.
+        factors(list): Factors multiplying the default steps, each half the previous one.
+        steps(dict): optional, steps of factor 1, by default the ones of :func:`defaults.get_steps`.
+
+    Attributes:
+        param_names(list): Names of the fit parameters.
+        fishers(list): :class:`analysis.fisher.Fisher` analysis at each factor.
+        extrapolated(:class:`analysis.fisher.Fisher`): Analysis with the Richardson extrapolated
+            derivatives, the reference of the errors.
+        num_renders(int): Number of images rendered.
+        num_renders_separate(int): Number of images that separate :class:`analysis.fisher.Fisher`
+            objects at each factor would render.
+    """
+
+    def __init__(self, g_parameters, image_renderer, snr, var_noise=None, factors=(2., 1., .5, .25), steps=None):
+        factors = [float(factor) for factor in factors]
+        if len(factors) < 2:
+            raise ValueError('Need at least two factors.')
+        if any(small != large / 2 for large, small in zip(factors, factors[1:])):
+            raise ValueError('Each factor should be half the previous one.')
+
+        self.g_parameters = g_parameters
+        self.image_renderer = image_renderer
+        self.factors = factors
+        self.index = gparameters.ParameterIndex(g_parameters, image_renderer)
+        self.param_names = self.index.names
+        self.num_params = len(self.param_names)
+        if steps is None:
+            steps = defaults.get_steps(g_parameters, image_renderer)
+        self.base_steps = np.array([steps[param] for param in self.param_names], dtype=float)
+
+        self.image_renderer_partials = image_renderer.get_unmasked()
+        self._images = {}
+
+        base = self._get_base(snr, var_noise)
+        self.fishers = []
+        stacks = []
+        for factor in factors:
+            derivatives, second_derivatives = self.get_derivatives(factor)
+            stacks.append((derivatives, second_derivatives))
+            self.fishers.append(self._get_fisher(base, factor, derivatives, second_derivatives))
+
+        self.num_renders = len(self._images)
+        self.num_renders_separate = len(factors) * (1 + 2 * self.num_params + 4 * self.num_params ** 2)
+
+        # richardson extrapolation of each pair of consecutive rungs.
+        extrapolations = [tuple((4 * fine - coarse) / 3 for coarse, fine in zip(stacks[m], stacks[m + 1]))
+                          for m in range(len(factors) - 1)]
+        self.extrapolations = [self._get_fisher(base, None, *stack) for stack in extrapolations]
+
+        # the pair that agrees best with the pair above it (the coarsest one if there is only one).
+        self.extrapolation_errors = [self.compare(self.extrapolations[m], self.extrapolations[m - 1])
+                                     for m in range(1, len(self.extrapolations))]
+        best = 0
+        if self.extrapolation_errors:
+            best = 1 + int(np.argmin([error['fisher'] for error in self.extrapolation_errors]))
+        self.reference_pair = best
+        self.extrapolated = self.extrapolations[best]
+        self._extrapolated_stacks = extrapolations[best]
+        self._stacks = stacks
+
+    def _get_base(self, snr, var_noise):
+        """Return the keyword arguments of :meth:`analysis.fisher.Fisher.from_stacks` with the image
+        and noise, set up the same way as by its constructor but rendered only once."""
+        image = self.image_renderer.get_image(gparameters.get_galaxies_models(g_parameters=self.g_parameters))
+        snrs = None
+        if var_noise is None:
+            var_noise = gparameters.get_var_noise(self.g_parameters, self.image_renderer, snr)
+            if self.g_parameters.num_galaxies > 1:
+                galaxy_images = [self.image_renderer.get_image(gparameters.get_galaxy_model(params))
+                                 for params in self.g_parameters.id_params.values()]
+                snrs = [fisher.get_snr(galaxy_image, var_noise) for galaxy_image in galaxy_images]
+                snrs[0] = snr
+        return {'snr': snr, 'var_noise': var_noise, 'image': image, 'snrs': snrs}
+
+    def _get_fisher(self, base, factor, derivatives, second_derivatives):
+        steps = None if factor is None else dict(zip(self.param_names, self.base_steps * factor))
+        fish = fisher.Fisher.from_stacks(self.g_parameters, self.image_renderer, derivatives=derivatives,
+                                         second_derivatives=second_derivatives, steps=steps, **base)
+        if factor is None:
+            fish.steps = None  # extrapolated to a step of zero.
+        return fish
+
+    def get_image_at(self, coefficients):
+        """Return the image of the galaxies with their fit parameters moved by coefficients times
+        the steps of factor 1, rendering it only the first time."""
+        key = tuple(float(c) for c in coefficients)
+        if key not in self._images:
+            id_params = self.index.to_id_params(self.index.values + np.array(key) * self.base_steps)
+            gal = gparameters.get_galaxies_models(id_params=id_params)
+            self._images[key] = self.image_renderer_partials.get_image(gal).array
+        return self._images[key]
+
+    def get_derivatives(self, factor):
+        """Return the stacks of the derivative and second derivative images with the steps of
+        factor, with the same finite differences as :class:`analysis.fisher.Fisher`."""
+        n = self.num_params
+        eye = np.eye(n) * factor
+        steps = self.base_steps * factor
+        shape = self.image_renderer.stamp.array.shape
+
+        derivatives = np.zeros((n,) + shape)
+        for i in range(n):
+            derivatives[i] = (self.get_image_at(eye[i]) - self.get_image_at(-eye[i])) / (2 * steps[i])
+
+        second_derivatives = np.zeros((n, n) + shape)
+        for i, j in itertools.combinations_with_replacement(range(n), 2):
+            second_derivatives[i, j] = ((self.get_image_at(eye[i] + eye[j]) + self.get_image_at(-eye[i] - eye[j]) -
+                                         self.get_image_at(-eye[i] + eye[j]) - self.get_image_at(eye[i] - eye[j])) /
+                                        (4 * steps[i] * steps[j]))
+            second_derivatives[j, i] = second_derivatives[i, j]
+        return derivatives, second_derivatives
+
+    @staticmethod
+    def compare(fish, reference):
+        """Return dictionary with the largest difference of the elements of the fisher matrices
+        of fish and reference (relative to the geometric mean of the diagonal elements of
+        reference) and of their biases (in units of the errors of reference)."""
+        fisher_array = fish.matrix_to_numpy_array(fish.fisher_matrix)
+        reference_array = reference.matrix_to_numpy_array(reference.fisher_matrix)
+        diagonal = np.sqrt(np.abs(np.diag(reference_array)))
+        sigmas = np.sqrt(np.diag(reference.matrix_to_numpy_array(reference.covariance_matrix)))
+        biases = np.array([fish.biases[param] for param in fish.param_names])
+        reference_biases = np.array([reference.biases[param] for param in reference.param_names])
+        return {
+            'fisher': float(np.max(np.abs(fisher_array - reference_array) / np.outer(diagonal, diagonal))),
+            'biases': float(np.max(np.abs(biases - reference_biases) / sigmas)),
+        }
+
+    def get_derivative_errors(self, m):
+        """Return dictionary with the relative error of the derivatives of each parameter at
+        factors[m], the largest of the errors of its own derivative and diagonal second derivative.
+
+        The error of the derivative D_i is the weighted norm of its difference with the
+        extrapolated one, relative to the norm of the latter. The error of the second derivative
+        D_ii is that of the quadratic term of the image over one fisher error sigma_i of the
+        parameter, relative to the linear term, |D_ii - D_ii'| sigma_i / (2 |D_i'|), not counting
+        the rounding noise of the images that both second derivatives can have (see
+        :meth:`get_rounding_noise`). Parameters the image depends on linearly (e.g. flux) have
+        second derivatives that are only that noise. The cross second derivatives are left out,
+        they would give every parameter the error of the least accurate one it is paired with.
+        """
+        weight = self.fishers[m].weight
+
+        def norm(stack):
+            return np.sqrt(np.sum(stack ** 2 * weight, axis=(-2, -1)))
+
+        diagonal = (np.arange(self.num_params),) * 2
+        derivatives, second_derivatives = self._stacks[m]
+        reference, second_reference = self._extrapolated_stacks
+        covariance = self.extrapolated.matrix_to_numpy_array(self.extrapolated.covariance_matrix)
+        sigmas = np.sqrt(np.diag(covariance))
+
+        # the extrapolation (4 D(h / 2) - D(h)) / 3 has 4 / 3 of the noise of its finer rung.
+        rounding = self.get_rounding_noise(self.factors[m]) + 4 / 3 * self.get_rounding_noise(
+            self.factors[self.reference_pair + 1])
+        difference = np.maximum(norm(second_derivatives[diagonal] - second_reference[diagonal]) - rounding, 0.)
+
+        first = norm(derivatives - reference) / norm(reference)
+        second = difference * sigmas / (2 * norm(reference))
+        return {param: float(max(first[i], second[i])) for i, param in enumerate(self.param_names)}
+
+    def get_rounding_noise(self, factor):
+        """Return array with the weighted norm of the rounding noise of the diagonal second
+        derivative of each parameter with the steps of factor: the four images of its finite
+        difference are each rounded to the precision of the image type, about eps |image| per
+        pixel, and divided by 4 h^2."""
+        center = self.get_image_at(np.zeros(self.num_params))
+        eps = np.finfo(center.dtype).eps
+        noise = np.sqrt(np.sum((2 * eps * center) ** 2 * self.fishers[0].weight))
+        return noise / (4 * (self.base_steps * factor) ** 2)
+
+    def get_safe_steps(self, rtol=1e-3):
+        """Return dictionary with the largest step of each parameter in the ladder whose
+        derivatives are within rtol of the extrapolated ones (see :meth:`get_derivative_errors`),
+        None for parameters where no step is."""
+        safe_steps = {param: None for param in self.param_names}
+        for m in reversed(range(len(self.factors))):
+            for i, (param, error) in enumerate(self.get_derivative_errors(m).items()):
+                if error <= rtol:
+                    safe_steps[param] = float(self.base_steps[i] * self.factors[m])
+        return safe_steps
+
+    def report(self, rtol=1e-3):
+        """Return json-serializable dictionary with, for each factor, the steps, the fisher
+        matrix, the biases and their errors with respect to the extrapolated analysis, plus the
+        extrapolated analysis, the estimate of its own error, the safe steps for rtol and the
+        number of images rendered."""
+        rungs = []
+        for m, (factor, fish) in enumerate(zip(self.factors, self.fishers)):
+            rungs.append({
+                'factor': factor,
+                'steps': {param: float(step) for param, step in fish.steps.items()},
+                'fisher_matrix': fish.matrix_to_numpy_array(fish.fisher_matrix).tolist(),
+                'biases': {param: float(bias) for param, bias in fish.biases.items()},
+                'errors': self.compare(fish, self.extrapolated),
+                'derivative_errors': self.get_derivative_errors(m),
+            })
+
+        extrapolated = self.extrapolated
+        return {
+            'param_names': self.param_names,
+            'rungs': rungs,
+            'extrapolated': {
+                'factors': self.factors[self.reference_pair:self.reference_pair + 2],
+                'fisher_matrix': extrapolated.matrix_to_numpy_array(extrapolated.fisher_matrix).tolist(),
+                'biases': {param: float(bias) for param, bias in extrapolated.biases.items()},
+                'errors': (self.extrapolation_errors[self.reference_pair - 1]
+                           if self.reference_pair > 0 else None),
+            },
+            'safe_steps': self.get_safe_steps(rtol),
+            'rtol': rtol,
+            'num_renders': self.num_renders,
+            'num_renders_separate': self.num_renders_separate,
+        }
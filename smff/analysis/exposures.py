@@ -0,0 +1,222 @@
+"""Joint fisher analysis of the same galaxies measured in several exposures.
+
+Each exposure has its own renderer (geometry and pixel scale), psf and noise level. The images of
+different exposures are independent, so the joint fisher matrix and bias matrix are the sums of
+those of each exposure. The galaxy profiles (before the convolution with the psf) needed for the
+derivatives are built once and shared by all the exposures, which are rendered in parallel.
+"""
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import galsim
+import numpy as np
+
+from . import gparameters
+from . import images
+from . import models
+
+
+class Exposure(object):
+    """One exposure of the galaxies.
+
+    Args:
+        image_renderer(:class:`analysis.images.ImageRenderer`): Object used to render the exposure.
+        psf_params(dict): Parameters of the psf of the exposure in the format of galaxies.csv
+            (psf_model, psf_flux, psf_fwhm, ...), by default the psf of the first galaxy.
+        snr(float): S/N ratio of the first galaxy in this exposure, used to compute var_noise.
+        var_noise(float or :class:`np.array`): Variance of the noise of the exposure (or variance
+            map, see :func:`analysis.images.get_weight`), can be given instead of snr.
+    """
+
+    def __init__(self, image_renderer, psf_params=None, snr=None, var_noise=None):
+        if snr is None and var_noise is None:
+            raise ValueError('Need to specify either snr or var_noise.')
+
+        self.image_renderer = image_renderer
+        self.psf_params = psf_params
+        self.snr = snr
+        self.var_noise = var_noise
+
+
+def _render_exposure(args):
+    """Return the stack of images of the profiles convolved with the psf, drawn without mask."""
+    profiles, psf, image_renderer = args
+    image_renderer_partials = image_renderer.get_unmasked()
+
+    stack = []
+    for profile in profiles:
+        if psf is not None:
+            profile = galsim.Convolve([profile, psf])
+        stack.append(image_renderer_partials.get_image(profile).array)
+    return np.array(stack, dtype=np.float64)
+
+
+class JointFisher(object):
+    """Fisher analysis of the galaxies in g_parameters combining several exposures.
+
+    The steps of the derivatives are the ones of the first exposure. The matrices are given in the
+    same dictionary form as in :class:`analysis.fisher.Fisher`, and as numpy arrays ordered
+    according to param_names.
+
+        Args:
+            g_parameters(:class:`analysis.gparameters.GParameters`): Parameters of the galaxies,
+                their psf is only used by exposures without psf_params.
+            exposures(list): :class:`Exposure` objects.
+            processes(int): Number of processes used to render the exposures, by default the
+                number of cpus.
+
+        Attributes:
+            param_names(list): Names of the fit parameters.
+            images(list): Array of the image of the galaxies in each exposure.
+            var_noises(list): Variance of the noise of each exposure.
+            exposure_fisher_arrays(list): Fisher matrix (array) of each exposure by itself.
+            fisher_array(:class:`np.array`): Joint fisher matrix.
+            covariance_array(:class:`np.array`): Joint covariance matrix.
+            bias_matrix_array(:class:`np.array`): Joint bias matrix, shape (n, n, n).
+            biases_array(:class:`np.array`): Biases of the parameters.
+            fisher_matrix, covariance_matrix, correlation_matrix, bias_matrix, biases(dict): Same
+                as the attributes with the same names in :class:`analysis.fisher.Fisher`.
+            fisher_condition_number(float): Condition number of the joint fisher matrix.
+    """
+
+    def __init__(self, g_parameters, exposures, processes=None):
+        if not exposures:
+            raise ValueError('Need at least one exposure.')
+
+        self.g_parameters = g_parameters
+        self.exposures = exposures
+        self.num_exposures = len(exposures)
+        self.num_galaxies = g_parameters.num_galaxies
+
+        self.index = gparameters.ParameterIndex(g_parameters, exposures[0].image_renderer)
+        self.steps = dict(zip(self.index.names, self.index.steps))
+        self.param_names = self.index.names
+        self.num_params = len(self.param_names)
+
+        # profiles at every shift needed for the derivatives, plus the first galaxy by itself
+        # which sets the noise of an exposure given by its snr.
+        self.shifts = self.get_shifts()
+        profiles = [self.get_profile(coefficients) for coefficients in self.shifts]
+        first_id = list(g_parameters.id_params)[0]
+        profiles.append(self._get_unconvolved(g_parameters.id_params[first_id]))
+
+        first_params = g_parameters.id_params[first_id]
+        tasks = []
+        for exposure in exposures:
+            psf_params = first_params if exposure.psf_params is None else exposure.psf_params
+            tasks.append((profiles, gparameters.get_psf_model(psf_params), exposure.image_renderer))
+
+        if processes == 1 or self.num_exposures == 1:
+            self._add_exposures(map(_render_exposure, tasks))
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                self._add_exposures(executor.map(_render_exposure, tasks))
+
+        self.covariance_array = np.linalg.inv(self.fisher_array)
+        self.biases_array = -.5 * np.einsum('ij,kl,jkl->i', self.covariance_array, self.covariance_array,
+                                            self.bias_matrix_array)
+
+        sigmas = np.sqrt(np.diag(self.covariance_array))
+        self.fisher_matrix = self.numpy_array_to_matrix(self.fisher_array)
+        self.covariance_matrix = self.numpy_array_to_matrix(self.covariance_array)
+        self.correlation_matrix = self.numpy_array_to_matrix(self.covariance_array / np.outer(sigmas, sigmas))
+        self.bias_matrix = {
+            (param_i, param_j, param_k): self.bias_matrix_array[i, j, k]
+            for i, param_i in enumerate(self.param_names)
+            for j, param_j in enumerate(self.param_names)
+            for k, param_k in enumerate(self.param_names)
+        }
+        self.biases = dict(zip(self.param_names, self.biases_array))
+        self.fisher_condition_number = np.linalg.cond(self.fisher_array)
+
+    def get_shifts(self):
+        """Return list with the shifts (in units of the steps of each parameter, as tuples) at
+        which the galaxies are drawn for the first and second derivatives."""
+        shifts = {(0,) * self.num_params: None}
+        for i in range(self.num_params):
+            for sign in (1, -1):
+                shifts[self._get_coefficients((i, sign))] = None
+            for j in range(i, self.num_params):
+                for sign_i in (1, -1):
+                    for sign_j in (1, -1):
+                        shifts[self._get_coefficients((i, sign_i), (j, sign_j))] = None
+        return list(shifts)
+
+    def _get_coefficients(self, *moves):
+        coefficients = [0] * self.num_params
+        for i, sign in moves:
+            coefficients[i] += sign
+        return tuple(coefficients)
+
+    @staticmethod
+    def _get_unconvolved(params):
+        return models.get_model_cls(params['galaxy_model'])(params).gal
+
+    def get_profile(self, coefficients):
+        """Return the profile of the galaxies (without psf) with their parameters moved by
+        coefficients times their steps."""
+        id_params = self.index.to_id_params(self.index.values + np.array(coefficients) * self.index.steps)
+        return galsim.Add([self._get_unconvolved(params) for params in id_params.values()])
+
+    def _add_exposures(self, stacks):
+        position = {coefficients: n for n, coefficients in enumerate(self.shifts)}
+
+        def get(*moves):
+            return stack[position[self._get_coefficients(*moves)]]
+
+        self.images = []
+        self.var_noises = []
+        self.exposure_fisher_arrays = []
+        self.fisher_array = np.zeros((self.num_params, self.num_params))
+        self.bias_matrix_array = np.zeros((self.num_params,) * 3)
+        steps = self.index.steps
+
+        for exposure, stack in zip(self.exposures, stacks):
+            mask = exposure.image_renderer.mask
+            image = get().copy()
+            image_first = stack[-1].copy()
+            if mask is not None:
+                image[mask] = 0.
+                image_first[mask] = 0.
+            self.images.append(image)
+
+            var_noise = exposure.var_noise
+            if var_noise is None:
+                var_noise = np.sum(image_first ** 2) / exposure.snr ** 2
+            self.var_noises.append(var_noise)
+
+            derivatives = np.array([(get((i, 1)) - get((i, -1))) / (2 * steps[i])
+                                    for i in range(self.num_params)])
+            weighted_derivatives = derivatives * images.get_weight(var_noise)
+
+            second_derivatives = np.zeros((self.num_params,) * 2 + image.shape)
+            for i in range(self.num_params):
+                for j in range(i, self.num_params):
+                    second_derivatives[i, j] = ((get((i, 1), (j, 1)) + get((i, -1), (j, -1)) -
+                                                 get((i, -1), (j, 1)) - get((i, 1), (j, -1))) /
+                                                (4 * steps[i] * steps[j]))
+                    second_derivatives[j, i] = second_derivatives[i, j]
+
+            fisher_array = np.einsum('ixy,jxy->ij', weighted_derivatives, derivatives)
+            self.exposure_fisher_arrays.append(fisher_array)
+            self.fisher_array += fisher_array
+            self.bias_matrix_array += np.einsum('ixy,jkxy->ijk', weighted_derivatives, second_derivatives)
+
+    def get_snrs(self):
+        """Return list with the S/N ratio of the galaxies in each exposure and combined over all
+        of them (last entry)."""
+        snrs = [math.sqrt(np.sum(image ** 2 * images.get_weight(var_noise)))
+                for image, var_noise in zip(self.images, self.var_noises)]
+        snrs.append(math.sqrt(sum(snr ** 2 for snr in snrs)))
+        return snrs
+
+    def matrix_to_numpy_array(self, matrix):
+        """Convert matrix dictionary to a numpy array."""
+        return np.array([[matrix[param_i, param_j] for param_j in self.param_names]
+                         for param_i in self.param_names])
+
+    def numpy_array_to_matrix(self, array):
+        """Convert numpy array to matrix dictionary."""
+        return {(param_i, param_j): array[i][j]
+                for i, param_i in enumerate(self.param_names)
+                for j, param_j in enumerate(self.param_names)}
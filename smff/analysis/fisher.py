@@ -2,18 +2,19 @@
 the fisher formalism from a given galaxy.
 """
 
-import copy
-import math
+import itertools
+from copy import deepcopy
 
 import numpy as np
 
 from . import gparameters
 from . import images
-from .. import defaults
+from . import parameterizations
+from . import shared
 
 
 def get_snr(img, var_noise):
-    return np.sqrt(np.sum(img.array ** 2) / var_noise)
+    return np.sqrt(np.sum(img.array ** 2 * images.get_weight(var_noise)))
 
 
 class Fisher(object):
@@ -32,13 +33,19 @@ class Fisher(object):
                                                 specified by the user.
             image_renderer(:class:`ImageRenderer`): Object used to render image of galaxy. 
             snr(float): Value S/N ratio to use in the analysis. 
+            var_noise(float or :class:`np.array`): optional, variance of the noise, either the same
+                for every pixel or a map with the shape of the image (use np.inf for pixels without
+                data, or :func:`analysis.images.weight_to_var_noise` to convert a weight map).
+                By default it is computed from snr.
 
         Attributes:
             image_renderer_partials(:class:`analysis.gparameters.ImageRenderer`): Object used to render
             images of partial derivatives. 
             image(:class:`Galsim.Image`): Dictionary whose keys are the ids of each of the
                 galaxies specified in galaxies.csv, and that map to another dictionary that can be taken in by :func:`analysis.gparameters.get_galaxy_model`
-            var_noise(float): Variance of noise of given S/N . 
+            var_noise(float or :class:`np.array`): Variance of noise of given S/N, or variance map.
+            weight(float or :class:`np.array`): Inverse of var_noise (0 where var_noise is infinite)
+                that weights each pixel in the contractions of the images.
             steps(dict): Dictionary containing the step size used when 
                 calculating partial derivatives. 
             param_names(list): A list containing the keys of fit_params
@@ -54,32 +61,61 @@ class Fisher(object):
             fisher_matrix(dict): Dictionary containing fisher matrix elements. 
             covariance_matrix(dict): Dictionary containing covariance matrix elements. 
             correlation_matrix(dict): Dictionary containing correlation matrix elements. 
-            bias_matrix_images(dict): Dictionary containing bias matrix image elements.
+            bias_matrix_images(dict): Dictionary containing bias matrix image elements, computed
+                the first time it is used.
             bias_matrix(dict): Dictionary containing bias matrix elements.
             bias_images(dict): Dictionary containing bias images elements.
             biases(dict): Dictionary containing biases
     """
 
     def __init__(self, g_parameters, image_renderer, snr, var_noise=None):
+        self._set_up(g_parameters, image_renderer, snr, var_noise)
+        self.derivatives_images = self.get_derivative_images()
+        self.second_derivatives_images = self.get_second_derivatives_images()
+        self._set_results()
+
+    @classmethod
+    def from_stacks(cls, g_parameters, image_renderer, snr, derivatives, second_derivatives, var_noise=None,
+                    image=None, snrs=None, steps=None):
+        """Return a :class:`Fisher` with the given derivative images instead of rendering them,
+        set up in the same way as by the constructor otherwise.
+
+        Args:
+            derivatives(:class:`np.array`): Stack (n, ny, nx) of the derivative images, in the
+                order of :attr:`analysis.gparameters.GParameters.ordered_fit_names`.
+            second_derivatives(:class:`np.array`): Stack (n, n, ny, nx) of the second derivative
+                images in the same order.
+            image(:class:`galsim.Image`): optional, image of the galaxies, rendered if not given.
+            snrs(list): optional, S/N ratio of each galaxy when var_noise is given (it is computed
+                from the images of the galaxies otherwise).
+            steps(dict): optional, steps the derivatives were computed with, by default the ones
+                of :func:`defaults.get_steps`.
+        """
+        fish = cls.__new__(cls)
+        fish._set_up(g_parameters, image_renderer, snr, var_noise, image=image, snrs=snrs)
+        if steps is not None:
+            fish.steps = dict(steps)
+        fish.set_derivatives(derivatives, second_derivatives)
+        return fish
+
+    def _set_up(self, g_parameters, image_renderer, snr, var_noise, image=None, snrs=None):
+        """Set the galaxies, image, noise and parameters of the analysis, everything but the
+        derivatives and what depends on them."""
         self.g_parameters = g_parameters
         self.snr = snr
         self.model = gparameters.get_galaxies_models(g_parameters=self.g_parameters)
         self.image_renderer = image_renderer
         self.num_galaxies = self.g_parameters.num_galaxies
+        self.shared_handles = None
 
         # we do not want to mask or crop the images used to obtain the partials.
-        self.image_renderer_partials = images.ImageRenderer(stamp=self.image_renderer.stamp)
-        self.image = self.image_renderer.get_image(self.model)
+        self.image_renderer_partials = self.image_renderer.get_unmasked()
+        self.image = self.image_renderer.get_image(self.model) if image is None else image
 
         if var_noise is None:
-            if self.num_galaxies == 1:
-                _, self.var_noise = images.add_noise(self.image, self.snr, 0)
-            else:
-                # obtain the image of only the first galaxy
-                model_galaxy1 = gparameters.get_galaxy_model(self.g_parameters.id_params['1'])
-                image_galaxy1 = self.image_renderer.get_image(model_galaxy1)
-                _, self.var_noise = images.add_noise(image_galaxy1, snr)
-
+            # the noise gives the first galaxy (alone) the S/N ratio snr.
+            self.var_noise = gparameters.get_var_noise(self.g_parameters, self.image_renderer, self.snr)
+            if self.num_galaxies > 1:
                 # also obtain the snr for the rest of the galaxies and put them in a list
                 self.snrs = []
                 self.snrs.append(self.snr)  # the first entry is the snr of the first galaxy
@@ -90,24 +126,135 @@ class Fisher(object):
 
         else:
             self.var_noise = var_noise
+            if snrs is not None:
+                self.snrs = list(snrs)
+        self.weight = images.get_weight(self.var_noise)
 
-        self.steps = defaults.get_steps(self.g_parameters, self.image_renderer)
-        self.param_names = g_parameters.ordered_fit_names
+        self.index = gparameters.ParameterIndex(self.g_parameters, self.image_renderer)
+        self.steps = dict(zip(self.index.names, self.index.steps))
+        self.param_names = self.index.names
         self.num_params = len(self.param_names)
 
-        self.derivatives_images = self.get_derivative_images()
-        self.second_derivatives_images = self.get_second_derivatives_images()
+    def _set_results(self):
+        """Compute everything that depends on the derivative images."""
         self.fisher_matrix_images = self.get_fisher_matrix_images()
         self.fisher_matrix = self.get_fisher_matrix()
         self.covariance_matrix = self.get_covariance_matrix()
         self.correlation_matrix = self.get_correlation_matrix()
-        self.bias_matrix_images = self.get_bias_matrix_images()
+        self._bias_matrix_images = None
         self.bias_matrix = self.get_bias_matrix()
         self.bias_images = self.get_bias_images()
         self.biases = self.get_biases()
-
         self.fisher_condition_number = self.get_fisher_condition_number()
 
+    @property
+    def bias_matrix_images(self):
+        """The images of the bias matrix, n times as many as the second derivative images, are
+        only computed the first time they are used."""
+        if getattr(self, '_bias_matrix_images', None) is None:
+            self._bias_matrix_images = self.get_bias_matrix_images()
+        return self._bias_matrix_images
+
+    @bias_matrix_images.setter
+    def bias_matrix_images(self, value):
+        self._bias_matrix_images = value
+
+    def share(self, kind='shm', directory=None):
+        """Move the image stacks into memory shared between processes (see :mod:`analysis.shared`).
+
+        Afterwards pickling this object (e.g. to send it to worker processes) only copies
+        handles to the stacks, which the workers attach to. The shared memory is released
+        when this object is.
+
+        Args:
+            kind(str): 'shm' to use POSIX shared memory, 'mmap' to use memory-mapped files.
+            directory(str): Directory of the files when kind is 'mmap'.
+
+        Returns:
+            A dict from the name of each stack to its :class:`analysis.shared.StackHandle`.
+        """
+        self.shared_handles = shared.share_stacks(self, kind, directory)
+        return self.shared_handles
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if state.get('shared_handles') is not None:
+            for attribute in shared.STACKS:
+                state.pop(attribute, None)
+            state.pop('_bias_matrix_images', None)  # behind the bias_matrix_images property.
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if state.get('shared_handles') is not None:
+            shared.attach_stacks(self, self.shared_handles)
+
+    def reparameterize(self, mapping):
+        """Return a new :class:`Fisher` object with the analysis in another parameterization of
+        the galaxies, without drawing any image.
+
+        With theta the current and phi the new parameters, the derivative images transform with
+        the chain rule, dm/dphi_a = J_ia dm/dtheta_i and d2m/dphi_a dphi_b = J_ia J_jb
+        d2m/dtheta_i dtheta_j + H_iab dm/dtheta_i, where J and H are the jacobian and hessian of
+        theta(phi) (see :mod:`analysis.parameterizations`). Everything else (fisher matrix,
+        covariance, bias images, biases) is then obtained from the new derivatives as usual.
+
+        Args:
+            mapping(dict): From the current to the new parameterization, keys of
+                :data:`analysis.parameterizations.FAMILIES`, e.g. {'g': 'e', 'hlr': 'sigma'}. Each
+                conversion is applied to every galaxy fit with the current parameters.
+
+        Returns:
+            A :class:`Fisher`. Its steps are the default ones of the new parameters, the
+            derivatives were not computed with them.
+        """
+        id_params = deepcopy(self.g_parameters.id_params)
+        names = list(self.param_names)
+        jacobian = np.eye(self.num_params)
+        hessian = np.zeros((self.num_params,) * 3)
+
+        for gal_id, params in id_params.items():
+            for old, new in mapping.items():
+                old_names = parameterizations.FAMILIES[old]
+                positions = [self.index.position.get(f'{name}_{gal_id}') for name in old_names]
+                if None in positions:
+                    continue
+                if new in parameterizations.SIZE_FAMILIES and params['galaxy_model'] != 'gaussian':
+                    raise ValueError(f'Galaxy {gal_id} is not gaussian, its size can not be given by sigma.')
+
+                new_values = parameterizations.convert(old, new, [params.pop(name) for name in old_names])
+                jac, hess = parameterizations.get_jacobian_hessian(old, new, new_values)
+                jacobian[np.ix_(positions, positions)] = jac
+                hessian[np.ix_(positions, positions, positions)] = hess
+
+                for i, name, value in zip(positions, parameterizations.FAMILIES[new], new_values):
+                    params[name] = value
+                    names[i] = f'{name}_{gal_id}'
+
+        g_parameters = gparameters.GParameters(id_params=id_params)
+        if set(g_parameters.ordered_fit_names) != set(names):
+            raise ValueError('The new parameters do not correspond to the fit parameters of the galaxies.')
+        order = [names.index(name) for name in g_parameters.ordered_fit_names]
+        jacobian = jacobian[:, order]
+        hessian = hessian[:, order][:, :, order]
+
+        derivatives = self.get_derivatives_stack()
+        new_derivatives = np.einsum('ia,ixy->axy', jacobian, derivatives)
+        new_second_derivatives = (np.einsum('ia,jb,ijxy->abxy', jacobian, jacobian,
+                                            self.get_second_derivatives_stack()) +
+                                  np.einsum('iab,ixy->abxy', hessian, derivatives))
+
+        return Fisher.from_stacks(g_parameters, self.image_renderer, self.snr, new_derivatives, new_second_derivatives,
+                                  var_noise=self.var_noise, image=self.image, snrs=getattr(self, 'snrs', None))
+
+    def set_derivatives(self, derivatives, second_derivatives):
+        """Replace the derivative images by the stacks derivatives (n, ny, nx) and
+        second_derivatives (n, n, ny, nx), ordered by param_names, and recompute everything that
+        depends on them."""
+        self.derivatives_images = self._to_matrix(derivatives, 1)
+        self.second_derivatives_images = self._to_matrix(second_derivatives, 2)
+        self._set_results()
+
     def matrix_to_numpy_array(self, matrix):
         """Convert matrix dictionary to a numpy array."""
         array = np.zeros([self.num_params, self.num_params])
@@ -129,6 +276,12 @@ class Fisher(object):
                 matrix[param_i, param_j] = array[i][j]
         return matrix
 
+    def get_image_at(self, shift):
+        """Return the image (array) of the galaxies with their fit parameters moved by shift."""
+        id_params = self.index.to_id_params(self.index.values + shift)
+        gal = gparameters.get_galaxies_models(id_params=id_params)
+        return self.image_renderer_partials.get_image(gal).array
+
     def get_derivative_images(self):
         """Return images of the partial derivatives of the galaxy.
 
@@ -138,15 +291,10 @@ class Fisher(object):
         partials_images = {}
         for i in range(self.num_params):
             param = self.param_names[i]
-            params_up = copy.deepcopy(self.g_parameters.params)
-            params_up[param] += self.steps[param]
-            params_down = copy.deepcopy(self.g_parameters.params)
-            params_down[param] -= self.steps[param]
-            gal_up = gparameters.get_galaxies_models(params_up)
-            gal_down = gparameters.get_galaxies_models(params_down)
-            img_up = self.image_renderer_partials.get_image(gal_up)
-            img_down = self.image_renderer_partials.get_image(gal_down)
-            partials_images[param] = ((img_up - img_down) / (2 * self.steps[param])).array
+            shift = self.index.get_shift(i)
+            img_up = self.get_image_at(shift)
+            img_down = self.get_image_at(-shift)
+            partials_images[param] = (img_up - img_down) / (2 * self.steps[param])
         return partials_images
 
     def get_second_derivatives_images(self):
@@ -156,62 +304,47 @@ class Fisher(object):
             for j in range(self.num_params):
                 param_i = self.param_names[i]
                 param_j = self.param_names[j]
+                shift_i = self.index.get_shift(i)
+                shift_j = self.index.get_shift(j)
 
-                params_iup_jup = copy.deepcopy(self.g_parameters.params)
-                params_iup_jup[param_i] += self.steps[param_i]
-                params_iup_jup[param_j] += self.steps[param_j]
-
-                params_idown_jup = copy.deepcopy(self.g_parameters.params)
-                params_idown_jup[param_i] -= self.steps[param_i]
-                params_idown_jup[param_j] += self.steps[param_j]
-
-                params_iup_jdown = copy.deepcopy(self.g_parameters.params)
-                params_iup_jdown[param_i] += self.steps[param_i]
-                params_iup_jdown[param_j] -= self.steps[param_j]
-
-                params_idown_jdown = copy.deepcopy(self.g_parameters.params)
-                params_idown_jdown[param_i] -= self.steps[param_i]
-                params_idown_jdown[param_j] -= self.steps[param_j]
-
-                gal_iup_jup = gparameters.get_galaxies_models(params_iup_jup)
-                gal_idown_jup = gparameters.get_galaxies_models(params_idown_jup)
-                gal_iup_jdown = gparameters.get_galaxies_models(params_iup_jdown)
-                gal_idown_jdown = gparameters.get_galaxies_models(params_idown_jdown)
-
-                img_iup_jup = self.image_renderer_partials.get_image(gal_iup_jup)
-                img_idown_jup = self.image_renderer_partials.get_image(gal_idown_jup)
-                img_iup_jdown = self.image_renderer_partials.get_image(gal_iup_jdown)
-                img_idown_jdown = self.image_renderer_partials.get_image(gal_idown_jdown)
+                img_iup_jup = self.get_image_at(shift_i + shift_j)
+                img_idown_jup = self.get_image_at(-shift_i + shift_j)
+                img_iup_jdown = self.get_image_at(shift_i - shift_j)
+                img_idown_jdown = self.get_image_at(-shift_i - shift_j)
 
                 secondDs_gal[param_i, param_j] = ((img_iup_jup + img_idown_jdown -
                                                    img_idown_jup - img_iup_jdown) /
-                                                  (4 * self.steps[param_i] * self.steps[param_j])).array
+                                                  (4 * self.steps[param_i] * self.steps[param_j]))
 
         return secondDs_gal
 
+    def get_derivatives_stack(self):
+        """Return array of shape (n, ny, nx) with the derivative images in the order of param_names."""
+        return np.array([self.derivatives_images[param] for param in self.param_names])
+
+    def get_second_derivatives_stack(self):
+        """Return array of shape (n, n, ny, nx) with the second derivative images in the order of
+        param_names."""
+        return np.array([[self.second_derivatives_images[param_i, param_j] for param_j in self.param_names]
+                         for param_i in self.param_names])
+
+    def _to_matrix(self, array, rank):
+        """Convert the first rank axes of array to a dictionary keyed by tuples of param_names."""
+        keys = itertools.product(self.param_names, repeat=rank)
+        indices = itertools.product(range(self.num_params), repeat=rank)
+        return {key[0] if rank == 1 else key: array[index] for key, index in zip(keys, indices)}
+
     def get_fisher_matrix_images(self):
         """Produce images of fisher matrix)."""
-        FisherM_images = {}
-        for i in range(self.num_params):
-            for j in range(self.num_params):
-                param_i = self.param_names[i]
-                param_j = self.param_names[j]
-                derivative1 = self.derivatives_images[param_i]
-                derivative2 = self.derivatives_images[param_j]
-                FisherM_images[param_i, param_j] = (
-                        derivative1 * derivative2 / self.var_noise)
-        return FisherM_images
+        derivatives = self.get_derivatives_stack()
+        images_array = derivatives[:, None] * (derivatives * self.weight)[None, :]
+        return self._to_matrix(images_array, 2)
 
     def get_fisher_matrix(self):
         """Calculate the actual values of the fisher matrix."""
-        FisherM = {}
-        for i in range(self.num_params):
-            for j in range(self.num_params):
-                param_i = self.param_names[i]
-                param_j = self.param_names[j]
-                FisherM[param_i, param_j] = (
-                    self.fisher_matrix_images[param_i, param_j].sum())
-        return FisherM
+        derivatives = self.get_derivatives_stack()
+        fisher_array = np.einsum('ixy,jxy->ij', derivatives * self.weight, derivatives)
+        return self.numpy_array_to_matrix(fisher_array)
 
     def get_covariance_matrix(self):
         """Calculate the covariance matrix by inverting fisher matrix."""
@@ -221,66 +354,34 @@ class Fisher(object):
 
     def get_correlation_matrix(self):
         """Calculate correlation matrix from the covariance matrix."""
-        correlation_matrix = {}
-        for i in range(self.num_params):
-            for j in range(self.num_params):
-                param_i = self.param_names[i]
-                param_j = self.param_names[j]
-                sigma_ij = self.covariance_matrix[param_i, param_j]
-                sigma_i = math.sqrt(self.covariance_matrix[param_i, param_i])
-                sigma_j = math.sqrt(self.covariance_matrix[param_j, param_j])
-                correlation_matrix[param_i, param_j] = (sigma_ij /
-                                                        (sigma_i * sigma_j))
-
-        return correlation_matrix
+        covariance_array = self.matrix_to_numpy_array(self.covariance_matrix)
+        sigmas = np.sqrt(np.diag(covariance_array))
+        return self.numpy_array_to_matrix(covariance_array / np.outer(sigmas, sigmas))
 
     def get_bias_matrix_images(self):
         """Produce images of each element of the bias matrix."""
-        BiasM_images = {}
-        for i in range(self.num_params):
-            for j in range(self.num_params):
-                for k in range(self.num_params):
-                    param_i = self.param_names[i]
-                    param_j = self.param_names[j]
-                    param_k = self.param_names[k]
-                    BiasM_images[param_i, param_j, param_k] = (
-                            self.derivatives_images[param_i] *
-                            self.second_derivatives_images[param_j, param_k] /
-                            self.var_noise)
-
-        return BiasM_images
+        weighted_derivatives = self.get_derivatives_stack() * self.weight
+        images_array = weighted_derivatives[:, None, None] * self.get_second_derivatives_stack()[None]
+        return self._to_matrix(images_array, 3)
 
     def get_bias_matrix(self):
         """Return bias matrix from the images of the bias matrix"""
-        BiasM = {}
-        for i in range(self.num_params):
-            for j in range(self.num_params):
-                for k in range(self.num_params):
-                    param_i = self.param_names[i]
-                    param_j = self.param_names[j]
-                    param_k = self.param_names[k]
-                    BiasM[param_i, param_j, param_k] = self.bias_matrix_images[
-                        param_i, param_j, param_k].sum()
-        return BiasM
+        bias_array = np.einsum('ixy,jkxy->ijk', self.get_derivatives_stack() * self.weight,
+                               self.get_second_derivatives_stack())
+        return self._to_matrix(bias_array, 3)
 
     def get_bias_images(self):
-        """Construct the bias of each parameter per pixel."""
-        bias_images = {}
-        for i in range(self.num_params):
-            summation = 0
-            for j in range(self.num_params):
-                for k in range(self.num_params):
-                    for l in range(self.num_params):
-                        param_i = self.param_names[i]
-                        param_j = self.param_names[j]
-                        param_k = self.param_names[k]
-                        param_l = self.param_names[l]
-                        summation += (self.covariance_matrix[param_i, param_j] *
-                                      self.covariance_matrix[param_k, param_l] *
-                                      self.bias_matrix_images[param_j, param_k,
-                                                              param_l])
-            bias_images[self.param_names[i]] = (-.5) * summation
-        return bias_images
+        """Construct the bias of each parameter per pixel.
+
+        The sum over j, k, l of C_ij C_kl (bias matrix image)_jkl factorizes into
+        (sum_j C_ij w D_j) (sum_kl C_kl D_kl), with D_j the derivative and D_kl the second
+        derivative images and w the weight of the pixels.
+        """
+        covariance_array = self.matrix_to_numpy_array(self.covariance_matrix)
+        weighted_derivatives = self.get_derivatives_stack() * self.weight
+        first = np.einsum('ij,jxy->ixy', covariance_array, weighted_derivatives)
+        second = np.einsum('kl,klxy->xy', covariance_array, self.get_second_derivatives_stack())
+        return self._to_matrix(-.5 * first * second, 1)
 
     def get_biases(self):
         """Return the value of the bias of each parameter in vector form."""
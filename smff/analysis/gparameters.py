@@ -3,7 +3,9 @@ import os
 from copy import deepcopy
 
 import galsim
+import numpy as np
 
+from . import images
 from . import models
 from .. import defaults
 
@@ -45,17 +47,36 @@ def get_galaxy_model(params):
 
     final = gal_model.gal
 
-    if params.get('psf_flux', 0) != 0:
+    psf = get_psf_model(params)
+    if psf is not None:
+        final = galsim.Convolve([final, psf])
 
-        if params.get('psf_flux', 1) != 1:
-            raise ValueError('I do not think you want a psf of flux not 1')
+    return final
 
-        psf_cls = models.get_model_cls(params['psf_model'])
-        psf_model = psf_cls(params)
 
-        final = galsim.Convolve([final, psf_model.psf])
+def get_psf_model(params):
+    """Return the :class:`galsim.GSObject` of the psf in params (dictionary of a single galaxy or
+    of the psf parameters alone), None if params have no psf (psf_flux is missing or 0)."""
+    if params.get('psf_flux', 0) == 0:
+        return None
 
-    return final
+    if params.get('psf_flux', 1) != 1:
+        raise ValueError('I do not think you want a psf of flux not 1')
+
+    psf_cls = models.get_model_cls(params['psf_model'])
+    return psf_cls(params).psf
+
+
+def get_var_noise(g_parameters, image_renderer, snr):
+    """Return the variance of the noise that gives the first galaxy of g_parameters, drawn alone
+    with image_renderer, the S/N ratio snr.
+
+    This is the noise of every analysis and fit of a project at a given snr (with a single galaxy,
+    the noise that gives the whole image that S/N ratio), so the fisher analysis and the fits of
+    the noise realizations agree however they are run.
+    """
+    params = next(iter(g_parameters.id_params.values()))
+    return images.get_var_noise(image_renderer.get_image(get_galaxy_model(params)), snr)
 
 
 def get_galaxies_models(fit_params=None, id_params=None, g_parameters=None, **kwargs):
@@ -110,6 +131,8 @@ class GParameters(object):
             galaxies.csv file.
 
         Attributes:
+            project(str): Directory the parameters were read from, None if
+                they were given directly as id_params.
             omit_fit(dict): Dictionary defined in containing
                 the parameters that should not be included in the
                 analysis for a particular galaxy model but could be
@@ -167,6 +190,7 @@ class GParameters(object):
                     except ValueError:
                         pass
 
+        self.project = project
         self.id_params = id_params
         self.params = GParameters.convert_id_params(self.id_params)
         self.omit_fit = _get_omit_fit(id_params, omit)
@@ -242,3 +266,191 @@ class GParameters(object):
             id_params[gal_id] = ID_params
 
         return id_params
+
+
+class ParameterIndex(object):
+    """Array representation of the parameters that are fit in a :class:`GParameters` object.
+
+    The fit parameters are given a fixed position (the order of
+    :attr:`GParameters.ordered_fit_names`) and the values, steps and bounds of each one are
+    resolved once from :mod:`defaults` and stored in numpy arrays, so perturbations of the
+    parameters are array operations. Vectors are only converted back to dictionaries, with
+    :meth:`to_id_params`, when the galaxies need to be drawn with galsim.
+
+        Args:
+            g_parameters(:class:`GParameters`): Parameters of the galaxies.
+            image_renderer(:class:`analysis.images.ImageRenderer`): Object used to render the
+                galaxies, needed for the steps and bounds of the positions.
+
+        Attributes:
+            names(list): Names of the fit parameters in the order of the vectors.
+            position(dict): Position in the vectors of each name.
+            gal_ids(list): Id of the galaxy each parameter belongs to.
+            values(:class:`np.array`): True values of the parameters.
+            steps(:class:`np.array`): Steps used for the derivatives of each parameter.
+            mins(:class:`np.array`): Lower bounds used when fitting each parameter.
+            maxs(:class:`np.array`): Upper bounds used when fitting each parameter.
+    """
+
+    def __init__(self, g_parameters, image_renderer):
+        self.names = list(g_parameters.ordered_fit_names)
+        self.num_params = len(self.names)
+        self.position = {name: i for i, name in enumerate(self.names)}
+
+        self.gal_ids = []
+        self._id_positions = {gal_id: [] for gal_id in g_parameters.id_params}
+        for i, name in enumerate(self.names):
+            base_name, gal_id = name.rsplit('_', 1)
+            self.gal_ids.append(gal_id)
+            self._id_positions[gal_id].append((base_name, i))
+
+        # parameters of each galaxy that never change, including the psf.
+        self._fixed_id_params = {}
+        for gal_id, params in g_parameters.id_params.items():
+            fit_names = [base_name for base_name, _ in self._id_positions[gal_id]]
+            self._fixed_id_params[gal_id] = {k: v for (k, v) in params.items() if k not in fit_names}
+
+        steps = defaults.get_steps(g_parameters, image_renderer)
+        mins = defaults.get_minimums(g_parameters, image_renderer.stamp)
+        maxs = defaults.get_maximums(g_parameters, image_renderer.stamp)
+        self.values = np.array([g_parameters.params[name] for name in self.names], dtype=float)
+        self.steps = np.array([steps[name] for name in self.names], dtype=float)
+        self.mins = np.array([mins.get(name, -np.inf) for name in self.names], dtype=float)
+        self.maxs = np.array([maxs.get(name, np.inf) for name in self.names], dtype=float)
+
+    def get_shift(self, *positions):
+        """Return the vector that moves the parameters at positions by one step each (a
+        position can be repeated)."""
+        shift = np.zeros(self.num_params)
+        for i in positions:
+            shift[i] += self.steps[i]
+        return shift
+
+    def to_id_params(self, vector):
+        """Return the parameters in vector, together with the fixed parameters, in the format of
+        :attr:`GParameters.id_params` so the galaxies can be drawn."""
+        id_params = {}
+        for gal_id, fixed in self._fixed_id_params.items():
+            params = dict(fixed)
+            for base_name, i in self._id_positions[gal_id]:
+                params[base_name] = vector[i]
+            id_params[gal_id] = params
+        return id_params
+
+    def to_dict(self, vector):
+        """Return vector as a dictionary from the names of the fit parameters to their values."""
+        return dict(zip(self.names, vector))
+
+
+class ModelEvaluator(object):
+    """Callable that draws the galaxies of a :class:`GParameters` object from a vector of values of
+    their fit parameters, used for the objective functions of the fits.
+
+    Everything that does not depend on the fit parameters is resolved once: the model class and
+    fixed parameters of each galaxy, the psf (never fit), the galaxies without fit parameters and
+    the image the models are drawn into. Each call only builds the profiles of the galaxies whose
+    parameters vary. The images are drawn like :meth:`analysis.images.ImageRenderer.get_image`
+    but without going through its cache.
+
+        Args:
+            g_parameters(:class:`GParameters`): Parameters of the galaxies.
+            image_renderer(:class:`analysis.images.ImageRenderer`): Object whose stamp, mask, draw
+                method and gsparams are used to draw the galaxies.
+            names(list): Names of the fit parameters in the order of the vectors, by default
+                :attr:`GParameters.ordered_fit_names`.
+
+        Attributes:
+            names(list): Names of the parameters in the order of the vectors.
+            num_calls(int): Number of images drawn.
+    """
+
+    def __init__(self, g_parameters, image_renderer, names=None):
+        self.names = list(g_parameters.ordered_fit_names if names is None else names)
+        self.num_calls = 0
+
+        positions = {gal_id: [] for gal_id in g_parameters.id_params}
+        for i, name in enumerate(self.names):
+            base_name, gal_id = name.rsplit('_', 1)
+            positions[gal_id].append((base_name, i))
+
+        # (model, fixed parameters, positions of the fit parameters, psf) of each varying galaxy.
+        self._varying = []
+        self._constant = []
+        for gal_id, params in g_parameters.id_params.items():
+            if not positions[gal_id]:
+                self._constant.append(get_galaxy_model(params))
+                continue
+
+            fit_names = [base_name for base_name, _ in positions[gal_id]]
+            fixed = {k: v for (k, v) in params.items() if k not in fit_names}
+            model = models.get_model_cls(params['galaxy_model'])()
+            self._varying.append((model, fixed, positions[gal_id], get_psf_model(params)))
+
+        self._gsparams = None
+        if images.GSPARAMS_PROFILES[image_renderer.gsparams]:
+            self._gsparams = galsim.GSParams(**images.GSPARAMS_PROFILES[image_renderer.gsparams])
+        self._method = image_renderer.method
+        self._mask = image_renderer.mask
+        self._image = deepcopy(image_renderer.stamp)
+
+    @staticmethod
+    def _get_galaxy(model, fixed, positions, psf, vector):
+        params = dict(fixed)
+        for base_name, i in positions:
+            params[base_name] = vector[i]
+
+        gal = model.get_gal(params)
+        if psf is not None:
+            gal = galsim.Convolve([gal, psf])
+        return gal
+
+    def get_model(self, vector):
+        """Return the :class:`galsim.GSObject` of the galaxies with fit parameters in vector."""
+        gals = list(self._constant)
+        for model, fixed, positions, psf in self._varying:
+            gals.append(self._get_galaxy(model, fixed, positions, psf, vector))
+
+        return galsim.Add(gals)
+
+    def _draw(self, galaxy):
+        if self._gsparams is not None:
+            galaxy = galaxy.withGSParams(self._gsparams)
+
+        galaxy.drawImage(image=self._image, use_true_center=False, method=self._method)
+        if self._mask is not None:
+            self._image.array[self._mask] = 0.
+
+        self.num_calls += 1
+        return self._image.array
+
+    def __call__(self, vector):
+        """Return the array of the image of the galaxies with fit parameters in vector.
+
+        The array is overwritten by the next call, copy it if it needs to be kept.
+        """
+        return self._draw(self.get_model(vector))
+
+    def get_jacobian(self, vector, steps):
+        """Return array of shape (number of parameters, ny, nx) with the derivatives of the image
+        of the galaxies with respect to each fit parameter at vector.
+
+        The image of each galaxy only depends on its own parameters, so only that galaxy is drawn
+        again for their forward differences (with steps, which can be negative). The image is
+        proportional to the flux, its derivative with respect to a flux is the image of the
+        galaxy divided by the flux and needs no drawing at all.
+        """
+        vector = np.asarray(vector, dtype=float)
+        jacobian = np.zeros((vector.size,) + self._image.array.shape)
+        for model, fixed, positions, psf in self._varying:
+            image = self._draw(self._get_galaxy(model, fixed, positions, psf, vector)).copy()
+            for base_name, i in positions:
+                if base_name == 'flux' and vector[i] != 0:
+                    jacobian[i] = image / vector[i]
+                    continue
+
+                shifted = vector.copy()
+                shifted[i] += steps[i]
+                shifted_image = self._draw(self._get_galaxy(model, fixed, positions, psf, shifted))
+                jacobian[i] = (shifted_image - image) / steps[i]
+
+        return jacobian
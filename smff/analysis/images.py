@@ -1,6 +1,34 @@
+import hashlib
+import json
+import math
+import os
+import warnings
 from copy import deepcopy
 
 import galsim
+import numpy as np
+
+from .. import defaults
+
+# named sets of galsim.GSParams that trade accuracy of the rendered images for speed, galsim
+# defaults are folding_threshold=5e-3, maxk_threshold=1e-3 and k/xvalue_accuracy=1e-5.
+GSPARAMS_PROFILES = {
+    'fast': dict(folding_threshold=2e-2, maxk_threshold=1e-2, kvalue_accuracy=1e-4, xvalue_accuracy=1e-4),
+    'default': dict(),
+    'accurate': dict(folding_threshold=1e-3, maxk_threshold=1e-4, kvalue_accuracy=1e-6, xvalue_accuracy=1e-6),
+}
+
+# methods of galsim.GSObject.drawImage that can be used (deterministic ones).
+DRAW_METHODS = ['auto', 'fft', 'real_space', 'no_pixel']
+
+
+class DrawFallbackWarning(UserWarning):
+    """Warned when galsim can not draw an image with method 'real_space' and uses a DFT instead."""
+
+
+# ids of the independent random streams derived from the seed of a set of fits (see get_stream_key).
+NOISE_STREAM = 0
+INIT_STREAM = 1
 
 
 class ImageRenderer(object):
@@ -14,6 +42,15 @@ class ImageRenderer(object):
             not actually use whatever was originally in the stamp.
         bounds(tuple): When drawn, the image will be clipped to these bounds.
         mask(:class:`np.array`): the pixels selected in this mask will be set to 0.
+        cache(:class:`RenderCache`): optional, cache on disk where rendered images are saved
+            and looked up before drawing them again.
+        method(str): Method passed on to :meth:`galsim.GSObject.drawImage`, one of
+            :data:`DRAW_METHODS`. 'real_space' avoids the FFTs, but galsim can only convolve two
+            profiles analytic in real space that way, so galaxies convolved with a psf and the
+            pixel are drawn with a DFT as with 'auto' (a :class:`DrawFallbackWarning` is
+            warned when that happens). 'no_pixel' skips the convolution with the pixel, which
+            is a different model of the images, use it only if that is intended.
+        gsparams(str): Name of the profile in :data:`GSPARAMS_PROFILES` used when drawing.
 
     One of the the following must be specified:
         * stamp
@@ -23,7 +60,7 @@ class ImageRenderer(object):
     """
 
     def __init__(self, pixel_scale=None, nx=None, ny=None, stamp=None,
-                 bounds=None, mask=None):
+                 bounds=None, mask=None, cache=None, method='auto', gsparams='default'):
 
         self.pixel_scale = pixel_scale
         self.nx = nx
@@ -31,6 +68,14 @@ class ImageRenderer(object):
         self.bounds = bounds
         self.mask = mask
         self.stamp = stamp
+        self.cache = cache
+        self.method = method
+        self.gsparams = gsparams
+
+        if self.method not in DRAW_METHODS:
+            raise ValueError(f'Draw method should be one of {DRAW_METHODS}')
+        if self.gsparams not in GSPARAMS_PROFILES:
+            raise ValueError(f'GSParams profile should be one of {list(GSPARAMS_PROFILES)}')
 
         if self.stamp is None:
             if self.nx is not None and self.ny is not None and self.pixel_scale is not None:
@@ -44,15 +89,285 @@ class ImageRenderer(object):
         if self.bounds is not None:
             self.stamp = self.stamp[bounds]
 
+    def get_config(self):
+        """Return a json-serializable dictionary describing how this object renders
+        images, used to key results that depend on the rendering (see :mod:`analysis.store`).
+        """
+        bounds = self.stamp.bounds
+        config = {
+            'pixel_scale': self.pixel_scale,
+            'bounds': [bounds.xmin, bounds.xmax, bounds.ymin, bounds.ymax],
+            'mask': None,
+            'method': self.method,
+            'gsparams': self.gsparams,
+        }
+        if self.mask is not None:
+            config['mask'] = hashlib.sha1(self.mask.tobytes()).hexdigest()
+        return config
+
+    def get_unmasked(self):
+        """Return a renderer that draws in the same way (stamp, method, gsparams and cache) but
+        does not mask the images, used for the partial derivatives."""
+        return ImageRenderer(stamp=self.stamp, cache=self.cache, method=self.method,
+                             gsparams=self.gsparams)
+
+    def _draw_real_space(self, galaxy, img):
+        """Draw galaxy with method 'real_space', replacing the warning galsim gives when it switches
+        to a DFT with a :class:`DrawFallbackWarning`, so the fallback can be told apart."""
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', galsim.GalSimWarning)
+            galaxy.drawImage(image=img, use_true_center=False, method=self.method)
+
+        for warning in caught:
+            if issubclass(warning.category, galsim.GalSimWarning) and 'DFT' in str(warning.message):
+                warnings.warn("galsim can not draw the galaxy in real space, it was drawn with a DFT as "
+                              f"with method 'auto' ({warning.message})", DrawFallbackWarning)
+            else:
+                warnings.warn_explicit(warning.message, warning.category, warning.filename, warning.lineno)
+
     def get_image(self, galaxy):
-        img = deepcopy(self.stamp)
-        galaxy.drawImage(image=img, use_true_center=False)
+        if self.cache is not None:
+            key = self.cache.get_key(galaxy, self)
+            img = self.cache.load(key, self.stamp)
+            if img is not None:
+                return img
 
-        if self.mask is None:
-            return img
+        if GSPARAMS_PROFILES[self.gsparams]:
+            galaxy = galaxy.withGSParams(**GSPARAMS_PROFILES[self.gsparams])
+
+        img = deepcopy(self.stamp)
+        if self.method == 'real_space':
+            self._draw_real_space(galaxy, img)
         else:
+            galaxy.drawImage(image=img, use_true_center=False, method=self.method)
+
+        if self.mask is not None:
             img.array[self.mask] = 0.
-            return img
+
+        if self.cache is not None:
+            self.cache.save(key, img.array)
+
+        return img
+
+
+class RenderCache(object):
+    """Content-addressed cache on disk of the images drawn by :class:`ImageRenderer`.
+
+    Each image is saved in a .npy file named after a hash of the galsim object drawn, the
+    configuration of the renderer (stamp geometry, pixel scale and mask) and the version of
+    galsim. The repr of a galsim object fully specifies it, so the hash covers every parameter of
+    every galaxy and of the psf. Images are returned memory-mapped (copy-on-write), so several
+    processes reading the same image share the pages.
+
+    Args:
+        directory(str): Directory where the images are saved, created if it does not exist.
+        max_bytes(int): optional, when the images in the cache take more than this, the least
+            recently used ones are removed.
+        safe(bool): Whether several processes might use the directory at the same time. If True
+            images are written to a temporary file that is then moved into place, so readers
+            never see a partially written image, and the eviction is done under a file lock.
+
+    Attributes:
+        hits(int): Number of images found in the cache.
+        misses(int): Number of images that had to be drawn.
+    """
+
+    lock_file = '.lock'
+
+    def __init__(self, directory, max_bytes=None, safe=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.safe = safe
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def get_key(galaxy, image_renderer):
+        description = {
+            'galaxy': repr(galaxy),
+            'renderer': image_renderer.get_config(),
+            'dtype': str(image_renderer.stamp.array.dtype),
+            'galsim': galsim.__version__,
+        }
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def get_filename(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def load(self, key, stamp):
+        """Return the image saved under key as a :class:`galsim.Image` with the bounds and wcs of
+        stamp, or None if it is not in the cache.
+        """
+        filename = self.get_filename(key)
+        try:
+            array = np.load(filename, mmap_mode='c')
+            os.utime(filename)  # mark as recently used.
+        except (FileNotFoundError, ValueError):
+            # not cached yet, or removed by another process in the meantime.
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return galsim.Image(array, xmin=stamp.xmin, ymin=stamp.ymin, wcs=stamp.wcs)
+
+    def save(self, key, array):
+        filename = self.get_filename(key)
+        if self.safe:
+            with defaults.atomic_file(filename, binary=True) as f:
+                np.save(f, array)
+        else:
+            np.save(filename, array)
+
+        if self.max_bytes is not None:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used images until the cache takes at most max_bytes."""
+        if not self.safe:
+            self._evict()
+            return
+
+        import fcntl
+        with open(os.path.join(self.directory, self.lock_file), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._evict()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def get_var_noise(image, snr):
+    """Return the variance of the noise that gives image the S/N ratio snr.
+
+    Same definition as :meth:`galsim.Image.addNoiseSNR` with preserve_flux=True.
+    """
+    return np.sum(image.array.astype(np.float64) ** 2) / snr ** 2
+
+
+def get_weight(var_noise):
+    """Return the weight (inverse variance) of the pixels given the variance of the noise, a float
+    or a map (array) where infinite values mark pixels without data, which get weight 0."""
+    if np.ndim(var_noise) == 0:
+        return 0. if math.isinf(var_noise) else 1. / var_noise
+    var_noise = np.asarray(var_noise, dtype=float)
+    return np.where(np.isinf(var_noise), 0., 1. / var_noise)
+
+
+def weight_to_var_noise(weight):
+    """Return the variance map corresponding to a weight map (inverse variance), with infinite
+    variance where the weight is 0."""
+    weight = np.asarray(weight, dtype=float)
+    with np.errstate(divide='ignore'):
+        return np.where(weight > 0, 1. / weight, np.inf)
+
+
+def get_stream_key(seed, stream, index=None):
+    """Return the key of the philox generator of stream (and index within it) of a seed.
+
+    The key is derived with :class:`np.random.SeedSequence`, so the streams of the same or of
+    different seeds are independent, and any of them can be regenerated from (seed, stream, index)
+    alone, wherever and in whatever order the fits are run.
+    """
+    spawn_key = (stream,) if index is None else (stream, int(index))
+    return np.random.SeedSequence(seed, spawn_key=spawn_key).generate_state(2, np.uint64)
+
+
+def get_stream_rng(seed, stream, index=None):
+    """Return a :class:`np.random.Generator` for stream (and index within it) of a seed."""
+    return np.random.Generator(np.random.Philox(key=get_stream_key(seed, stream, index)))
+
+
+class NoiseEngine(object):
+    """Produce realizations of gaussian noise for a given image.
+
+    The variance of the noise is computed only once and the noise fields are generated in blocks
+    with a single vectorized call to a counter-based numpy generator (Philox) keyed by the
+    :data:`NOISE_STREAM` of the seed. The realization with a given index only depends on the seed
+    and on that index, so it is the same whether it is generated by itself or as part of any block.
+
+    Args:
+        image(:class:`galsim.Image`): Noiseless image that noise is added to.
+        snr(float): Signal to noise ratio, used to compute the variance of the noise.
+        var_noise(float or :class:`np.array`): Variance of the noise, can be given instead of snr,
+            either the same for every pixel or a map with the shape of the image (pixels with
+            infinite variance get no noise).
+        seed(int): Seed of the set of fits the noise is generated for.
+
+    Attributes:
+        var_noise(float or :class:`np.array`): Variance of the noise on each pixel.
+    """
+
+    def __init__(self, image, snr=None, var_noise=None, seed=0):
+        if var_noise is None:
+            if snr is None:
+                raise ValueError('Need to specify either snr or var_noise.')
+            var_noise = get_var_noise(image, snr)
+
+        self.image = image
+        self.var_noise = var_noise
+        self.seed = seed
+        self.key = get_stream_key(seed, NOISE_STREAM)
+        self.shape = image.array.shape
+
+        # one pair of uniforms per pair of normals (Box-Muller), rounded up to a whole number of
+        # philox blocks (4 words) so each realization starts at its own counter.
+        self.num_pixels = image.array.size
+        self.num_uniforms = 2 * int(math.ceil(self.num_pixels / 2.))
+        self.num_words = 4 * int(math.ceil(self.num_uniforms / 4.))
+
+        # standard deviation of the noise of each pixel (flattened) or of all of them.
+        self.sigma = np.sqrt(np.where(np.isinf(var_noise), 0., var_noise))
+        if self.sigma.ndim:
+            self.sigma = self.sigma.ravel()
+
+    def get_noise(self, start, size=1):
+        """Return array of shape (size, ny, nx) with the noise realizations of indices start,
+        start + 1, ..., start + size - 1.
+        """
+        bit_generator = np.random.Philox(key=self.key)
+        bit_generator.advance(int(start) * self.num_words // 4)
+        uniforms = np.random.Generator(bit_generator).random((size, self.num_words))
+
+        u1 = uniforms[:, 0:self.num_uniforms:2]
+        u2 = uniforms[:, 1:self.num_uniforms:2]
+        radius = np.sqrt(-2 * np.log1p(-u1))
+        angle = 2 * np.pi * u2
+        normals = np.concatenate([radius * np.cos(angle), radius * np.sin(angle)], axis=1)
+        return (normals[:, :self.num_pixels] * self.sigma).reshape((size,) + self.shape)
+
+    def get_noisy_arrays(self, start, size=1):
+        """Return array of shape (size, ny, nx) with the image plus the noise realizations of
+        indices start, ..., start + size - 1.
+        """
+        return self.image.array + self.get_noise(start, size)
+
+    def get_noisy_image(self, index):
+        """Return a :class:`galsim.Image` with the noise realization of the given index."""
+        noisy_image = self.image.copy()
+        noisy_image.array[:] = self.get_noisy_arrays(index)[0]
+        return noisy_image
 
 
 def add_noise(image, snr, noise_seed=0):
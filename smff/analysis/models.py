@@ -7,12 +7,14 @@ import sys
 
 import galsim
 
+from . import registry
+
 # referencing itself.
 curr_module = sys.modules[__name__]
 
 
 def get_extra():
-    return ['id', 'galaxy_model', 'psf_model']
+    return registry.get_extra()
 
 
 # make sure names of model class is the same name as the one to generate.
@@ -75,21 +77,8 @@ class Model(object):
 
 
 class Gaussian(Model):
-    parameters = [
-        'flux',
-
-        'x0', 'y0',
-
-        'hlr',
-        'fwhm',
-        'sigma',
-
-        'e1', 'e2',
-        'eta1', 'eta2',
-        'e', 'q', 'beta',
-        'g1', 'g2'
-    ]
-    omit_general = []
+    parameters = registry.GALAXY_MODELS['gaussian']
+    omit_general = registry.OMIT_GENERAL['gaussian']
 
     def __init__(self, params=None, params_omit=None):
         Model.__init__(self, params, params_omit)
@@ -109,21 +98,8 @@ class Gaussian(Model):
 
 
 class Exponential(Model):
-    parameters = [
-        'x0', 'y0',
-
-        'flux',
-
-        'hlr',
-        'fwhm',
-        'sigma',
-
-        'e1', 'e2',
-        'g1', 'g2',
-        'eta1', 'eta2',
-        'q', 'beta'
-    ]
-    omit_general = []
+    parameters = registry.GALAXY_MODELS['exponential']
+    omit_general = registry.OMIT_GENERAL['exponential']
 
     def __init__(self, params=None, params_omit=None):
         Model.__init__(self, params, params_omit)
@@ -141,22 +117,9 @@ class Exponential(Model):
 
 
 class BulgeDisk(Model):
-    parameters = [
-        'x0', 'y0',
-
-        'flux_b', 'flux_d', 'flux_b/flux_total',
-
-        'hlr_d', 'hlr_b', 'R_r',
+    parameters = registry.GALAXY_MODELS['bulgedisk']
 
-        'e1', 'e2',
-        'eta1', 'eta2',
-
-        'delta_e', 'delta_theta',
-
-        'n_d', 'n_b'
-    ]
-
-    omit_general = ['delta_e', 'delta_theta', 'n_d', 'n_b']
+    omit_general = registry.OMIT_GENERAL['bulgedisk']
 
     def __init__(self, params=None, params_omit=None):
         Model.__init__(self, params, params_omit)
@@ -197,20 +160,9 @@ class BulgeDisk(Model):
 
 
 class BulgeDisk6(Model):
-    parameters = [
-        'x0', 'y0',
-
-        'flux',
-
-        'hlr',
+    parameters = registry.GALAXY_MODELS['bulgedisk6']
 
-        'e1', 'e2',
-        'eta1', 'eta2',
-
-        'n_d', 'n_b'
-    ]
-
-    omit_general = ['n_d', 'n_b']
+    omit_general = registry.OMIT_GENERAL['bulgedisk6']
 
     def __init__(self, params=None, params_omit=None):
         Model.__init__(self, params, params_omit)
@@ -253,13 +205,7 @@ class PsfModel(object):
 
 
 class GaussianPsf(PsfModel):
-    parameters = [
-        'psf_flux',
-
-        'psf_fwhm',
-
-        'psf_e1', 'psf_e2'
-    ]
+    parameters = registry.PSF_MODELS['gaussianpsf']
 
     def __init__(self, params=None):
         PsfModel.__init__(self, params)
@@ -282,16 +228,7 @@ class GaussianPsf(PsfModel):
 
 
 class MoffatPsf(PsfModel):
-    parameters = [
-        'psf_flux',
-
-        'psf_fwhm',
-        'psf_hlr',
-
-        'psf_beta',
-
-        'psf_e1', 'psf_e2'
-    ]
+    parameters = registry.PSF_MODELS['moffatpsf']
 
     def __init__(self, params=None):
         PsfModel.__init__(self, params)
@@ -308,42 +245,19 @@ class MoffatPsf(PsfModel):
 
 
 def get_gal_parameters():
-    """
-    Iterate over all subclasses to get fieldnames. Instantiate each subclass and get self.parameters
-    from each and add to fieldnames.
-    Returns:
-
-    """
-    gal_parameters = []
-    classes = [obj for name, obj in inspect.getmembers(sys.modules[__name__]) if inspect.isclass(obj)]
-    for cls in classes:
-        if 'Psf' not in cls.__name__:
-            gal_parameters += cls.parameters
-
-    # remove duplicates
-    gal_parameters = list(set(gal_parameters))
-
-    return gal_parameters
+    return registry.get_gal_parameters()
 
 
 def get_psf_parameters():
-    psf_parameters = []
-    classes = [obj for name, obj in inspect.getmembers(sys.modules[__name__]) if inspect.isclass(obj)]
-    for cls in classes:
-        if 'Psf' in cls.__name__ and cls.__name__ != 'PsfModel':
-            psf_parameters += cls.parameters
-
-    psf_parameters = list(set(psf_parameters))
-
-    return psf_parameters
+    return registry.get_psf_parameters()
 
 
 def get_all_parameters():
-    return get_gal_parameters() + get_psf_parameters()
+    return registry.get_all_parameters()
 
 
 def get_fieldnames():
-    return get_extra() + get_gal_parameters() + get_psf_parameters()
+    return registry.get_fieldnames()
 
 
 def get_model_cls(model):
@@ -357,20 +271,9 @@ def get_model_cls(model):
 
 def get_all_models():
     """Used to display choices in generate.py"""
-    classes = [obj for name, obj in inspect.getmembers(sys.modules[__name__]) if inspect.isclass(obj)]
-    gal_models = []
-    for cls in classes:
-        if 'Psf' not in cls.__name__ and 'Model' != cls.__name__:
-            gal_models.append(cls.__name__.lower())
-    return gal_models
+    return registry.get_all_models()
 
 
 def get_all_psf_models():
     """Used to display choices in generate.py"""
-    classes = [obj for name, obj in inspect.getmembers(sys.modules[__name__]) if inspect.isclass(obj)]
-    psf_models = []
-    for cls in classes:
-        if 'Psf' in cls.__name__ and cls.__name__ != 'PsfModel':
-            psf_models.append(cls.__name__.lower())
-
-    return psf_models
+    return registry.get_all_psf_models()
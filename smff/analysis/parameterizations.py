@@ -0,0 +1,170 @@
+"""Conversions between equivalent parameterizations of the galaxies, used by
+:meth:`analysis.fisher.Fisher.reparameterize`.
+
+The ellipticity of a galaxy can be given by its reduced shear (g1, g2), its distortion (e1, e2),
+its conformal shear (eta1, eta2) or its axis ratio and position angle (q, beta), see
+:meth:`analysis.models.Model.shear`. All of them are converted through the polar form
+(eta, beta) of the conformal shear: |g| = tanh(eta / 2), |e| = tanh(eta), q = exp(-eta) and the
+components are |x| (cos 2 beta, sin 2 beta). The size of gaussian galaxies can be given by their
+half light radius or by sigma, with hlr = sqrt(2 ln 2) sigma.
+"""
+import math
+
+import numpy as np
+
+# names of the parameters of each parameterization, in order.
+FAMILIES = {
+    'g': ['g1', 'g2'],
+    'e': ['e1', 'e2'],
+    'eta': ['eta1', 'eta2'],
+    'qbeta': ['q', 'beta'],
+    'hlr': ['hlr'],
+    'sigma': ['sigma'],
+}
+
+SHEAR_FAMILIES = ['g', 'e', 'eta', 'qbeta']
+SIZE_FAMILIES = ['hlr', 'sigma']
+
+HLR_PER_SIGMA = math.sqrt(2 * math.log(2))
+
+# the conversions between (g1, g2), (e1, e2) and (eta1, eta2) of galaxies rounder than this use the
+# expansion of the magnitudes below, the polar form is ill conditioned there.
+ROUND = 1e-3
+
+# coefficients (c1, c3) of the expansion c1 eta + c3 eta^3 of the magnitude of each family.
+EXPANSIONS = {
+    'g': (.5, -1. / 24),
+    'e': (1., -1. / 3),
+    'eta': (1., 0.),
+}
+
+
+def _get_magnitude(family, eta):
+    """Return the magnitude of the components of family for the conformal shear eta, and its first
+    and second derivatives with respect to eta."""
+    if family == 'g':
+        magnitude = math.tanh(eta / 2)
+        return magnitude, (1 - magnitude ** 2) / 2, -magnitude * (1 - magnitude ** 2) / 2
+    if family == 'e':
+        magnitude = math.tanh(eta)
+        return magnitude, 1 - magnitude ** 2, -2 * magnitude * (1 - magnitude ** 2)
+    return eta, 1., 0.
+
+
+def _to_polar(family, values):
+    x1, x2 = values
+    if family == 'qbeta':
+        return -math.log(x1), x2
+
+    magnitude = math.hypot(x1, x2)
+    beta = .5 * math.atan2(x2, x1)
+    if family == 'g':
+        return 2 * math.atanh(magnitude), beta
+    if family == 'e':
+        return math.atanh(magnitude), beta
+    return magnitude, beta
+
+
+def _from_polar(family, eta, beta):
+    if family == 'qbeta':
+        return [math.exp(-eta), beta]
+
+    if family == 'g':
+        magnitude = math.tanh(eta / 2)
+    elif family == 'e':
+        magnitude = math.tanh(eta)
+    else:
+        magnitude = eta
+    return [magnitude * math.cos(2 * beta), magnitude * math.sin(2 * beta)]
+
+
+def convert(old, new, values):
+    """Return list with the values of the parameters of family new equivalent to values (list)
+    of the parameters of family old, both keys of :data:`FAMILIES`."""
+    if old == new:
+        return list(values)
+
+    if old in SHEAR_FAMILIES and new in SHEAR_FAMILIES:
+        return _from_polar(new, *_to_polar(old, values))
+
+    if old in SIZE_FAMILIES and new in SIZE_FAMILIES:
+        factor = HLR_PER_SIGMA if old == 'sigma' else 1. / HLR_PER_SIGMA
+        return [values[0] * factor]
+
+    raise ValueError(f'Can not convert the parameters {FAMILIES[old]} into {FAMILIES[new]}.')
+
+
+def _get_polar_derivatives(family, eta, beta):
+    """Return the jacobian (2, 2) and hessian (2, 2, 2) of the parameters of a shear family with
+    respect to the polar form (eta, beta)."""
+    if family == 'qbeta':
+        q = math.exp(-eta)
+        return np.array([[-q, 0.], [0., 1.]]), np.array([[[q, 0.], [0., 0.]], [[0., 0.], [0., 0.]]])
+
+    magnitude, first, second = _get_magnitude(family, eta)
+    cos, sin = math.cos(2 * beta), math.sin(2 * beta)
+    jacobian = np.array([[first * cos, -2 * magnitude * sin],
+                         [first * sin, 2 * magnitude * cos]])
+    hessian = np.array([[[second * cos, -2 * first * sin], [-2 * first * sin, -4 * magnitude * cos]],
+                        [[second * sin, 2 * first * cos], [2 * first * cos, -4 * magnitude * sin]]])
+    return jacobian, hessian
+
+
+def _get_round_jacobian_hessian(old, new, new_values):
+    """Jacobian and hessian of the conversion between two of the families with components (g, e
+    and eta) of a galaxy rounder than :data:`ROUND`.
+
+    The conversion is old = R(r) new, with r = |new|. Expanding the magnitudes to third order
+    (see :data:`EXPANSIONS`) gives R = a0 + a2 r^2 up to terms of order r^4.
+    """
+    c1, c3 = EXPANSIONS[old]
+    b1, b3 = EXPANSIONS[new]
+    a0 = c1 / b1
+    a2 = c3 / b1 ** 3 - c1 * b3 / b1 ** 4
+
+    x = new_values
+    eye = np.eye(2)
+    jacobian = (a0 + a2 * x @ x) * eye + 2 * a2 * np.outer(x, x)
+    hessian = 2 * a2 * (np.einsum('ia,b->iab', eye, x) + np.einsum('ib,a->iab', eye, x) +
+                        np.einsum('ab,i->iab', eye, x))
+    return jacobian, hessian
+
+
+def get_jacobian_hessian(old, new, new_values):
+    """Return the jacobian J[i, a] = d old_i / d new_a and hessian H[i, a, b] = d^2 old_i / d new_a
+    d new_b of the conversion from the parameters of family new (with values new_values) back
+    to those of family old.
+
+    Both are exact: the conversions between shear families go through the polar form (eta, beta)
+    with the chain rule, the derivatives of the polar form with respect to the parameters of
+    new being those of the inverse of the (explicit) conversion from the polar form to new. The
+    conversion to (q, beta) is singular for a round galaxy, where beta is not defined.
+    """
+    new_values = np.asarray(new_values, dtype=float)
+    n = new_values.size
+    if old == new:
+        return np.eye(n), np.zeros((n, n, n))
+
+    if old in SIZE_FAMILIES and new in SIZE_FAMILIES:
+        return np.array([convert(new, old, [1.])]), np.zeros((1, 1, 1))
+
+    if old not in SHEAR_FAMILIES or new not in SHEAR_FAMILIES:
+        raise ValueError(f'Can not convert the parameters {FAMILIES[new]} into {FAMILIES[old]}.')
+
+    if 'qbeta' not in (old, new) and math.hypot(*new_values) < ROUND:
+        return _get_round_jacobian_hessian(old, new, new_values)
+
+    eta, beta = _to_polar(new, new_values)
+    if eta == 0:
+        raise ValueError('The position angle beta is not defined for a round galaxy.')
+    new_jacobian, new_hessian = _get_polar_derivatives(new, eta, beta)
+    old_jacobian, old_hessian = _get_polar_derivatives(old, eta, beta)
+
+    # derivatives of (eta, beta) with respect to the parameters of new.
+    polar_jacobian = np.linalg.inv(new_jacobian)
+    polar_hessian = -np.einsum('pi,iqr,qa,rb->pab', polar_jacobian, new_hessian, polar_jacobian, polar_jacobian)
+
+    jacobian = old_jacobian @ polar_jacobian
+    hessian = (np.einsum('ipq,pa,qb->iab', old_hessian, polar_jacobian, polar_jacobian) +
+               np.einsum('ip,pab->iab', old_jacobian, polar_hessian))
+    return jacobian, hessian
@@ -2,14 +2,172 @@
 generated galaxies to extracting information from relevant files.
 """
 import csv
+import io
+import json
 import math
+import os
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
 import numpy as np
 
 from .. import defaults
 
+# fit results can be read from a results directory or from an archive of it with these suffixes.
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+# the rows parsed from an archive are cached next to it in a file with this suffix.
+INDEX_SUFFIX = '.index.json'
+
+# archives with fewer members than this are parsed without starting processes.
+MIN_PARALLEL_MEMBERS = 500
+
+
+def is_archive(path):
+    """Return whether path is a zip or tar archive (judging by its suffix)."""
+    return str(path).endswith(ARCHIVE_SUFFIXES)
+
+
+def _parse_rows(text):
+    """Return the header and the rows (lists of strings) of the text of a result file."""
+    reader = csv.reader(io.StringIO(text))
+    fieldnames = next(reader, [])
+    return {'fieldnames': fieldnames, 'rows': [row for row in reader if row]}
+
+
+def _is_result_member(name):
+    return name.endswith('.csv') and not os.path.basename(name).startswith('.')
+
+
+def _read_zip_members(args):
+    """Return dictionary with the parsed contents of the members names of a zip archive."""
+    archive, names = args
+    with zipfile.ZipFile(archive) as zf:
+        return {name: _parse_rows(zf.read(name).decode()) for name in names}
+
+
+def _load_index(archive):
+    index_file = Path(str(archive) + INDEX_SUFFIX)
+    if not index_file.exists():
+        return {}
+    try:
+        with open(index_file, 'r') as f:
+            return json.load(f)['members']
+    except (ValueError, KeyError):
+        return {}
+
+
+def _save_index(archive, members):
+    """Write the index of the archive atomically, so concurrent readers never see a partial one."""
+    index_file = Path(str(archive) + INDEX_SUFFIX)
+    try:
+        with defaults.atomic_file(index_file) as f:
+            json.dump({'archive': os.path.basename(archive), 'members': members}, f)
+    except OSError:
+        pass  # the index only saves time, e.g. the directory of the archive might be read-only.
+
+
+def read_archive_rows(archive, processes=None, use_index=True):
+    """Return list with the rows of the fit result files inside a zip or tar archive, without
+    extracting it.
+
+    The members of zip archives are parsed in parallel. Tar archives (possibly compressed) can
+    only be read sequentially, so they are streamed once in this process. The parsed members are
+    cached in an index next to the archive (see :data:`INDEX_SUFFIX`), keyed by their size and crc
+    (zip) or mtime (tar), so reading it again only parses members that were added or changed.
+
+    Args:
+        archive(str): Path of the archive.
+        processes(int): Number of processes parsing zip members, by default the number of cpus.
+        use_index(bool): Whether to use and update the cached index.
+    """
+    archive = str(archive)
+    index = _load_index(archive) if use_index else {}
+    members = {}
+
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            infos = [info for info in zf.infolist() if not info.is_dir() and _is_result_member(info.filename)]
+        signatures = {info.filename: [info.file_size, info.CRC] for info in infos}
+        names = list(signatures)
+        todo = [name for name in names if index.get(name, {}).get('signature') != signatures[name]]
+
+        if processes == 1 or len(todo) < MIN_PARALLEL_MEMBERS:
+            parsed = _read_zip_members((archive, todo))
+        else:
+            processes = processes or os.cpu_count()
+            chunk_size = math.ceil(len(todo) / (4 * processes))
+            tasks = [(archive, todo[start:start + chunk_size]) for start in range(0, len(todo), chunk_size)]
+            parsed = {}
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                for chunk in executor.map(_read_zip_members, tasks):
+                    parsed.update(chunk)
+
+        for name in names:
+            members[name] = index[name] if name not in parsed else dict(parsed[name], signature=signatures[name])
+
+    elif tarfile.is_tarfile(archive):
+        with tarfile.open(archive, 'r|*') as tf:
+            for info in tf:
+                if not info.isfile() or not _is_result_member(info.name):
+                    continue
+                signature = [info.size, info.mtime]
+                if index.get(info.name, {}).get('signature') == signature:
+                    members[info.name] = index[info.name]
+                else:
+                    members[info.name] = dict(_parse_rows(tf.extractfile(info).read().decode()),
+                                              signature=signature)
+
+    else:
+        raise ValueError(f'{archive} is not a zip or tar archive.')
+
+    if use_index and members != index:
+        _save_index(archive, members)
+
+    rows = []
+    for member in members.values():
+        fieldnames = member['fieldnames']
+        rows.extend(dict(zip(fieldnames, row)) for row in member['rows'])
+    return rows
+
+
+def read_result_rows(results_dir, processes=None, use_index=True):
+    """Return list with the rows (dictionaries of strings) of all the fit result files in
+    results_dir, which can also be a zip or tar archive of the result files (see
+    :func:`read_archive_rows`, processes and use_index only apply to archives)."""
+    if is_archive(results_dir):
+        return read_archive_rows(results_dir, processes=processes, use_index=use_index)
+
+    rows = []
+    for fit_file in Path(results_dir).iterdir():
+        with open(fit_file) as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                rows.append(row)
+    return rows
+
+
+def read_results(project_path, g_parameters, fish=None, results=None):
+    """Return the pulls, residuals, biases, pull means, residual widths, bounds of the pulls and
+    reduced chi2 of the fits of the project.
+
+    Args:
+        fish(:class:`analysis.fisher.Fisher`): Fisher analysis of the galaxies (or
+            :class:`analysis.store.FisherInfo`), by default the one in the fisher info file of the
+            project written by generate.py, if it matches the galaxies.
+        results(str): Directory or zip/tar archive with the fit results, by default the results
+            directory of the project.
+    """
+    if fish is None:
+        from . import store
+
+        fish = store.load_fisher_info(project_path, g_parameters)
+        if fish is None:
+            raise ValueError(f'{project_path} has no fisher info file for its galaxies, generate it with '
+                             'generate.py --snr or pass the fisher analysis.')
 
-def read_results(project_path, g_parameters, fish):
     orig_image = fish.image
     mins = defaults.get_minimums(g_parameters, orig_image)
     maxs = defaults.get_maximums(g_parameters, orig_image)
@@ -17,27 +175,24 @@ def read_results(project_path, g_parameters, fish):
     residuals = {}
     pulls = {}
     redchis = []  # list containing values of reduced chi2 for each fit.
-    results_dir = project_path.joinpath(defaults.RESULTS_DIR)
+    results_dir = project_path.joinpath(defaults.RESULTS_DIR) if results is None else results
 
     # read results from results_dir's files.
-    for fit_file in results_dir.iterdir():
-        with open(fit_file) as csvfile:
-            reader = csv.DictReader(csvfile)
-            for i, row in enumerate(reader):
-                redchis.append(float(row['redchi']))
-                for param in g_parameters.fit_params:
-                    if param not in residuals:
-                        residuals[param] = []
-                    if param not in pulls:
-                        pulls[param] = []
-                    residual = (float(row[param]) -
-                                float(g_parameters.params[param]))
-
-                    pull = (residual /
-                            math.sqrt(fish.covariance_matrix[param, param]))
-
-                    residuals[param].append(residual)
-                    pulls[param].append(pull)
+    for row in read_result_rows(results_dir):
+        redchis.append(float(row['redchi']))
+        for param in g_parameters.fit_params:
+            if param not in residuals:
+                residuals[param] = []
+            if param not in pulls:
+                pulls[param] = []
+            residual = (float(row[param]) -
+                        float(g_parameters.params[param]))
+
+            pull = (residual /
+                    math.sqrt(fish.covariance_matrix[param, param]))
+
+            residuals[param].append(residual)
+            pulls[param].append(pull)
 
     biases = {param: np.mean(residuals[param]) for param in residuals}
     pull_means = {param: np.mean(pulls[param]) for param in residuals}
@@ -50,3 +205,87 @@ def read_results(project_path, g_parameters, fish):
                  param in residuals}
 
     return pulls, residuals, biases, pull_means, res_stds, pull_mins, pull_maxs, redchis
+
+
+def _get_statistics(first_moments, second_moments, num_params, fish):
+    """Return dictionary of the statistics of the fits (of shape (..., num_params)) given the first and
+    second moments of the residuals and pulls stacked along the last axis."""
+    stds = np.sqrt(np.maximum(second_moments - first_moments ** 2, 0.))
+    statistics = {
+        'biases': first_moments[..., :num_params],
+        'pull_means': first_moments[..., num_params:],
+        'res_stds': stds[..., :num_params],
+        'pull_stds': stds[..., num_params:],
+    }
+    if fish is not None:
+        params = fish.param_names
+        fisher_sigmas = np.sqrt(np.array([fish.covariance_matrix[param, param] for param in params]))
+        fisher_biases = np.array([fish.biases[param] for param in params])
+        statistics['res_std_ratios'] = statistics['res_stds'] / fisher_sigmas
+        # the fisher biases can be close to zero, so their difference is compared with the errors.
+        statistics['bias_differences'] = (statistics['biases'] - fisher_biases) / fisher_sigmas
+    return statistics
+
+
+def _stack_results(residuals, pulls, fish):
+    params = fish.param_names if fish is not None else list(residuals)
+    x = np.array([residuals[param] for param in params] + [pulls[param] for param in params], dtype=float)
+    return params, x
+
+
+def get_bootstrap_errors(residuals, pulls, fish=None, num_bootstrap=1000, seed=0, chunk_size=100):
+    """Return bootstrap errors of the statistics of the fits returned by :func:`read_results`.
+
+    Each bootstrap sample is represented by the number of times each fit is drawn, so the
+    statistics of a chunk of samples are a couple of matrix products with the residuals and pulls
+    instead of a python loop per sample.
+
+    Args:
+        residuals(dict): Residuals of each parameter, as returned by :func:`read_results`.
+        pulls(dict): Pulls of each parameter, as returned by :func:`read_results`.
+        fish(:class:`analysis.fisher.Fisher`): optional, to also get errors of the ratios of the
+            residual widths to the fisher errors and of the differences of the biases with the
+            fisher biases, in units of the fisher errors.
+        num_bootstrap(int): Number of bootstrap samples.
+        seed(int): Seed of the generator used to draw the samples.
+        chunk_size(int): Number of samples drawn at the same time.
+
+    Returns:
+        A dictionary mapping the name of each statistic ('biases', 'pull_means', 'res_stds',
+        'pull_stds' and with fish also 'res_std_ratios', 'bias_differences') to a dictionary with
+        the error of that statistic for each parameter.
+    """
+    params, x = _stack_results(residuals, pulls, fish)
+    num_fits = x.shape[1]
+    rng = np.random.default_rng(seed)
+    probabilities = np.full(num_fits, 1. / num_fits)
+
+    samples = {}
+    for start in range(0, num_bootstrap, chunk_size):
+        size = min(chunk_size, num_bootstrap - start)
+        counts = rng.multinomial(num_fits, probabilities, size=size).astype(float)
+        statistics = _get_statistics(counts @ x.T / num_fits, counts @ (x ** 2).T / num_fits, len(params), fish)
+        for name, values in statistics.items():
+            samples.setdefault(name, []).append(values)
+
+    return {name: dict(zip(params, np.std(np.concatenate(values), axis=0, ddof=1)))
+            for name, values in samples.items()}
+
+
+def get_jackknife_errors(residuals, pulls, fish=None):
+    """Return the jackknife (delete-one) errors of the statistics of the fits returned by
+    :func:`read_results`, in the same format as :func:`get_bootstrap_errors`.
+
+    The statistics without each fit are obtained at once from the sums over all the fits.
+    """
+    params, x = _stack_results(residuals, pulls, fish)
+    num_fits = x.shape[1]
+    first_moments = (x.sum(axis=1) - x.T) / (num_fits - 1)
+    second_moments = ((x ** 2).sum(axis=1) - (x ** 2).T) / (num_fits - 1)
+    statistics = _get_statistics(first_moments, second_moments, len(params), fish)
+
+    errors = {}
+    for name, values in statistics.items():
+        deviations = values - values.mean(axis=0)
+        errors[name] = dict(zip(params, np.sqrt((num_fits - 1) / num_fits * np.sum(deviations ** 2, axis=0))))
+    return errors
@@ -0,0 +1,153 @@
+"""Static table of the galaxy and psf models implemented in :mod:`analysis.models` and of their
+parameters.
+
+It is kept apart from :mod:`analysis.models` (which imports galsim) so that the command line
+scripts can list the models and parameters quickly. The classes in :mod:`analysis.models` take
+their parameters from here, so a new model has to be added to this table (and the parameters it
+needs to REQUIRED) as well.
+"""
+
+EXTRA = ['id', 'galaxy_model', 'psf_model']
+
+GALAXY_MODELS = {
+    'gaussian': [
+        'flux',
+
+        'x0', 'y0',
+
+        'hlr',
+        'fwhm',
+        'sigma',
+
+        'e1', 'e2',
+        'eta1', 'eta2',
+        'e', 'q', 'beta',
+        'g1', 'g2'
+    ],
+
+    'exponential': [
+        'x0', 'y0',
+
+        'flux',
+
+        'hlr',
+        'fwhm',
+        'sigma',
+
+        'e1', 'e2',
+        'g1', 'g2',
+        'eta1', 'eta2',
+        'q', 'beta'
+    ],
+
+    'bulgedisk': [
+        'x0', 'y0',
+
+        'flux_b', 'flux_d', 'flux_b/flux_total',
+
+        'hlr_d', 'hlr_b', 'R_r',
+
+        'e1', 'e2',
+        'eta1', 'eta2',
+
+        'delta_e', 'delta_theta',
+
+        'n_d', 'n_b'
+    ],
+
+    'bulgedisk6': [
+        'x0', 'y0',
+
+        'flux',
+
+        'hlr',
+
+        'e1', 'e2',
+        'eta1', 'eta2',
+
+        'n_d', 'n_b'
+    ],
+}
+
+# parameters never fit for all galaxies of a model.
+OMIT_GENERAL = {
+    'gaussian': [],
+    'exponential': [],
+    'bulgedisk': ['delta_e', 'delta_theta', 'n_d', 'n_b'],
+    'bulgedisk6': ['n_d', 'n_b'],
+}
+
+PSF_MODELS = {
+    'gaussianpsf': [
+        'psf_flux',
+
+        'psf_fwhm',
+
+        'psf_e1', 'psf_e2'
+    ],
+
+    'moffatpsf': [
+        'psf_flux',
+
+        'psf_fwhm',
+        'psf_hlr',
+
+        'psf_beta',
+
+        'psf_e1', 'psf_e2'
+    ],
+}
+
+# parameters each model needs to be drawn, as groups of alternatives (any one alternative
+# specified in full satisfies its group), following the get_profile methods in analysis.models.
+SHEAR = [('e1', 'e2'), ('g1', 'g2'), ('eta1', 'eta2'), ('q', 'beta'), ('e', 'beta')]
+
+REQUIRED = {
+    'gaussian': [[('flux',)], [('x0', 'y0')], [('hlr',), ('sigma',)], SHEAR],
+    'exponential': [[('flux',)], [('x0', 'y0')], [('hlr',)], SHEAR],
+    'bulgedisk': [[('flux_b', 'flux_d')], [('x0', 'y0')], [('hlr_b', 'hlr_d'), ('hlr_d', 'R_r')],
+                  [('n_b',)], [('n_d',)], SHEAR],
+    'bulgedisk6': [[('flux',)], [('x0', 'y0')], [('hlr',)], [('n_b',)], [('n_d',)], SHEAR],
+    'gaussianpsf': [[('psf_flux',)], [('psf_fwhm',)]],
+    'moffatpsf': [[('psf_flux',)], [('psf_beta',)], [('psf_fwhm',), ('psf_hlr',)]],
+}
+
+
+def _unique(names):
+    return list(dict.fromkeys(names))
+
+
+def get_extra():
+    return list(EXTRA)
+
+
+def get_gal_parameters():
+    return _unique(param for parameters in GALAXY_MODELS.values() for param in parameters)
+
+
+def get_psf_parameters():
+    return _unique(param for parameters in PSF_MODELS.values() for param in parameters)
+
+
+def get_all_parameters():
+    return get_gal_parameters() + get_psf_parameters()
+
+
+def get_fieldnames():
+    return get_extra() + get_gal_parameters() + get_psf_parameters()
+
+
+def get_all_models():
+    return sorted(GALAXY_MODELS)
+
+
+def get_all_psf_models():
+    return sorted(PSF_MODELS)
+
+
+def get_missing_parameters(model, params):
+    """Return list with the groups of parameters of model (galaxy or psf) that are not specified in
+    params, each one as a string with its alternatives (e.g. 'hlr or sigma')."""
+    return [' or '.join(', '.join(alternative) for alternative in group)
+            for group in REQUIRED[model]
+            if not any(all(param in params for param in alternative) for alternative in group)]
@@ -0,0 +1,155 @@
+"""Place the image stacks of a :class:`analysis.fisher.Fisher` object in memory that can be
+shared between processes.
+
+The stacks are copied once into POSIX shared memory (or a memory-mapped file) and the
+dictionaries of the fisher object are replaced by views into it. A fisher object in this state
+pickles only small handles to the stacks, so workers it is sent to attach to the same memory
+instead of receiving a copy. The memory is released when the fisher object that created it is.
+"""
+import itertools
+import os
+import tempfile
+import weakref
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# attribute of the fisher object and number of parameters that index each of its entries.
+STACKS = {
+    'derivatives_images': 1,
+    'second_derivatives_images': 2,
+    'fisher_matrix_images': 2,
+    'bias_matrix_images': 3,
+    'bias_images': 1,
+}
+
+
+class StackHandle(object):
+    """Picklable reference to an array in shared memory or in a memory-mapped file.
+
+    Args:
+        kind(str): Either 'shm' (POSIX shared memory) or 'mmap' (file).
+        name(str): Name of the shared memory block or path of the file.
+        shape(tuple): Shape of the array.
+        dtype(str): Data type of the array.
+    """
+
+    def __init__(self, kind, name, shape, dtype):
+        self.kind = kind
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    def attach(self):
+        """Return (array, resource) where array is a view of the shared array and resource is
+        the object that has to be kept alive while the array is used (None for files)."""
+        if self.kind == 'mmap':
+            return np.load(self.name, mmap_mode='r'), None
+
+        shm = _attach_shared_memory(self.name)
+        array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+        array.flags.writeable = False
+        return array, shm
+
+
+def _attach_shared_memory(name):
+    """Attach to an existing block without letting the resource tracker of this process remove
+    it when the process ends; only the owner unlinks it."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # python < 3.13, skip the registration that track=False avoids.
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _release(resources, owner):
+    for resource in resources:
+        if isinstance(resource, str):
+            if owner and os.path.exists(resource):
+                os.remove(resource)
+            continue
+        try:
+            resource.close()
+        except BufferError:
+            pass  # a view is still in use, the mapping goes away with it.
+        if owner:
+            try:
+                resource.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def _stack(fish, attribute):
+    rank = STACKS[attribute]
+    images = getattr(fish, attribute)
+    keys = list(itertools.product(fish.param_names, repeat=rank))
+    first = images[keys[0][0] if rank == 1 else keys[0]]
+    shape = (fish.num_params,) * rank + np.shape(first)
+    stack = np.empty(shape, dtype=np.asarray(first).dtype)
+    for key, index in zip(keys, itertools.product(range(fish.num_params), repeat=rank)):
+        stack[index] = images[key[0] if rank == 1 else key]
+    return stack
+
+
+def _unstack(fish, attribute, stack):
+    rank = STACKS[attribute]
+    images = {}
+    for key, index in zip(itertools.product(fish.param_names, repeat=rank),
+                          itertools.product(range(fish.num_params), repeat=rank)):
+        images[key[0] if rank == 1 else key] = stack[index]
+    return images
+
+
+def share_stacks(fish, kind='shm', directory=None):
+    """Copy the image stacks of fish into shared memory and make fish use them.
+
+    Args:
+        fish(:class:`analysis.fisher.Fisher`): Fisher object that owns the shared memory.
+        kind(str): 'shm' to use POSIX shared memory, 'mmap' to use memory-mapped files.
+        directory(str): Directory of the files when kind is 'mmap', the system temporary
+            directory by default.
+
+    Returns:
+        A dict from the name of each stack to its :class:`StackHandle`.
+    """
+    if kind not in ('shm', 'mmap'):
+        raise ValueError('kind should be either \'shm\' or \'mmap\'.')
+
+    handles = {}
+    resources = []
+    for attribute in STACKS:
+        stack = _stack(fish, attribute)
+        if kind == 'shm':
+            shm = shared_memory.SharedMemory(create=True, size=max(stack.nbytes, 1))
+            shared = np.ndarray(stack.shape, dtype=stack.dtype, buffer=shm.buf)
+            shared[...] = stack
+            handles[attribute] = StackHandle(kind, shm.name, stack.shape, stack.dtype.str)
+            resources.append(shm)
+        else:
+            fd, filename = tempfile.mkstemp(dir=directory, suffix='.npy')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, stack)
+            shared = np.load(filename, mmap_mode='r')
+            handles[attribute] = StackHandle(kind, filename, stack.shape, stack.dtype.str)
+            resources.append(filename)
+        setattr(fish, attribute, _unstack(fish, attribute, shared))
+
+    weakref.finalize(fish, _release, resources, True)
+    return handles
+
+
+def attach_stacks(fish, handles):
+    """Replace the image stacks of fish with views of the shared stacks in handles. The
+    attachments are closed (but the memory not released) when fish is garbage collected."""
+    resources = []
+    for attribute, handle in handles.items():
+        stack, resource = handle.attach()
+        if resource is not None:
+            resources.append(resource)
+        setattr(fish, attribute, _unstack(fish, attribute, stack))
+    weakref.finalize(fish, _release, resources, False)
@@ -0,0 +1,317 @@
+"""Save and load the results of a :class:`analysis.fisher.Fisher` analysis so that they
+do not have to be recomputed (and the images re-rendered) every time a project is opened.
+
+Each result is saved in its own directory inside the project's fisher directory, named
+after a hash of everything the analysis depends on (the galaxies.csv file, the configuration
+of the image renderer, the step sizes and the noise level). The scalars and matrices are
+written to a small json header and the derivative image stacks to .npy files that are memory-mapped
+when loaded.
+
+A compact summary of the analysis of a project (covariance, biases, condition number and S/N ratio
+of each galaxy) can also be written to its info file (see :func:`get_fisher_info`), which steps
+that only need those numbers read instead of the full analysis.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from . import fisher
+from . import gparameters
+from . import images
+from .. import defaults
+
+HEADER_FILE = 'header.json'
+STACKS = ['derivatives_images', 'second_derivatives_images']
+
+
+def _to_builtin(value):
+    """Convert numpy scalars so that they can be written with json, arrays (e.g. variance maps)
+    are replaced by a hash of their contents."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return hashlib.sha1(np.ascontiguousarray(value, dtype=float).tobytes()).hexdigest()
+    return value
+
+
+def get_galaxies_hash(g_parameters):
+    """Return a hash of the galaxies described by g_parameters.
+
+    The contents of galaxies.csv are used when g_parameters was read from a project, otherwise
+    the id_params the object was created with.
+    """
+    sha = hashlib.sha1()
+    if g_parameters.project is not None:
+        with open(os.path.join(g_parameters.project, defaults.GALAXY_FILE), 'rb') as f:
+            sha.update(f.read())
+    else:
+        sha.update(json.dumps(g_parameters.id_params, sort_keys=True, default=_to_builtin).encode())
+    # the omitted parameters come from sets, sort them so the hash is the same in every process.
+    omit_fit = {gal_id: sorted(omit) for gal_id, omit in g_parameters.omit_fit.items()}
+    sha.update(json.dumps(omit_fit, sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+def get_key(g_parameters, image_renderer, snr, var_noise=None, steps=None):
+    """Return the key under which the fisher analysis with the given inputs is stored.
+
+    Args:
+        g_parameters(:class:`analysis.gparameters.GParameters`): Parameters of the galaxies.
+        image_renderer(:class:`analysis.images.ImageRenderer`): Object used to render the galaxies.
+        snr(float): S/N ratio used in the analysis.
+        var_noise(float or :class:`np.array`): Variance (or variance map) of the noise if given
+            explicitly to the fisher analysis.
+        steps(dict): Steps used for the derivatives, by default the ones in :func:`defaults.get_steps`.
+
+    Returns:
+        A str.
+    """
+    if steps is None:
+        steps = defaults.get_steps(g_parameters, image_renderer)
+
+    inputs = {
+        'galaxies': get_galaxies_hash(g_parameters),
+        'renderer': image_renderer.get_config(),
+        'steps': {param: _to_builtin(step) for param, step in steps.items()},
+        'snr': _to_builtin(snr),
+        'var_noise': _to_builtin(var_noise),
+    }
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def get_fisher_dir(project):
+    return Path(project).joinpath(defaults.FISHER_DIR)
+
+
+def save_fisher(fish, project, key):
+    """Write the results of fish into the fisher directory of project under key.
+
+    The directory is first written to a temporary location and then moved, so a result that
+    can be found is always complete. The key is a hash of the inputs, so a directory already
+    saved under it (e.g. by another process) has the same results and is kept, processes that
+    memory-mapped its stacks keep reading them (see :func:`defaults.atomic_directory`).
+
+    Returns:
+        The path (:class:`pathlib.Path`) of the directory with the saved results.
+    """
+    fisher_dir = get_fisher_dir(project)
+    fisher_dir.mkdir(exist_ok=True)
+    result_dir = fisher_dir.joinpath(key)
+    if result_dir.joinpath(HEADER_FILE).exists():
+        return result_dir
+
+    names = fish.param_names
+    header = {
+        'key': key,
+        'param_names': names,
+        'snr': _to_builtin(fish.snr),
+        'snrs': [_to_builtin(snr) for snr in getattr(fish, 'snrs', [])],
+        'var_noise': None if np.ndim(fish.var_noise) else _to_builtin(fish.var_noise),
+        'steps': {param: _to_builtin(fish.steps[param]) for param in names},
+        'fisher_matrix': fish.matrix_to_numpy_array(fish.fisher_matrix).tolist(),
+        'covariance_matrix': fish.matrix_to_numpy_array(fish.covariance_matrix).tolist(),
+        'correlation_matrix': fish.matrix_to_numpy_array(fish.correlation_matrix).tolist(),
+        'bias_matrix': [[[_to_builtin(fish.bias_matrix[i, j, k]) for k in names] for j in names]
+                        for i in names],
+        'biases': [_to_builtin(fish.biases[param]) for param in names],
+        'fisher_condition_number': _to_builtin(fish.fisher_condition_number),
+    }
+
+    with defaults.atomic_directory(result_dir) as temp_dir:
+        with open(temp_dir.joinpath(HEADER_FILE), 'w') as f:
+            json.dump(header, f)
+        np.save(temp_dir.joinpath('image.npy'), fish.image.array)
+        if np.ndim(fish.var_noise):
+            np.save(temp_dir.joinpath('var_noise.npy'), fish.var_noise)
+        np.save(temp_dir.joinpath('derivatives_images.npy'),
+                np.array([fish.derivatives_images[i] for i in names]))
+        np.save(temp_dir.joinpath('second_derivatives_images.npy'),
+                np.array([[fish.second_derivatives_images[i, j] for j in names] for i in names]))
+
+    return result_dir
+
+
+def load_fisher(project, g_parameters, image_renderer, key):
+    """Return a :class:`analysis.fisher.Fisher` object with the results stored in project under key.
+
+    No image is rendered, the derivative image stacks are memory-mapped from disk and the
+    matrices and biases are computed from them.
+
+    Returns:
+        A :class:`analysis.fisher.Fisher` or None if there are no results stored under key.
+    """
+    result_dir = get_fisher_dir(project).joinpath(key)
+    if not result_dir.joinpath(HEADER_FILE).exists():
+        return None
+
+    with open(result_dir.joinpath(HEADER_FILE), 'r') as f:
+        header = json.load(f)
+
+    stacks = {name: np.load(result_dir.joinpath(name + '.npy'), mmap_mode='r') for name in STACKS}
+    image = image_renderer.stamp.copy()
+    image.array[:] = np.load(result_dir.joinpath('image.npy'))
+    var_noise = header['var_noise']
+    if var_noise is None:
+        var_noise = np.load(result_dir.joinpath('var_noise.npy'))
+
+    return fisher.Fisher.from_stacks(g_parameters, image_renderer, header['snr'], stacks['derivatives_images'],
+                                     stacks['second_derivatives_images'], var_noise=var_noise, image=image,
+                                     snrs=header['snrs'] or None, steps=header['steps'])
+
+
+def get_fisher(g_parameters, image_renderer, snr, var_noise=None, project=None):
+    """Return the fisher analysis of the given inputs, loading it from project if it was saved
+    before and otherwise computing it and saving it.
+
+    Args:
+        g_parameters(:class:`analysis.gparameters.GParameters`): Parameters of the galaxies.
+        image_renderer(:class:`analysis.images.ImageRenderer`): Object used to render the galaxies.
+        snr(float): S/N ratio used in the analysis.
+        var_noise(float): Optional, variance of the noise passed on to :class:`analysis.fisher.Fisher`.
+        project(str): Directory where the results are stored, by default the project that
+            g_parameters was read from.
+
+    Returns:
+        A :class:`analysis.fisher.Fisher`
+    """
+    if project is None:
+        project = g_parameters.project
+    if project is None:
+        raise ValueError('Need a project directory to store the fisher analysis.')
+
+    key = get_key(g_parameters, image_renderer, snr, var_noise)
+    fish = load_fisher(project, g_parameters, image_renderer, key)
+    if fish is None:
+        fish = fisher.Fisher(g_parameters=g_parameters, image_renderer=image_renderer, snr=snr,
+                             var_noise=var_noise)
+        save_fisher(fish, project, key)
+    return fish
+
+
+class FisherInfo(object):
+    """Summary of a fisher analysis read from the info file of a project, with the attributes of
+    :class:`analysis.fisher.Fisher` that the summary contains.
+
+    Attributes:
+        key(str): Key of the inputs of the analysis, see :func:`get_key`.
+        param_names(list): Names of the fit parameters.
+        snr(float): S/N ratio used in the analysis.
+        snrs(list): S/N ratio of each galaxy.
+        var_noise(float): Variance of the noise, None if it was a map.
+        covariance_matrix(dict): Same as in :class:`analysis.fisher.Fisher`.
+        biases(dict): Same as in :class:`analysis.fisher.Fisher`.
+        fisher_condition_number(float): Same as in :class:`analysis.fisher.Fisher`.
+        image(:class:`galsim.Image`): Blank stamp of the analysis, its bounds set the bounds of the fits.
+    """
+
+    def __init__(self, header, image_renderer):
+        self.key = header['key']
+        self.param_names = header['param_names']
+        self.num_params = len(self.param_names)
+        self.snr = header['snr']
+        self.snrs = header['snrs']
+        self.var_noise = header['var_noise']
+        self.covariance_matrix = self.numpy_array_to_matrix(header['covariance_matrix'])
+        self.biases = dict(zip(self.param_names, header['biases']))
+        self.fisher_condition_number = header['fisher_condition_number']
+        self.image = image_renderer.stamp
+
+    def matrix_to_numpy_array(self, matrix):
+        """Convert matrix dictionary to a numpy array."""
+        return np.array([[matrix[param_i, param_j] for param_j in self.param_names]
+                         for param_i in self.param_names])
+
+    def numpy_array_to_matrix(self, array):
+        """Convert numpy array to matrix dictionary."""
+        return {(param_i, param_j): array[i][j]
+                for i, param_i in enumerate(self.param_names)
+                for j, param_j in enumerate(self.param_names)}
+
+
+def get_galaxies_snrs(fish):
+    """Return list with the S/N ratio of each galaxy of fish by itself."""
+    snrs = []
+    for params in fish.g_parameters.id_params.values():
+        image = fish.image_renderer.get_image(gparameters.get_galaxy_model(params))
+        snrs.append(_to_builtin(fisher.get_snr(image, fish.var_noise)))
+    return snrs
+
+
+def save_fisher_info(fish, project, key):
+    """Write the summary of fish (see :class:`FisherInfo`) to the info file of project, atomically."""
+    info_file = Path(project).joinpath(defaults.FISHER_INFO_FILE)
+    names = fish.param_names
+    header = {
+        'key': key,
+        'renderer': fish.image_renderer.get_config(),
+        'param_names': names,
+        'snr': _to_builtin(fish.snr),
+        'snrs': get_galaxies_snrs(fish),
+        'var_noise': None if np.ndim(fish.var_noise) else _to_builtin(fish.var_noise),
+        'covariance_matrix': fish.matrix_to_numpy_array(fish.covariance_matrix).tolist(),
+        'biases': [_to_builtin(fish.biases[param]) for param in names],
+        'fisher_condition_number': _to_builtin(fish.fisher_condition_number),
+    }
+
+    with defaults.atomic_file(info_file) as f:
+        json.dump(header, f, indent=2)
+
+    return info_file
+
+
+def load_fisher_info(project, g_parameters, image_renderer=None, snr=None, var_noise=None):
+    """Return the :class:`FisherInfo` in the info file of project if it was written for these
+    inputs (its key matches theirs), None otherwise.
+
+    Args:
+        image_renderer(:class:`analysis.images.ImageRenderer`): optional, renderer of the analysis,
+            by default one rebuilt from the configuration in the info file (which can not contain
+            a mask).
+        snr(float): optional, S/N ratio of the analysis, by default the one in the info file.
+    """
+    info_file = Path(project).joinpath(defaults.FISHER_INFO_FILE)
+    if not info_file.exists():
+        return None
+
+    with open(info_file, 'r') as f:
+        header = json.load(f)
+
+    if image_renderer is None:
+        config = header['renderer']
+        if config['mask'] is not None:
+            return None
+        xmin, xmax, ymin, ymax = config['bounds']
+        image_renderer = images.ImageRenderer(pixel_scale=config['pixel_scale'], nx=xmax - xmin + 1,
+                                              ny=ymax - ymin + 1, method=config['method'],
+                                              gsparams=config['gsparams'])
+    if snr is None:
+        snr = header['snr']
+
+    if header['key'] != get_key(g_parameters, image_renderer, snr, var_noise):
+        return None
+    return FisherInfo(header, image_renderer)
+
+
+def get_fisher_info(g_parameters, image_renderer, snr, var_noise=None, project=None):
+    """Return the :class:`FisherInfo` of the given inputs from the info file of project, or
+    compute the analysis (with :func:`get_fisher`, so it is stored as well) and write the info file.
+
+    Args:
+        project(str): Project of the info file, by default the project that g_parameters was
+            read from.
+    """
+    if project is None:
+        project = g_parameters.project
+    if project is None:
+        raise ValueError('Need a project directory to store the fisher info file.')
+
+    info = load_fisher_info(project, g_parameters, image_renderer, snr, var_noise)
+    if info is None:
+        fish = get_fisher(g_parameters, image_renderer, snr, var_noise=var_noise, project=project)
+        key = get_key(g_parameters, image_renderer, snr, var_noise)
+        save_fisher_info(fish, project, key)
+        info = load_fisher_info(project, g_parameters, image_renderer, snr, var_noise)
+    return info
@@ -0,0 +1,380 @@
+"""Smooth surrogates of the results of the fisher analysis along one or two sweep parameters.
+
+Plots of the biases, errors or correlations of the parameters against, e.g., the separation or
+the size of the galaxies need a :class:`analysis.fisher.Fisher` analysis per point. A surrogate
+interpolates those results with Chebyshev polynomials over a range of the sweep parameters so
+they can be evaluated anywhere without rendering anything.
+
+The range is covered by patches (intervals or rectangles), each interpolated on a grid of
+Chebyshev-Lobatto nodes. The number of nodes of a patch is doubled (the nodes are nested, so the
+analyses already done are reused) until the interpolant of the coarser grid predicts the results
+at the new nodes within the tolerance, and patches that still do not converge are split in two
+along the sweep parameter with the largest error. So the analyses concentrate where the results
+vary quickly. The error measured in the last refinement of each patch is kept as an estimate of
+the interpolation error.
+
+Surrogates are saved inside the project (see :func:`get_surrogate`), under a hash of the
+galaxies, renderer, S/N ratio, sweep ranges and tolerances they were built with.
+"""
+import hashlib
+import itertools
+import json
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from pathlib import Path
+
+import numpy as np
+
+from . import fisher
+from . import gparameters
+from . import store
+from .. import defaults
+
+HEADER_FILE = 'header.json'
+VALUES_FILE = 'values.npz'
+
+
+def get_output_names(param_names):
+    """Return the names of the results interpolated by a surrogate: 'bias:<param>' and
+    'sigma:<param>' for each parameter and 'correlation:<param_i>,<param_j>' for each pair."""
+    names = [f'bias:{param}' for param in param_names]
+    names += [f'sigma:{param}' for param in param_names]
+    names += [f'correlation:{param_i},{param_j}' for param_i, param_j in itertools.combinations(param_names, 2)]
+    return names
+
+
+def get_outputs(fish):
+    """Return array with the results of fish in the order of :func:`get_output_names`."""
+    names = fish.param_names
+    covariance = fish.matrix_to_numpy_array(fish.covariance_matrix)
+    correlation = fish.matrix_to_numpy_array(fish.correlation_matrix)
+    rows, columns = np.triu_indices(len(names), k=1)
+    return np.concatenate([[fish.biases[param] for param in names],
+                           np.sqrt(np.diag(covariance)),
+                           correlation[rows, columns]])
+
+
+def _analyze(args):
+    """Return the outputs of the fisher analysis with the sweep parameters set to point."""
+    id_params, sweep_names, point, image_renderer, snr = args
+    id_params = deepcopy(id_params)
+    for name, value in zip(sweep_names, point):
+        param, gal_id = name.rsplit('_', 1)
+        id_params[gal_id][param] = float(value)
+    fish = fisher.Fisher(gparameters.GParameters(id_params=id_params), image_renderer, snr)
+    return get_outputs(fish)
+
+
+def get_lobatto_nodes(num_nodes):
+    """Return the Chebyshev-Lobatto nodes in [-1, 1] (increasing) and their barycentric weights."""
+    j = np.arange(num_nodes)
+    nodes = -np.cos(np.pi * j / (num_nodes - 1))
+    weights = (-1.) ** j
+    weights[[0, -1]] *= .5
+    return nodes, weights
+
+
+def get_lagrange_matrix(num_nodes, points):
+    """Return array of shape (len(points), num_nodes) with the Lagrange basis of the Lobatto nodes
+    evaluated at points (in [-1, 1]), with the barycentric formula."""
+    nodes, weights = get_lobatto_nodes(num_nodes)
+    points = np.asarray(points, dtype=float)
+    diff = points[:, None] - nodes[None, :]
+    exact = diff == 0
+    diff[exact] = 1.
+    terms = weights / diff
+    matrix = terms / terms.sum(axis=1, keepdims=True)
+    hits = exact.any(axis=1)
+    matrix[hits] = exact[hits].astype(float)
+    return matrix
+
+
+class Patch(object):
+    """Tensor Chebyshev interpolant over a box of the sweep parameters.
+
+    Args:
+        lower(:class:`np.array`): Lower corner of the box.
+        upper(:class:`np.array`): Upper corner of the box.
+        values(:class:`np.array`): Outputs at the Lobatto nodes, shape (n,) * dimension + (outputs,).
+        errors(:class:`np.array`): Estimated interpolation error of each output.
+    """
+
+    def __init__(self, lower, upper, values, errors):
+        self.lower = np.asarray(lower, dtype=float)
+        self.upper = np.asarray(upper, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        self.errors = np.asarray(errors, dtype=float)
+        self.num_nodes = self.values.shape[0]
+
+    def to_unit(self, points):
+        return 2 * (points - self.lower) / (self.upper - self.lower) - 1
+
+    def contains(self, points):
+        return np.all((points >= self.lower) & (points <= self.upper), axis=-1)
+
+    def evaluate(self, points):
+        """Return array (len(points), outputs) with the interpolated outputs at points."""
+        unit = self.to_unit(points)
+        result = self.values
+        matrices = [get_lagrange_matrix(self.num_nodes, unit[:, axis]) for axis in range(unit.shape[1])]
+        if len(matrices) == 1:
+            return matrices[0] @ result
+        return np.einsum('pi,pj,ijm->pm', matrices[0], matrices[1], result)
+
+
+class Surrogate(object):
+    """Interpolant of the results of the fisher analysis over a range of the sweep parameters.
+
+    Built with :func:`build_surrogate`, or loaded with :func:`get_surrogate`.
+
+    Attributes:
+        sweep_names(list): Names of the sweep parameters (e.g. 'hlr_1', 'x0_2').
+        output_names(list): Names of the outputs, see :func:`get_output_names`.
+        patches(list): :class:`Patch` objects covering the range.
+        num_analyses(int): Number of fisher analyses the surrogate was built from.
+    """
+
+    def __init__(self, sweep_names, output_names, patches, num_analyses, rtol, atol):
+        self.sweep_names = sweep_names
+        self.output_names = output_names
+        self.patches = patches
+        self.num_analyses = num_analyses
+        self.rtol = rtol
+        self.atol = atol
+        self.position = {name: i for i, name in enumerate(output_names)}
+
+    def evaluate(self, *coordinates):
+        """Return dictionary from the name of each output to its interpolated values at the
+        points with the given coordinates (one array or float per sweep parameter)."""
+        coordinates = np.broadcast_arrays(*[np.asarray(c, dtype=float) for c in coordinates])
+        shape = coordinates[0].shape
+        points = np.stack([c.ravel() for c in coordinates], axis=-1)
+
+        result = np.full((len(points), len(self.output_names)), np.nan)
+        missing = np.ones(len(points), dtype=bool)
+        for patch in self.patches:
+            inside = missing & patch.contains(points)
+            if inside.any():
+                result[inside] = patch.evaluate(points[inside])
+                missing &= ~inside
+        if missing.any():
+            raise ValueError('Some points are outside the range of the surrogate.')
+
+        return {name: result[:, i].reshape(shape) for i, name in enumerate(self.output_names)}
+
+    def get(self, output_name, *coordinates):
+        """Return the interpolated values of one output at the given coordinates."""
+        return self.evaluate(*coordinates)[output_name]
+
+    def get_errors(self):
+        """Return dictionary with the estimated interpolation error of each output (largest over
+        the patches)."""
+        errors = np.max([patch.errors for patch in self.patches], axis=0)
+        return dict(zip(self.output_names, errors))
+
+    def report(self):
+        """Return dictionary with the number of analyses and patches, the tolerances, the
+        estimated error of each output and whether every output is within the tolerance."""
+        errors = self.get_errors()
+        scales = np.max([np.abs(patch.values).reshape(-1, len(self.output_names)).max(axis=0)
+                         for patch in self.patches], axis=0)
+        tolerances = np.maximum(self.rtol * scales, self.atol)
+        return {
+            'num_analyses': self.num_analyses,
+            'num_patches': len(self.patches),
+            'rtol': self.rtol,
+            'atol': self.atol,
+            'converged': bool(np.all(np.array(list(errors.values())) <= tolerances)),
+            'errors': {name: float(error) for name, error in errors.items()},
+        }
+
+
+def build_surrogate(g_parameters, image_renderer, snr, sweep, rtol=1e-3, atol=1e-8, initial_nodes=5,
+                    max_nodes=17, max_analyses=500, processes=None):
+    """Build a :class:`Surrogate` of the fisher analysis of the galaxies in g_parameters.
+
+    Args:
+        g_parameters(:class:`analysis.gparameters.GParameters`): Parameters of the galaxies, the
+            sweep parameters are replaced at each point.
+        image_renderer(:class:`analysis.images.ImageRenderer`): Object used to render the galaxies.
+        snr(float): S/N ratio of the analysis at every point.
+        sweep(dict): Range (lower, upper) of each of the (one or two) sweep parameters, given by
+            their names in :attr:`analysis.gparameters.GParameters.params`, e.g. {'x0_2': (.5, 3.)}.
+        rtol(float): Tolerance of the interpolation error relative to the largest absolute value
+            of each output in the patch.
+        atol(float): Absolute tolerance of the interpolation error, for outputs close to 0.
+        initial_nodes(int): Nodes per sweep parameter of a new patch (odd).
+        max_nodes(int): Largest number of nodes per sweep parameter before a patch is split.
+        max_analyses(int): Budget of fisher analyses, patches are accepted with their current
+            error once it is spent.
+        processes(int): Number of processes running the analyses, by default the number of cpus.
+
+    Returns:
+        A :class:`Surrogate`
+    """
+    sweep_names = list(sweep)
+    if len(sweep_names) not in (1, 2):
+        raise ValueError('Surrogates support one or two sweep parameters.')
+    for name in sweep_names:
+        if name not in g_parameters.params:
+            raise ValueError(f'{name} is not a parameter of the galaxies.')
+
+    output_names = get_output_names(g_parameters.ordered_fit_names)
+    dimension = len(sweep_names)
+    cache = {}
+
+    def analyze(points, executor):
+        new = [tuple(point) for point in np.round(points, 12) if tuple(point) not in cache]
+        new = list(dict.fromkeys(new))
+        tasks = [(g_parameters.id_params, sweep_names, point, image_renderer, snr) for point in new]
+        mapper = executor.map if executor is not None else map
+        for point, outputs in zip(new, mapper(_analyze, tasks)):
+            cache[point] = outputs
+        return np.array([cache[tuple(point)] for point in np.round(points, 12)])
+
+    def grid(lower, upper, num_nodes):
+        nodes, _ = get_lobatto_nodes(num_nodes)
+        axes = [lower[k] + (upper[k] - lower[k]) * (nodes + 1) / 2 for k in range(dimension)]
+        return np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, dimension)
+
+    def refine(executor):
+        patches = []
+        lower = np.array([sweep[name][0] for name in sweep_names], dtype=float)
+        upper = np.array([sweep[name][1] for name in sweep_names], dtype=float)
+        queue = [(lower, upper, initial_nodes)]
+
+        while queue:
+            lower, upper, num_nodes = queue.pop(0)
+            fine_nodes = 2 * num_nodes - 1
+            coarse = analyze(grid(lower, upper, num_nodes), executor)
+            fine = analyze(grid(lower, upper, fine_nodes), executor)
+            coarse_values = coarse.reshape((num_nodes,) * dimension + (-1,))
+            fine_values = fine.reshape((fine_nodes,) * dimension + (-1,))
+
+            patch = Patch(lower, upper, coarse_values, np.zeros(len(output_names)))
+            difference = np.abs(patch.evaluate(grid(lower, upper, fine_nodes)) - fine)
+            difference = difference.reshape(fine_values.shape)
+            errors = difference.reshape(-1, len(output_names)).max(axis=0)
+            tolerances = np.maximum(rtol * np.abs(fine).max(axis=0), atol)
+
+            if np.all(errors <= tolerances) or len(cache) >= max_analyses:
+                patches.append(Patch(lower, upper, fine_values, errors))
+
+            elif fine_nodes < max_nodes:
+                queue.append((lower, upper, fine_nodes))
+
+            else:
+                # split along the sweep parameter with the largest error at the nodes that are new
+                # only along it.
+                axis_errors = []
+                for axis in range(dimension):
+                    index = tuple(slice(1, None, 2) if k == axis else slice(None, None, 2)
+                                  for k in range(dimension))
+                    axis_errors.append(np.max(difference[index] / tolerances))
+                axis = int(np.argmax(axis_errors))
+                middle = (lower[axis] + upper[axis]) / 2
+                upper_left, lower_right = upper.copy(), lower.copy()
+                upper_left[axis] = middle
+                lower_right[axis] = middle
+                queue.append((lower, upper_left, initial_nodes))
+                queue.append((lower_right, upper, initial_nodes))
+
+        return patches
+
+    if processes == 1:
+        patches = refine(None)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            patches = refine(executor)
+
+    return Surrogate(sweep_names, output_names, patches, len(cache), rtol, atol)
+
+
+def get_key(g_parameters, image_renderer, snr, sweep, rtol, atol, initial_nodes, max_nodes, max_analyses):
+    """Return the key under which the surrogate with the given inputs is stored, including the
+    settings of the refinement (see :func:`build_surrogate`) that change the surrogate built."""
+    inputs = {
+        'galaxies': store.get_galaxies_hash(g_parameters),
+        'renderer': image_renderer.get_config(),
+        'snr': snr,
+        'sweep': {name: [float(bound) for bound in bounds] for name, bounds in sweep.items()},
+        'rtol': rtol,
+        'atol': atol,
+        'initial_nodes': initial_nodes,
+        'max_nodes': max_nodes,
+        'max_analyses': max_analyses,
+    }
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def save_surrogate(surrogate, project, key):
+    """Write surrogate into the surrogates directory of project under key, atomically.
+
+    The key is a hash of everything the surrogate depends on, so a surrogate already stored
+    under it (e.g. by another process) is kept as it is.
+    """
+    surrogate_dir = Path(project).joinpath(defaults.SURROGATE_DIR)
+    surrogate_dir.mkdir(exist_ok=True)
+    result_dir = surrogate_dir.joinpath(key)
+    if result_dir.joinpath(HEADER_FILE).exists():
+        return result_dir
+
+    header = {
+        'key': key,
+        'sweep_names': surrogate.sweep_names,
+        'output_names': surrogate.output_names,
+        'num_analyses': surrogate.num_analyses,
+        'rtol': surrogate.rtol,
+        'atol': surrogate.atol,
+        'patches': [{'lower': patch.lower.tolist(), 'upper': patch.upper.tolist(), 'errors': patch.errors.tolist()}
+                    for patch in surrogate.patches],
+    }
+
+    with defaults.atomic_directory(result_dir) as temp_dir:
+        with open(temp_dir.joinpath(HEADER_FILE), 'w') as f:
+            json.dump(header, f)
+        np.savez(temp_dir.joinpath(VALUES_FILE), *[patch.values for patch in surrogate.patches])
+
+    return result_dir
+
+
+def load_surrogate(project, key):
+    """Return the :class:`Surrogate` stored in project under key, None if there is none."""
+    result_dir = Path(project).joinpath(defaults.SURROGATE_DIR, key)
+    if not result_dir.joinpath(HEADER_FILE).exists():
+        return None
+
+    with open(result_dir.joinpath(HEADER_FILE), 'r') as f:
+        header = json.load(f)
+    with np.load(result_dir.joinpath(VALUES_FILE)) as values:
+        patches = [Patch(patch['lower'], patch['upper'], values[f'arr_{i}'], patch['errors'])
+                   for i, patch in enumerate(header['patches'])]
+
+    return Surrogate(header['sweep_names'], header['output_names'], patches, header['num_analyses'],
+                     header['rtol'], header['atol'])
+
+
+def get_surrogate(g_parameters, image_renderer, snr, sweep, rtol=1e-3, atol=1e-8, initial_nodes=5, max_nodes=17,
+                  max_analyses=500, processes=None, project=None):
+    """Return the surrogate stored in project for these inputs, or build it with
+    :func:`build_surrogate` (see there for the arguments) and store it.
+
+    Args:
+        project(str): Project where the surrogate is stored, by default the project g_parameters
+            was read from. If None (and g_parameters was not read from a project) nothing is stored.
+    """
+    if project is None:
+        project = g_parameters.project
+
+    key = get_key(g_parameters, image_renderer, snr, sweep, rtol, atol, initial_nodes, max_nodes, max_analyses)
+    if project is not None:
+        surrogate = load_surrogate(project, key)
+        if surrogate is not None:
+            return surrogate
+
+    surrogate = build_surrogate(g_parameters, image_renderer, snr, sweep, rtol=rtol, atol=atol,
+                                initial_nodes=initial_nodes, max_nodes=max_nodes, max_analyses=max_analyses,
+                                processes=processes)
+    if project is not None:
+        save_surrogate(surrogate, project, key)
+    return surrogate
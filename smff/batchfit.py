@@ -0,0 +1,249 @@
+"""Fit many noise realizations of a galaxy image at once.
+
+The image of the galaxies is expanded to second order around the true parameters using the
+derivative images of a :class:`analysis.fisher.Fisher` object,
+
+    model(theta0 + delta) = image + delta_i D_i + 1/2 delta_i delta_j D_ij,
+
+and the least squares problem of every realization is solved with Gauss-Newton steps on this
+model. The model, its Jacobian and the residuals only enter through projections on the
+derivative images, so after projecting each noise field once all realizations advance together
+with a handful of array operations per iteration and no images are rendered. Realizations that
+do not converge, hit a bound or move too far from the truth for the expansion to be trusted are
+fitted again with :func:`runfits.perform_fit` (lmfit).
+
+The chi2 of the fits solved on the quadratic model is the one of the model, not of a rendered
+image, so it is kept apart from the chi2 of the fits done by lmfit (see :class:`BatchFitResults`).
+"""
+import os
+
+import numpy as np
+
+from . import defaults
+from . import runfits
+from .analysis import fisher
+from .analysis import images
+
+
+class BatchFitResults(object):
+    """Results of :func:`perform_batch_fit`.
+
+    Attributes:
+        param_names(list): Names of the fitted parameters, the order of the columns of values.
+        noise_seeds(:class:`np.array`): Index of the noise realization of each fit.
+        values(:class:`np.array`): Array of shape (K, P) with the fitted values of each fit.
+        chi2(:class:`np.array`): Chi2 of the rendered model of the fits done by lmfit, nan for
+            the fits solved on the quadratic model.
+        model_chi2(:class:`np.array`): Chi2 of the quadratic model at the solution of the batch
+            solver of each fit (also of those that fell back).
+        nfev(:class:`np.array`): Number of function evaluations (rendered models) of lmfit, 0
+            for the fits solved on the quadratic model.
+        iterations(:class:`np.array`): Number of iterations of the batch solver of each fit.
+        success(:class:`np.array`): Whether each fit converged.
+        fallback(:class:`np.array`): Whether each fit was done by lmfit instead.
+        fallback_results(dict): From the index of each fit done by lmfit to its results.
+        seed(int): Seed of the noise engine of the fits.
+        ndata(int): Number of pixels of the image.
+    """
+
+    def __init__(self, param_names, noise_seeds, values, chi2, model_chi2, nfev, iterations, success, fallback,
+                 fallback_results, seed, ndata):
+        self.param_names = param_names
+        self.noise_seeds = noise_seeds
+        self.values = values
+        self.chi2 = chi2
+        self.model_chi2 = model_chi2
+        self.nfev = nfev
+        self.iterations = iterations
+        self.success = success
+        self.fallback = fallback
+        self.fallback_results = fallback_results
+        self.seed = seed
+        self.ndata = ndata
+
+    def get_values_dict(self, k):
+        """Return the fitted values of the k-th fit as a dictionary."""
+        return dict(zip(self.param_names, self.values[k]))
+
+
+def _get_gradient(delta, a, b, g1, g12, g22):
+    """Gradient (J . r) of the quadratic model for each realization, see module docstring."""
+    return (a + np.einsum('kj,kij->ki', delta, b)
+            - np.einsum('il,kl->ki', g1, delta)
+            - .5 * np.einsum('ilm,kl,km->ki', g12, delta, delta)
+            - np.einsum('lij,kj,kl->ki', g12, delta, delta)
+            - .5 * np.einsum('ijlm,kj,kl,km->ki', g22, delta, delta, delta))
+
+
+def _get_normal_matrix(delta, g1, g12, g22):
+    """Gauss-Newton matrix (J . J^T) of the quadratic model for each realization."""
+    return (g1
+            + np.einsum('ilm,km->kil', g12, delta)
+            + np.einsum('lij,kj->kil', g12, delta)
+            + np.einsum('ijlm,kj,km->kil', g22, delta, delta))
+
+
+def _get_chi2(delta, nn, a, b, g1, g12, g22):
+    return (nn - 2 * np.einsum('ki,ki->k', a, delta) - np.einsum('ki,kij,kj->k', delta, b, delta)
+            + np.einsum('ki,ij,kj->k', delta, g1, delta)
+            + np.einsum('ilm,ki,kl,km->k', g12, delta, delta, delta)
+            + .25 * np.einsum('ijlm,ki,kj,kl,km->k', g22, delta, delta, delta, delta))
+
+
+def perform_batch_fit(g_parameters, image_renderer, snr=20., num_fits=1, first_seed=0, fish=None,
+                      noise_engine=None, jacobian='per', max_iter=20, tol=1e-4, max_sigma=5.,
+                      chunk_size=1000, fallback=True, method='leastsq'):
+    """Fit num_fits noise realizations (indices first_seed, first_seed + 1, ...) of the image of
+    the galaxies in g_parameters together.
+
+    Args:
+        g_parameters(:class:`analysis.gparameters.GParameters`): Parameters of the galaxies.
+        image_renderer(:class:`analysis.images.ImageRenderer`): Object used to render the galaxies.
+        snr(float): Signal to noise ratio of the fits.
+        num_fits(int): Number of noise realizations to fit.
+        first_seed(int): Index of the first noise realization.
+        fish(:class:`analysis.fisher.Fisher`): optional, fisher analysis of the galaxies.
+        noise_engine(:class:`analysis.images.NoiseEngine`): optional, engine producing the noise.
+        jacobian(str): 'per' to solve with the Gauss-Newton matrix of each realization (one
+            stacked solve per iteration), 'shared' to use the fisher matrix for all of them.
+        max_iter(int): Maximum number of iterations of the batch solver.
+        tol(float): Convergence threshold on the size of the steps, in units of the fisher
+            predicted error of each parameter.
+        max_sigma(float): Fits that move more than this many fisher errors away from the truth
+            are not trusted to the quadratic model.
+        chunk_size(int): Number of realizations held in memory at the same time.
+        fallback(bool): Whether to fit the realizations that did not converge with lmfit.
+        method(str): Method of :func:`runfits.perform_fit` used for the fallback fits.
+
+    Returns:
+        A :class:`BatchFitResults`
+    """
+    if jacobian not in ('per', 'shared'):
+        raise ValueError('jacobian should be either \'per\' or \'shared\'.')
+
+    if fish is None:
+        fish = fisher.Fisher(g_parameters=g_parameters, image_renderer=image_renderer, snr=snr)
+    if noise_engine is None:
+        noise_engine = images.NoiseEngine(fish.image, var_noise=fish.var_noise)
+
+    names = fish.param_names
+    num_params = fish.num_params
+    sqrt_weight = np.sqrt(images.get_weight(noise_engine.var_noise))
+    if np.ndim(sqrt_weight):
+        sqrt_weight = sqrt_weight.ravel()
+
+    # whitened derivative images and their projections on each other.
+    d1 = np.array([fish.derivatives_images[param].ravel() for param in names]) * sqrt_weight
+    d2 = np.array([[fish.second_derivatives_images[param_i, param_j].ravel() for param_j in names]
+                   for param_i in names]) * sqrt_weight
+    g1 = np.einsum('in,jn->ij', d1, d1)
+    g12 = np.einsum('in,jln->ijl', d1, d2)
+    g22 = np.einsum('ijn,lmn->ijlm', d2, d2)
+    g1_inv = np.linalg.inv(g1)
+
+    theta0 = np.array([g_parameters.params[param] for param in names])
+    errors = np.sqrt(np.diag(fish.matrix_to_numpy_array(fish.covariance_matrix)))
+    mins = defaults.get_minimums(g_parameters, fish.image)
+    maxs = defaults.get_maximums(g_parameters, fish.image)
+    lower = np.array([mins.get(param, -np.inf) for param in names]) - theta0
+    upper = np.array([maxs.get(param, np.inf) for param in names]) - theta0
+
+    noise_seeds = np.arange(first_seed, first_seed + num_fits)
+    values = np.zeros((num_fits, num_params))
+    chi2 = np.full(num_fits, np.nan)
+    model_chi2 = np.zeros(num_fits)
+    nfev = np.zeros(num_fits, dtype=int)
+    iterations = np.zeros(num_fits, dtype=int)
+    success = np.zeros(num_fits, dtype=bool)
+
+    for start in range(0, num_fits, chunk_size):
+        size = min(chunk_size, num_fits - start)
+        noise = noise_engine.get_noise(first_seed + start, size).reshape(size, -1) * sqrt_weight
+        nn = np.einsum('kn,kn->k', noise, noise)
+        a = noise @ d1.T
+        b = (noise @ d2.reshape(num_params ** 2, -1).T).reshape(size, num_params, num_params)
+
+        delta = np.zeros((size, num_params))
+        active = np.ones(size, dtype=bool)
+        converged = np.zeros(size, dtype=bool)
+        chunk_iterations = np.zeros(size, dtype=int)
+
+        for _ in range(max_iter):
+            if not active.any():
+                break
+            d, ad, bd = delta[active], a[active], b[active]
+            gradient = _get_gradient(d, ad, bd, g1, g12, g22)
+            if jacobian == 'per':
+                step = np.linalg.solve(_get_normal_matrix(d, g1, g12, g22), gradient[..., None])[..., 0]
+            else:
+                step = gradient @ g1_inv.T
+
+            new_delta = np.clip(d + step, lower, upper)
+            delta[active] = new_delta
+            chunk_iterations[active] += 1
+
+            done = np.all(np.abs(step) < tol * errors, axis=1)
+            hit_bound = np.any((new_delta <= lower) | (new_delta >= upper), axis=1)
+            too_far = np.any(np.abs(new_delta) > max_sigma * errors, axis=1)
+
+            idx = np.flatnonzero(active)
+            converged[idx[done & ~hit_bound & ~too_far]] = True
+            active[idx[done | hit_bound | too_far]] = False
+
+        values[start:start + size] = theta0 + delta
+        model_chi2[start:start + size] = _get_chi2(delta, nn, a, b, g1, g12, g22)
+        iterations[start:start + size] = chunk_iterations
+        success[start:start + size] = converged
+
+    fell_back = ~success
+    fallback_results = {}
+    if fallback:
+        for k in np.flatnonzero(fell_back):
+            results = runfits.perform_fit(g_parameters, image_renderer, snr=snr,
+                                          noise_seed=noise_seeds[k], method=method,
+                                          noise_engine=noise_engine)
+            values[k] = [results.params[param].value for param in names]
+            chi2[k] = results.chisqr
+            nfev[k] = results.nfev
+            success[k] = results.success
+            fallback_results[int(k)] = results
+    else:
+        fell_back[:] = False
+
+    return BatchFitResults(names, noise_seeds, values, chi2, model_chi2, nfev, iterations, success, fell_back,
+                           fallback_results, noise_engine.seed, fish.image.array.size)
+
+
+def write_results(batch, project):
+    """Write each fit of batch to the results file of project numbered by its noise realization,
+    in the format of :func:`runfits.write_results`.
+
+    The column quadratic_model tells the fits solved on the quadratic model apart, their chi2 and
+    redchi are the ones of the model and their nfev is 0. The columns model_chi2 and iterations
+    of the batch solver are written for every fit.
+    """
+    os.makedirs(os.path.join(project, defaults.RESULTS_DIR), exist_ok=True)
+    num_params = len(batch.param_names)
+    for k, noise_seed in enumerate(batch.noise_seeds):
+        noise_seed = int(noise_seed)
+        if k in batch.fallback_results:
+            row = runfits.get_results_row(batch.fallback_results[k], noise_seed, seed=batch.seed)
+        else:
+            nfree = batch.ndata - num_params
+            row = batch.get_values_dict(k)
+            row.update({
+                'chi2': batch.model_chi2[k],
+                'success': bool(batch.success[k]),
+                'errorbars': False,
+                'nfev': 0,
+                'nvarys': num_params,
+                'ndata': batch.ndata,
+                'nfree': nfree,
+                'redchi': batch.model_chi2[k] / nfree,
+                'seed': batch.seed,
+                'stream': noise_seed,
+            })
+        row['quadratic_model'] = k not in batch.fallback_results
+        row['model_chi2'] = batch.model_chi2[k]
+        row['iterations'] = batch.iterations[k]
+        runfits.write_row(row, project, noise_seed)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""Generate many projects at once from a catalog of scenes.
+
+The catalog is either a csv file or a numpy (.npy) structured array with one row per galaxy.
+Besides the usual columns of galaxies.csv (see :func:`analysis.registry.get_fieldnames`) each row
+has a 'project' column with the name of the project (directory) the galaxy belongs to, so all
+the rows with the same project form one scene.
+"""
+import argparse
+import csv
+import math
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from . import defaults
+from .analysis import registry
+from .generate import write_galaxy_file
+
+PROJECT_COLUMN = 'project'
+
+
+def read_catalog(filename):
+    """Return the rows of the catalog in filename as a list of dictionaries, omitting the empty
+    values."""
+    filename = Path(filename)
+    rows = []
+    if filename.suffix == '.npy':
+        catalog = np.load(filename.as_posix())
+        if catalog.dtype.names is None:
+            raise ValueError('A numpy catalog should be a structured array with named fields.')
+        for entry in catalog:
+            row = {}
+            for name in catalog.dtype.names:
+                value = entry[name].item()
+                if isinstance(value, bytes):
+                    value = value.decode()
+                if isinstance(value, float) and math.isnan(value):
+                    continue
+                if value != '':
+                    row[name] = value
+            rows.append(row)
+
+    else:
+        with open(filename.as_posix(), 'r') as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                rows.append({k: v for (k, v) in row.items() if v})
+
+    return rows
+
+
+def validate_catalog(rows):
+    """Check every row of the catalog against the parameters and models in :mod:`analysis.registry`
+    and return the rows grouped by project.
+
+    Each row may only specify parameters of its galaxy model and psf model (none of a psf without
+    psf_model), and has to specify every parameter they need to be drawn.
+
+    Returns:
+        A dict mapping the name of each project to a list with the rows of its galaxies.
+    """
+    fieldnames = registry.get_fieldnames()
+    parameters = set(registry.get_all_parameters())
+    psf_parameters = set(registry.get_psf_parameters())
+    gal_models = registry.get_all_models()
+    psf_models = registry.get_all_psf_models()
+
+    scenes = {}
+    for i, row in enumerate(rows):
+        unknown = [k for k in row if k not in fieldnames and k != PROJECT_COLUMN]
+        if unknown:
+            raise ValueError(f'Row {i} of the catalog has unknown columns: {unknown}')
+
+        for column in (PROJECT_COLUMN, 'id', 'galaxy_model'):
+            if column not in row:
+                raise ValueError(f'Row {i} of the catalog does not specify {column}.')
+
+        if row['galaxy_model'] not in gal_models:
+            raise ValueError(f'Row {i} of the catalog has unknown galaxy model {row["galaxy_model"]}.')
+
+        if 'psf_model' in row and row['psf_model'] not in psf_models:
+            raise ValueError(f'Row {i} of the catalog has unknown psf model {row["psf_model"]}.')
+
+        models = [row['galaxy_model']] + ([row['psf_model']] if 'psf_model' in row else [])
+        allowed = set(registry.GALAXY_MODELS[row['galaxy_model']])
+        if 'psf_model' in row:
+            allowed.update(registry.PSF_MODELS[row['psf_model']])
+        others = [k for k in row if k in parameters and k not in allowed]
+        if 'psf_model' not in row and any(k in psf_parameters for k in others):
+            raise ValueError(f'Row {i} of the catalog has psf parameters but no psf_model: '
+                             f'{[k for k in others if k in psf_parameters]}')
+        if others:
+            raise ValueError(f'Row {i} of the catalog has parameters that are not of the models '
+                             f'{" and ".join(models)}: {others}')
+
+        missing = [group for model in models for group in registry.get_missing_parameters(model, row)]
+        if missing:
+            raise ValueError(f'Row {i} of the catalog does not specify {"; ".join(missing)} of the models '
+                             f'{" and ".join(models)}.')
+
+        row_to_write = {}
+        for k, v in row.items():
+            if k in parameters:
+                try:
+                    v = float(v)
+                except ValueError:
+                    raise ValueError(f'Row {i} of the catalog has a non-numeric value for {k}.')
+            row_to_write[k] = v
+        row_to_write['id'] = int(float(row['id']))
+
+        project = str(row_to_write.pop(PROJECT_COLUMN))
+        scenes.setdefault(project, []).append(row_to_write)
+
+    for project, scene in scenes.items():
+        ids = [row['id'] for row in scene]
+        if len(set(ids)) != len(ids):
+            raise ValueError(f'Project {project} has repeated galaxy ids.')
+        if not set(ids) <= {1, 2}:
+            raise ValueError(f'Project {project}: only support two galaxies with ids 1 and 2.')
+
+    return scenes
+
+
+def write_projects(scenes, directory, overwrite=False):
+    """Write each scene into its own project directory inside directory.
+
+    Args:
+        scenes(dict): Output of :func:`validate_catalog`.
+        directory(str): Directory where the projects are created.
+        overwrite(bool): Replace the galaxies of projects that already exist (their fit results
+            are removed), otherwise existing projects raise an error before anything is written.
+
+    Returns:
+        A list with the paths of the projects written.
+    """
+    directory = Path(directory)
+    project_paths = {project: directory.joinpath(project) for project in scenes}
+
+    if not overwrite:
+        existing = [p.as_posix() for p in project_paths.values() if p.joinpath(defaults.GALAXY_FILE).exists()]
+        if existing:
+            raise OSError(f'These projects already exist (use overwrite): {existing}')
+
+    for project, scene in scenes.items():
+        project_path = project_paths[project]
+        project_path.mkdir(parents=True, exist_ok=True)
+
+        results_dir = project_path.joinpath(defaults.RESULTS_DIR)
+        if results_dir.exists():
+            shutil.rmtree(results_dir.as_posix())
+
+        write_galaxy_file(project_path.joinpath(defaults.GALAXY_FILE),
+                          sorted(scene, key=lambda row: row['id']))
+
+    return list(project_paths.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate one project per scene of a catalog of galaxies.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('catalog', type=str,
+                        help=('Catalog (.csv or .npy) with one row per galaxy, with a \'project\' column'
+                              'and the same columns as galaxies.csv.'))
+
+    parser.add_argument('-d', '--directory', default='.',
+                        type=str,
+                        help='Directory where the projects are created.')
+
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Replace the galaxies of projects that already exist.')
+
+    args = parser.parse_args()
+
+    scenes = validate_catalog(read_catalog(args.catalog))
+    write_projects(scenes, args.directory, overwrite=args.overwrite)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+"""Benchmark of the fitting configurations of a project.
+
+Every configuration (fitting method, warm start and backend) fits the same noise realizations
+(indices first_fit, first_fit + 1, ... of the streams of seed, see
+:func:`analysis.images.get_stream_key`), so their costs and results can be compared fit by fit.
+
+Warm starts:
+    random: the random initial values of :func:`runfits.perform_fit`.
+    truth: the true values of the parameters.
+    batch: the solution of the quadratic model of :mod:`batchfit` for the same realization.
+
+Backends:
+    serial: one fit after the other in this process.
+    processes: the fits split over a pool of processes.
+    batch: :func:`batchfit.perform_batch_fit`, with the method used for the fits that fall back
+        (the warm start does not apply).
+
+For each configuration the benchmark reports the wall time, the number of function evaluations,
+the fraction of fits that converged away from the bounds, the agreement of the fitted values with
+those of the first configuration and the bias and width of the residuals compared with the fisher
+predictions. A configuration reproduces the fisher predictions when the width of the residuals of
+every parameter agrees with its fisher error and the mean residual agrees with its fisher bias,
+both within :data:`NUM_STD_ERRORS` standard errors.
+
+The batch backend solves the quadratic model of the fisher formalism for most fits, so its
+agreement with the fisher predictions is partly built in. Its configurations are flagged as
+model based and never chosen as the cheapest (see :func:`get_cheapest`).
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from . import defaults
+from . import runfits
+from . import telemetry
+
+WARM_STARTS = ('random', 'truth', 'batch')
+BACKENDS = ('serial', 'processes', 'batch')
+
+# backends whose results come (mostly) from the fisher model instead of fits of the images.
+MODEL_BASED_BACKENDS = ('batch',)
+
+# tolerance of the agreement of the width of the residuals with the fisher errors and of their mean
+# with the fisher biases, in units of the standard error of the width (1 / sqrt(2 (num_fits - 1))
+# relative) and of the mean (res_std / sqrt(num_fits)).
+NUM_STD_ERRORS = 3.
+
+
+def _run_fits(args):
+    """Return list with (values, nfev, success, bound hits, wall time) of each fit."""
+    g_parameters, image_renderer, noise_engine, method, noise_seeds, init_values = args
+    fits = []
+    for noise_seed, values in zip(noise_seeds, init_values):
+        results = runfits.perform_fit(g_parameters, image_renderer, noise_seed=noise_seed, method=method,
+                                      noise_engine=noise_engine, init_values=values)
+        fits.append(([results.params[param].value for param in g_parameters.fit_params], results.nfev,
+                     bool(results.success), results.telemetry['bound_hits'], results.telemetry['wall_time']))
+    return fits
+
+
+def get_init_values(warm_start, g_parameters, image_renderer, fish, noise_engine, noise_seeds):
+    """Return list with the initial values of each fit for warm_start (None for the default
+    random values)."""
+    import numpy as np
+
+    if warm_start == 'random':
+        return [None] * len(noise_seeds)
+
+    if warm_start == 'truth':
+        return [dict(g_parameters.fit_params) for _ in noise_seeds]
+
+    if warm_start == 'batch':
+        from . import batchfit
+
+        batch = batchfit.perform_batch_fit(g_parameters, image_renderer, num_fits=len(noise_seeds),
+                                           first_seed=noise_seeds[0], fish=fish, noise_engine=noise_engine,
+                                           fallback=False)
+        mins = defaults.get_minimums(g_parameters, fish.image)
+        maxs = defaults.get_maximums(g_parameters, fish.image)
+        init_values = []
+        for k in range(len(noise_seeds)):
+            values = batch.get_values_dict(k)
+            init_values.append({param: float(np.clip(value, mins.get(param, -np.inf), maxs.get(param, np.inf)))
+                                for param, value in values.items()})
+        return init_values
+
+    raise ValueError(f'Unknown warm start {warm_start}, should be one of {WARM_STARTS}.')
+
+
+def run_configuration(g_parameters, image_renderer, fish, noise_engine, noise_seeds, method, warm_start,
+                      backend, processes=None):
+    """Fit the noise realizations noise_seeds with one configuration.
+
+    Returns:
+        A dictionary with the fitted values (array of shape (num_fits, num_params) in the order of
+        g_parameters.fit_params), nfev, success and bound hits of each fit, the wall time of each
+        fit and the elapsed time of the whole configuration (including the warm start).
+    """
+    import numpy as np
+
+    from . import batchfit
+
+    start = time.perf_counter()
+    if backend == 'batch':
+        batch = batchfit.perform_batch_fit(g_parameters, image_renderer, num_fits=len(noise_seeds),
+                                           first_seed=noise_seeds[0], fish=fish, noise_engine=noise_engine,
+                                           method=method)
+        elapsed = time.perf_counter() - start
+        names = list(g_parameters.fit_params)
+        order = [batch.param_names.index(param) for param in names]
+        mins = defaults.get_minimums(g_parameters, fish.image)
+        maxs = defaults.get_maximums(g_parameters, fish.image)
+        bound_hits = [';'.join(telemetry.get_bound_hits(batch.get_values_dict(k), mins, maxs))
+                      for k in range(len(noise_seeds))]
+        return {
+            'values': batch.values[:, order],
+            'nfev': batch.nfev.astype(float),
+            'success': batch.success,
+            'bound_hits': bound_hits,
+            'wall_times': np.full(len(noise_seeds), elapsed / len(noise_seeds)),
+            'elapsed': elapsed,
+        }
+
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend {backend}, should be one of {BACKENDS}.')
+
+    init_values = get_init_values(warm_start, g_parameters, image_renderer, fish, noise_engine, noise_seeds)
+    if backend == 'serial':
+        fits = _run_fits((g_parameters, image_renderer, noise_engine, method, noise_seeds, init_values))
+    else:
+        processes = processes or os.cpu_count()
+        chunk_size = math.ceil(len(noise_seeds) / processes)
+        tasks = [(g_parameters, image_renderer, noise_engine, method, noise_seeds[i:i + chunk_size],
+                  init_values[i:i + chunk_size]) for i in range(0, len(noise_seeds), chunk_size)]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            fits = list(itertools.chain.from_iterable(executor.map(_run_fits, tasks)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'values': np.array([fit[0] for fit in fits]),
+        'nfev': np.array([fit[1] for fit in fits], dtype=float),
+        'success': np.array([fit[2] for fit in fits]),
+        'bound_hits': [fit[3] for fit in fits],
+        'wall_times': np.array([fit[4] for fit in fits]),
+        'elapsed': elapsed,
+    }
+
+
+def summarize_configuration(run, reference, g_parameters, fish):
+    """Return dictionary with the costs and the statistics of the results of one configuration,
+    comparing the fitted values with those of the reference configuration fit by fit."""
+    import numpy as np
+
+    names = list(g_parameters.fit_params)
+    true_values = np.array([g_parameters.fit_params[param] for param in names])
+    sigmas = np.sqrt(np.array([fish.covariance_matrix[param, param] for param in names]))
+    fisher_biases = np.array([fish.biases[param] for param in names])
+
+    num_fits = len(run['values'])
+    converged = run['success'] & np.array([not hits for hits in run['bound_hits']])
+    residuals = run['values'] - true_values
+    res_stds = residuals.std(axis=0, ddof=1) if num_fits > 1 else np.full(len(names), np.nan)
+    std_ratios = res_stds / sigmas
+    ratio_error = 1. / math.sqrt(2 * (num_fits - 1)) if num_fits > 1 else math.inf
+    biases = residuals.mean(axis=0)
+    bias_errors = res_stds / math.sqrt(num_fits)
+    reproduces_widths = bool(np.all(np.abs(std_ratios - 1) <= NUM_STD_ERRORS * ratio_error))
+    bias_pulls = (biases - fisher_biases) / bias_errors
+    reproduces_biases = bool(np.all(np.abs(bias_pulls) <= NUM_STD_ERRORS))
+    differences = np.abs(run['values'] - reference['values']) / sigmas
+
+    return {
+        'num_fits': num_fits,
+        'elapsed': run['elapsed'],
+        'fits_per_second': num_fits / run['elapsed'],
+        'wall_time': telemetry.get_distribution(run['wall_times']),
+        'nfev': telemetry.get_distribution(run['nfev']),
+        'success_rate': float(run['success'].mean()),
+        'convergence_rate': float(converged.mean()),
+        'agreement': {
+            'max_sigma': float(differences.max()),
+            'median_sigma': float(np.median(differences)),
+            'fraction_within_0.1_sigma': float(np.mean(np.all(differences < .1, axis=1))),
+        },
+        'params': {
+            param: {
+                'bias': float(biases[i]),
+                'bias_error': float(bias_errors[i]),
+                'fisher_bias': float(fisher_biases[i]),
+                'bias_pull': float(bias_pulls[i]),
+                'res_std': float(res_stds[i]),
+                'fisher_sigma': float(sigmas[i]),
+                'res_std_ratio': float(std_ratios[i]),
+            }
+            for i, param in enumerate(names)
+        },
+        'std_ratio_error': ratio_error,
+        'reproduces_widths': reproduces_widths,
+        'reproduces_biases': reproduces_biases,
+        'reproduces_fisher': reproduces_widths and reproduces_biases,
+    }
+
+
+def run_benchmark(project, snr, slen, methods=('leastsq',), warm_starts=('random',), backends=('serial',),
+                  num_fits=50, first_fit=1, seed=0, processes=None, verbose=False):
+    """Fit the same noise realizations of the galaxies of project with every combination of
+    methods, warm_starts and backends.
+
+    Args:
+        project(str): Project with the galaxies.csv of the galaxies.
+        snr(float): S/N ratio of the fits.
+        slen(int): Size of the images (odd).
+        methods(list): Methods of :func:`runfits.perform_fit`.
+        warm_starts(list): Initial values of the fits, see :data:`WARM_STARTS`.
+        backends(list): How the fits are run, see :data:`BACKENDS`.
+        num_fits(int): Number of noise realizations.
+        first_fit(int): Index of the first noise realization.
+        seed(int): Seed of the noise and initial values.
+        processes(int): Number of processes of the processes backend, by default the number of cpus.
+
+    Returns:
+        A dictionary with the inputs of the benchmark and a list with the summary of each
+        configuration (see :func:`summarize_configuration`), the first one is the reference of
+        the agreement of the others.
+    """
+    from .analysis import gparameters
+    from .analysis import images
+    from .analysis import store
+
+    g_parameters = gparameters.GParameters(project)
+    image_renderer = images.ImageRenderer(pixel_scale=defaults.PIXEL_SCALE, nx=slen, ny=slen)
+    fish = store.get_fisher(g_parameters, image_renderer, snr)
+    noise_engine = images.NoiseEngine(fish.image, var_noise=fish.var_noise, seed=seed)
+    noise_seeds = list(range(first_fit, first_fit + num_fits))
+
+    configurations = []
+    for method, warm_start, backend in itertools.product(methods, warm_starts, backends):
+        if backend == 'batch':
+            if warm_start != warm_starts[0]:
+                continue
+            warm_start = None
+        configurations.append((method, warm_start, backend))
+
+    benchmark = {
+        'project': str(project),
+        'snr': snr,
+        'slen': slen,
+        'num_fits': num_fits,
+        'first_fit': first_fit,
+        'seed': seed,
+        'configurations': [],
+    }
+    reference = None
+    for method, warm_start, backend in configurations:
+        run = run_configuration(g_parameters, image_renderer, fish, noise_engine, noise_seeds, method, warm_start,
+                                backend, processes=processes)
+        reference = reference or run
+        summary = {'method': method, 'warm_start': warm_start, 'backend': backend,
+                   'model_based': backend in MODEL_BASED_BACKENDS}
+        summary.update(summarize_configuration(run, reference, g_parameters, fish))
+        benchmark['configurations'].append(summary)
+        if verbose:
+            print(f'{method} {warm_start} {backend}: {summary["elapsed"]:.2f}s', flush=True)
+
+    return benchmark
+
+
+def get_cheapest(benchmark):
+    """Return the summary of the fastest configuration of benchmark that fits the images (is not
+    model based) and reproduces the fisher predictions, None if no configuration does."""
+    valid = [configuration for configuration in benchmark['configurations']
+             if configuration['reproduces_fisher'] and not configuration['model_based']]
+    return min(valid, key=lambda configuration: configuration['elapsed'], default=None)
+
+
+def _print_benchmark(benchmark):
+    print(f'{benchmark["num_fits"]} fits of {benchmark["project"]} at snr {benchmark["snr"]} (seed '
+          f'{benchmark["seed"]}, fits {benchmark["first_fit"]}-{benchmark["first_fit"] + benchmark["num_fits"] - 1})')
+    print(f'{"method":<14}{"warm start":<12}{"backend":<11}{"seconds":>9}{"fits/s":>9}{"nfev":>8}'
+          f'{"converged":>11}{"max diff":>10}{"max |std ratio - 1|":>21}{"max |bias pull|":>17}{"fisher":>8}')
+    for configuration in benchmark['configurations']:
+        worst = max(abs(param['res_std_ratio'] - 1) for param in configuration['params'].values())
+        worst_bias = max(abs(param['bias_pull']) for param in configuration['params'].values())
+        agrees = 'yes' if configuration['reproduces_fisher'] else 'no'
+        print(f'{configuration["method"]:<14}{str(configuration["warm_start"]):<12}{configuration["backend"]:<11}'
+              f'{configuration["elapsed"]:>9.2f}{configuration["fits_per_second"]:>9.2f}'
+              f'{configuration["nfev"]["mean"]:>8.1f}{configuration["convergence_rate"]:>11.3f}'
+              f'{configuration["agreement"]["max_sigma"]:>10.2e}{worst:>21.3f}{worst_bias:>17.2f}'
+              f'{agrees:>8}{"  (model based)" if configuration["model_based"] else ""}')
+
+    cheapest = get_cheapest(benchmark)
+    if cheapest is None:
+        print('no configuration fitting the images reproduces the fisher predictions.')
+    else:
+        print(f'cheapest configuration reproducing the fisher predictions: {cheapest["method"]} '
+              f'{cheapest["warm_start"]} {cheapest["backend"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the cost and results of fitting methods, warm starts and '
+                                                 'backends on the same noise realizations of a project.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-p', '--project', default=defaults.PROJECT,
+                        type=str,
+                        help='Project with the galaxies to fit.')
+
+    parser.add_argument('--snr', default=None,
+                        type=float,
+                        help='Signal to noise ratio of the fits, by default the one of the project.')
+
+    parser.add_argument('--slen', default=41,
+                        type=int,
+                        help='The size to use for the image in which to draw the galaxy model.')
+
+    parser.add_argument('--methods', nargs='+', default=['leastsq', runfits.NUMPY_METHOD],
+                        help='Fitting methods, any lmfit method or \'numpy_lm\'.')
+
+    parser.add_argument('--warm-starts', nargs='+', default=['random'],
+                        choices=WARM_STARTS,
+                        help='Initial values of the fits.')
+
+    parser.add_argument('--backends', nargs='+', default=['serial'],
+                        choices=BACKENDS,
+                        help='How the fits are run.')
+
+    parser.add_argument('-n', '--number-fits', default=50,
+                        type=int,
+                        help='Number of noise realizations fitted by every configuration.')
+
+    parser.add_argument('--first-fit', default=1,
+                        type=int,
+                        help='Index of the first noise realization.')
+
+    parser.add_argument('--seed', default=0,
+                        type=int,
+                        help='Seed of the noise and initial values of the fits.')
+
+    parser.add_argument('--processes', default=None,
+                        type=int,
+                        help='Number of processes of the processes backend, by default the number of cpus.')
+
+    parser.add_argument('-o', '--output', default=None,
+                        type=str,
+                        help='Write the benchmark as json into this file.')
+
+    parser.add_argument('--json', action='store_true',
+                        help='Print the benchmark as json.')
+
+    args = parser.parse_args()
+
+    snr = args.snr
+    snr_file = Path(args.project).joinpath(defaults.SNR_FILE)
+    if snr is None:
+        if not snr_file.exists():
+            raise ValueError('Need to specify the snr, the project has none.')
+        with open(snr_file, 'r') as snrfile:
+            snr = float(snrfile.readline())
+
+    benchmark = run_benchmark(args.project, snr, args.slen, methods=args.methods, warm_starts=args.warm_starts,
+                              backends=args.backends, num_fits=args.number_fits, first_fit=args.first_fit,
+                              seed=args.seed, processes=args.processes, verbose=not args.json)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(benchmark, f, indent=2)
+
+    if args.json:
+        print(json.dumps(benchmark, indent=2))
+    else:
+        _print_benchmark(benchmark)
+
+
+if __name__ == '__main__':
+    main()
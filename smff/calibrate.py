@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""Compare the fisher analysis of a project drawn with each combination of galsim draw method and
+GSParams profile (see :class:`analysis.images.ImageRenderer`) against a reference, to choose
+the fastest one whose accuracy is good enough.
+
+For each configuration it reports the time taken by the analysis, the largest relative
+difference of the fisher matrix elements and the largest difference of the biases, in units of
+the fisher predicted error of each parameter.
+
+Method 'no_pixel' draws a different model of the images (without the pixel response), so it is
+only compared when asked for, and its results are labelled as such. Configurations with method
+'real_space' that galsim had to draw with a DFT are flagged, their images are those of 'auto'.
+"""
+import argparse
+import json
+import time
+import warnings
+
+import numpy as np
+
+from . import defaults
+from .analysis import fisher
+from .analysis import gparameters
+from .analysis import images
+
+# draw methods compared by default, the ones drawing the same model of the images as the reference.
+SAME_MODEL_METHODS = [method for method in images.DRAW_METHODS if method != 'no_pixel']
+
+
+def calibrate(g_parameters, snr, pixel_scale, slen, methods, profiles, reference=('auto', 'accurate')):
+    """Return list with one dictionary of results for each configuration (method, profile).
+
+    Args:
+        g_parameters(:class:`analysis.gparameters.GParameters`): Parameters of the galaxies.
+        snr(float): S/N ratio of the analysis.
+        pixel_scale(float): Pixel scale of the images.
+        slen(int): Size of the side of the images, in pixels.
+        methods(list): Draw methods to try, see :data:`analysis.images.DRAW_METHODS`.
+        profiles(list): GSParams profiles to try, see :data:`analysis.images.GSPARAMS_PROFILES`.
+        reference(tuple): Configuration (method, profile) the others are compared to.
+
+    Each result has whether the configuration draws the same model as the reference
+    ('same_model', False for 'no_pixel') and whether galsim fell back to a DFT ('dft_fallback').
+    """
+
+    def get_fisher(method, profile):
+        image_renderer = images.ImageRenderer(pixel_scale=pixel_scale, nx=slen, ny=slen, method=method,
+                                              gsparams=profile)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', images.DrawFallbackWarning)
+            start = time.perf_counter()
+            fish = fisher.Fisher(g_parameters=g_parameters, image_renderer=image_renderer, snr=snr)
+            seconds = time.perf_counter() - start
+        fallback = any(issubclass(warning.category, images.DrawFallbackWarning) for warning in caught)
+        return fish, seconds, fallback
+
+    ref_fish, ref_time, ref_fallback = get_fisher(*reference)
+    names = ref_fish.param_names
+    ref_fisher_matrix = ref_fish.matrix_to_numpy_array(ref_fish.fisher_matrix)
+    ref_biases = np.array([ref_fish.biases[param] for param in names])
+    ref_sigmas = np.sqrt(np.diag(ref_fish.matrix_to_numpy_array(ref_fish.covariance_matrix)))
+
+    results = []
+    for method in methods:
+        for profile in profiles:
+            if (method, profile) == tuple(reference):
+                fish, seconds, fallback = ref_fish, ref_time, ref_fallback
+            else:
+                fish, seconds, fallback = get_fisher(method, profile)
+
+            fisher_matrix = fish.matrix_to_numpy_array(fish.fisher_matrix)
+            biases = np.array([fish.biases[param] for param in names])
+            fisher_diff = np.abs(fisher_matrix - ref_fisher_matrix) / np.abs(ref_fisher_matrix).max()
+            bias_diff = np.abs(biases - ref_biases) / ref_sigmas
+
+            results.append({
+                'method': method,
+                'gsparams': profile,
+                'same_model': method != 'no_pixel',
+                'dft_fallback': fallback,
+                'seconds': seconds,
+                'speedup': ref_time / seconds,
+                'max_fisher_rel_diff': float(fisher_diff.max()),
+                'max_bias_diff_sigma': float(bias_diff.max()),
+                'bias_diff_sigma': dict(zip(names, bias_diff.tolist())),
+            })
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=('Report the accuracy and speed of the fisher analysis of a'
+                                                  'project with each galsim draw method and GSParams profile.'),
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-p', '--project', default=defaults.PROJECT,
+                        type=str,
+                        help='Project with the galaxies to use.')
+
+    parser.add_argument('--snr', default=20.,
+                        type=float,
+                        help='Signal to noise ratio of the analysis.')
+
+    parser.add_argument('--slen', default=41,
+                        type=int,
+                        help='The size to use for the image in which to draw the galaxy model.')
+
+    parser.add_argument('--methods', nargs='+', default=SAME_MODEL_METHODS,
+                        choices=images.DRAW_METHODS,
+                        help="Draw methods to compare, 'no_pixel' draws a different model of the images.")
+
+    parser.add_argument('--profiles', nargs='+', default=list(images.GSPARAMS_PROFILES),
+                        choices=list(images.GSPARAMS_PROFILES),
+                        help='GSParams profiles to compare.')
+
+    parser.add_argument('--reference', nargs=2, default=['auto', 'accurate'],
+                        metavar=('METHOD', 'PROFILE'),
+                        help='Configuration the others are compared to.')
+
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as json instead of a table.')
+
+    args = parser.parse_args()
+
+    g_parameters = gparameters.GParameters(args.project)
+    results = calibrate(g_parameters, args.snr, defaults.PIXEL_SCALE, args.slen, args.methods, args.profiles,
+                        reference=tuple(args.reference))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f'{"method":<12}{"gsparams":<10}{"seconds":>10}{"speedup":>10}{"fisher rel":>12}{"bias/sigma":>12}  note')
+    for result in results:
+        note = 'different model' if not result['same_model'] else 'drawn with DFT' if result['dft_fallback'] else ''
+        print(f'{result["method"]:<12}{result["gsparams"]:<10}{result["seconds"]:>10.3f}{result["speedup"]:>10.2f}'
+              f'{result["max_fisher_rel_diff"]:>12.2e}{result["max_bias_diff_sigma"]:>12.2e}  {note}')
+
+
+if __name__ == '__main__':
+    main()
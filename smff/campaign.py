@@ -0,0 +1,172 @@
+"""Run fits of a project in batches until the biases of the parameters are measured with a
+target precision.
+
+After each batch the running bias (mean residual), pull mean and their standard errors are
+updated, and the campaign stops as soon as the standard error of the bias of every requested
+parameter is below the target, which can be given as an absolute error or as a fraction of the
+bias predicted by the fisher formalism. Biases that vanish by symmetry (e.g. of the position
+of a single galaxy) would give targets of about zero, so the fractional targets are never smaller
+than :data:`MIN_TARGET_SIGMAS` times the fisher predicted error of the parameter.
+"""
+import math
+import os
+from pathlib import Path
+
+from . import defaults
+from . import runfits
+
+# smallest target standard error of a bias given as a fraction of the fisher bias, in units of the
+# fisher predicted error of the parameter (a target of 0.05 sigma needs about 400 fits).
+MIN_TARGET_SIGMAS = 0.05
+
+
+class RunningStatistics(object):
+    """Running mean and standard error of the residuals and pulls of each parameter.
+
+    Args:
+        params(list): Names of the parameters.
+        true_values(dict): True value of each parameter.
+        sigmas(dict): Fisher predicted error of each parameter, used for the pulls.
+    """
+
+    def __init__(self, params, true_values, sigmas):
+        self.params = params
+        self.true_values = true_values
+        self.sigmas = sigmas
+        self.num_fits = 0
+        self.sums = {param: 0. for param in params}
+        self.squares = {param: 0. for param in params}
+
+    def add(self, values):
+        """Add the fitted values (dict) of one fit."""
+        self.num_fits += 1
+        for param in self.params:
+            residual = float(values[param]) - self.true_values[param]
+            self.sums[param] += residual
+            self.squares[param] += residual ** 2
+
+    def get_bias(self, param):
+        return self.sums[param] / self.num_fits
+
+    def get_std(self, param):
+        mean = self.get_bias(param)
+        return math.sqrt(max(self.squares[param] / self.num_fits - mean ** 2, 0.))
+
+    def get_bias_error(self, param):
+        """Standard error of the bias of param."""
+        if self.num_fits < 2:
+            return float('inf')
+        return self.get_std(param) / math.sqrt(self.num_fits - 1)
+
+    def get_pull_mean(self, param):
+        return self.get_bias(param) / self.sigmas[param]
+
+    def get_pull_mean_error(self, param):
+        return self.get_bias_error(param) / self.sigmas[param]
+
+
+def get_targets(params, fish, target_error=None, fisher_fraction=None):
+    """Return dictionary with the target standard error of the bias of each parameter, the
+    smallest of target_error and fisher_fraction times the fisher predicted bias. The latter is
+    floored at :data:`MIN_TARGET_SIGMAS` times the fisher predicted error of the parameter, so
+    parameters with a fisher bias of about zero still have a reachable target."""
+    targets = {}
+    for param in params:
+        candidates = []
+        if target_error is not None:
+            candidates.append(target_error)
+        if fisher_fraction is not None:
+            sigma = math.sqrt(fish.covariance_matrix[param, param])
+            candidates.append(max(fisher_fraction * abs(fish.biases[param]), MIN_TARGET_SIGMAS * sigma))
+        if not candidates:
+            raise ValueError('Need to specify a target error or a fisher fraction.')
+        targets[param] = min(candidates)
+    return targets
+
+
+def run_campaign(project, snr, slen, max_fits, batch_size=100, target_error=None, fisher_fraction=None,
+                 params=None, method='leastsq', seed=0, verbose=True):
+    """Fit noise realizations of the galaxies in project in batches until the bias of each parameter
+    in params is measured with the target precision, or max_fits fits have been done.
+
+    Fit results are written to the results directory of the project as usual and existing results
+    are counted towards the precision.
+
+    Args:
+        project(str): Directory of the project.
+        snr(float): Signal to noise ratio of the fits.
+        slen(int): Size of the side of the image, in pixels.
+        max_fits(int): Maximum number of fits in the results directory.
+        batch_size(int): Number of fits between updates of the estimates.
+        target_error(float): Target standard error of the biases.
+        fisher_fraction(float): Target standard error of each bias as a fraction of the fisher
+            predicted bias (at least :data:`MIN_TARGET_SIGMAS` fisher errors, see :func:`get_targets`).
+        params(list): Parameters whose biases need to reach the target, all fit parameters by default.
+        method(str): Method of :func:`runfits.perform_fit`, an lmfit method or :data:`runfits.NUMPY_METHOD`.
+        seed(int): Seed of the noise and initial values of the fits, fit i uses the streams of
+            seed with index i (see :func:`analysis.images.get_stream_key`).
+        verbose(bool): Print the estimates after each batch.
+
+    Returns:
+        A dictionary with the number of fits done, the number of fits saved with respect to
+        max_fits, whether the target was reached and, for each parameter, the bias, its standard
+        error, the target and the pull mean with its standard error.
+    """
+    from .analysis import gparameters
+    from .analysis import images
+    from .analysis import readfits
+    from .analysis import store
+
+    results_dir = os.path.join(project, defaults.RESULTS_DIR)
+    os.makedirs(results_dir, exist_ok=True)
+
+    g_parameters = gparameters.GParameters(project)
+    image_renderer = images.ImageRenderer(pixel_scale=defaults.PIXEL_SCALE, nx=slen, ny=slen)
+    fish = store.get_fisher(g_parameters, image_renderer, snr)
+    noise_engine = images.NoiseEngine(fish.image, var_noise=fish.var_noise, seed=seed)
+
+    if params is None:
+        params = fish.param_names
+    targets = get_targets(params, fish, target_error, fisher_fraction)
+    sigmas = {param: math.sqrt(fish.covariance_matrix[param, param]) for param in params}
+    true_values = {param: float(g_parameters.params[param]) for param in params}
+    statistics = RunningStatistics(params, true_values, sigmas)
+
+    existing_fits = 0
+    for row in readfits.read_result_rows(Path(results_dir)):
+        statistics.add(row)
+        existing_fits += 1
+
+    def reached():
+        return all(statistics.get_bias_error(param) <= targets[param] for param in params)
+
+    fit_number = existing_fits
+    while not reached() and fit_number < max_fits:
+        for _ in range(min(batch_size, max_fits - fit_number)):
+            fit_number += 1
+            results = runfits.perform_fit(g_parameters, image_renderer, snr=snr, noise_seed=fit_number,
+                                          method=method, noise_engine=noise_engine)
+            runfits.write_results(results, project, fit_number, seed=seed)
+            statistics.add({param: results.params[param].value for param in params})
+
+        if verbose:
+            errors = ', '.join(f'{param}: {statistics.get_bias_error(param):.2e}/{targets[param]:.2e}'
+                               for param in params)
+            print(f'{statistics.num_fits} fits, bias errors (achieved/target) {errors}')
+
+    report = {
+        'num_fits': statistics.num_fits,
+        'fits_saved': max(max_fits - statistics.num_fits, 0),
+        'reached': reached(),
+        'params': {},
+    }
+    for param in params:
+        report['params'][param] = {
+            'bias': statistics.get_bias(param),
+            'bias_error': statistics.get_bias_error(param),
+            'target': targets[param],
+            'fisher_bias': fish.biases[param],
+            'pull_mean': statistics.get_pull_mean(param),
+            'pull_mean_error': statistics.get_pull_mean_error(param),
+        }
+    return report
@@ -1,6 +1,6 @@
 """Some of the defaults that are used in the overall program."""
-
-import numpy as np
+import contextlib
+import os
 
 
 def get_steps(g_parameters, image_renderer):
@@ -45,7 +45,7 @@ def get_steps(g_parameters, image_renderer):
     return steps
 
 
-def get_initial_values_fit(g_parameters):
+def get_initial_values_fit(g_parameters, rng=None):
     """Return a dictionary containing the initial values to be used in the
     in the fitting of the parameters.
 
@@ -54,17 +54,75 @@ def get_initial_values_fit(g_parameters):
     Args:
     g_parameters(:class:`analysis.galfun.GParameters`): An object containing different
         forms of the galaxy parameters.
+    rng(:class:`np.random.Generator`): optional, generator of the random offsets from the true
+        values, global np.random by default.
 
     Returns:
         A dict.
     """
+    if rng is None:
+        import numpy as np  # only needed here, keep the import of this module light.
+        rng = np.random
+
     initial_values = dict()
     fit_params = g_parameters.fit_params
     for param in fit_params:
-        initial_values[param] = fit_params[param] + abs(np.random.uniform()) * (fit_params[param] / 10 + 0.2)
+        initial_values[param] = fit_params[param] + abs(rng.uniform()) * (fit_params[param] / 10 + 0.2)
     return initial_values
 
 
+def _get_temp_path(path):
+    """Return a hidden path with the suffix .tmp next to path, unique to this call."""
+    directory, name = os.path.split(os.fspath(path))
+    return os.path.join(directory, f'.{name}.{os.urandom(6).hex()}.tmp')
+
+
+@contextlib.contextmanager
+def atomic_file(path, binary=False):
+    """Context manager yielding a file open for writing the new contents of path, which replace
+    path when the block ends without errors, so readers never see a partial file.
+
+    The file is written under a temporary name in the same directory, created with os.open so
+    the umask gives it the same permissions as files created by open() (tempfile would make it
+    readable only by its owner).
+    """
+    temp_path = _get_temp_path(path)
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb' if binary else 'w') as f:
+            yield f
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+@contextlib.contextmanager
+def atomic_directory(path):
+    """Context manager yielding the path of a temporary directory where the files of the
+    directory path are written, which is moved to path when the block ends without errors.
+
+    The directories written this way are named after a hash of their contents, so if path
+    already exists (e.g. another process wrote it in the meantime) it is kept as it is and the
+    temporary directory is discarded, readers of the existing one are never disturbed.
+    """
+    from pathlib import Path
+    import shutil
+
+    temp_path = Path(_get_temp_path(path))
+    os.mkdir(temp_path, 0o777)
+    try:
+        yield temp_path
+        try:
+            os.replace(temp_path, path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    finally:
+        if temp_path.exists():
+            shutil.rmtree(temp_path)
+
+
 def get_minimums(g_parameters, gal_image):
     """Return a dictionary containing the minimum values to be used in the
     in the fitting of the parameters.
@@ -165,6 +223,10 @@ PLOTS_DIR = 'plots'
 RESULTS_DIR = 'results'
 GALAXY_FILE = 'galaxies.csv'
 SNR_FILE = 'snr.txt'
+FISHER_DIR = 'fisher'
+FISHER_INFO_FILE = 'fisher_info.json'
+FORECAST_DIR = 'forecast'
+SURROGATE_DIR = 'surrogates'
 MODEL = 'gaussian'
 FIGURE_BASENAME = 'figure'
 FIGURE_EXTENSION = '.pdf'
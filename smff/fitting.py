@@ -7,10 +7,12 @@ inside the project folder specified.
 """
 
 import argparse
+import json
 import shutil
 import subprocess
 from pathlib import Path
 
+from . import campaign
 from . import defaults
 
 
@@ -49,6 +51,34 @@ def main():
                         metavar='SLAC_COMPUTER',
                         help='Same as above but have to be logged in a SLAC computer.')
 
+    parser.add_argument('--target-error', default=None,
+                        type=float,
+                        help=('With -rf, run fits in batches and stop when the standard error of the'
+                              'bias of every parameter is below this value (at most N fits).'))
+
+    parser.add_argument('--fisher-fraction', default=None,
+                        type=float,
+                        help=('With -rf, run fits in batches and stop when the standard error of the'
+                              'bias of every parameter is below this fraction of its fisher bias, or '
+                              'campaign.MIN_TARGET_SIGMAS times its fisher error if that is larger.'))
+
+    parser.add_argument('--batch-size', default=100,
+                        type=int,
+                        help='Number of fits between checks of the precision of the biases.')
+
+    parser.add_argument('--params', nargs='+', default=None,
+                        help='Parameters whose biases need to reach the target, all by default.')
+
+    parser.add_argument('--method', default='leastsq',
+                        type=str,
+                        help=('Fitting method, any lmfit method or \'numpy_lm\' for the numpy'
+                              'Levenberg-Marquardt fitter.'))
+
+    parser.add_argument('--seed', default=0,
+                        type=int,
+                        help=('Seed of the noise and initial values of the fits, fit number i always uses'
+                              'the same random streams of the seed wherever it runs.'))
+
     args = parser.parse_args()
 
     project_path = Path(args.project)
@@ -77,9 +107,21 @@ def main():
     for _ in results_dir.iterdir():
         existing_fits += 1
 
-    if args.run_fits:
+    if args.run_fits and (args.target_error is not None or args.fisher_fraction is not None):
+        report = campaign.run_campaign(project_path.as_posix(), snr, args.slen, existing_fits + args.number_fits,
+                                       batch_size=args.batch_size, target_error=args.target_error,
+                                       fisher_fraction=args.fisher_fraction, params=args.params,
+                                       method=args.method, seed=args.seed)
+        print(json.dumps(report, indent=2))
+
+        if args.snr:
+            with open(snr_file, 'w') as snrfile:
+                snrfile.write(str(snr))
+
+    elif args.run_fits:
         for i in range(args.number_fits):
-            subprocess.run(f"python -m smff.runfits {i + 1} {snr} {project_path} {existing_fits} {args.slen}",
+            subprocess.run(f"python -m smff.runfits {i + 1} {snr} {project_path} {existing_fits} {args.slen}"
+                           f" {args.method} {args.seed}",
                            shell=True)
 
         # write snr to file, so no confusion as to what snr we have later.
@@ -89,7 +131,8 @@ def main():
 
     elif args.run_fits_slac:
         subprocess.run(f'bsub -o data/output.txt -q {args.run_fits_slac} -J "name[1-{args.number_fits}]"'
-                       f' "python -m smff.runfits \$LSB_JOBINDEX {snr} {args.project} {existing_fits} {args.slen}"',
+                       f' "python -m smff.runfits \$LSB_JOBINDEX {snr} {args.project} {existing_fits} {args.slen}'
+                       f' {args.method} {args.seed}"',
                        shell=True)
 
         if args.snr:
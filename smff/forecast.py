@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+"""Fisher forecast of the errors and noise biases of every scene in a catalog of galaxies.
+
+The catalog has the same format as the one taken by :mod:`batchgenerate` (one row per galaxy
+and a 'project' column naming the scene). The fisher analysis of each scene is done in a pool of
+processes and the results are written in chunks of rows into .npz files with one array per
+column, together with a summary of the whole population.
+"""
+import argparse
+import json
+import math
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from . import defaults
+from .analysis import fisher
+from .analysis import gparameters
+from .analysis import images
+from .batchgenerate import read_catalog, validate_catalog
+
+SUMMARY_FILE = 'summary.json'
+CHUNK_BASENAME = 'forecast-'
+
+
+def get_id_params(scene):
+    """Return the rows of a scene (see :func:`batchgenerate.validate_catalog`) in the format
+    of :attr:`analysis.gparameters.GParameters.id_params`."""
+    return {str(row['id']): {k: v for (k, v) in row.items() if k != 'id'} for row in scene}
+
+
+def forecast_scene(scene, pixel_scale, slen, snr, max_condition):
+    """Return dictionary with the results of the fisher analysis of the rows of a single scene."""
+    g_parameters = gparameters.GParameters(id_params=get_id_params(scene))
+    image_renderer = images.ImageRenderer(pixel_scale=pixel_scale, nx=slen, ny=slen)
+    names = g_parameters.ordered_fit_names
+    result = {
+        'names': names,
+        'values': [g_parameters.params[name] for name in names],
+        'failed': False,
+        'condition_number': np.nan,
+        'snrs': [np.nan, np.nan],
+        'covariance': np.full((len(names), len(names)), np.nan),
+        'biases': [np.nan] * len(names),
+    }
+
+    try:
+        fish = fisher.Fisher(g_parameters=g_parameters, image_renderer=image_renderer, snr=snr)
+    except (np.linalg.LinAlgError, ValueError):
+        result['failed'] = True
+        return result
+
+    result['condition_number'] = fish.fisher_condition_number
+    result['snrs'] = getattr(fish, 'snrs', [fish.snr, np.nan])
+    result['covariance'] = fish.matrix_to_numpy_array(fish.covariance_matrix)
+    result['biases'] = [fish.biases[name] for name in names]
+    if not np.isfinite(fish.fisher_condition_number) or fish.fisher_condition_number > max_condition:
+        result['failed'] = True
+
+    return result
+
+
+def _forecast_scene_args(args):
+    return forecast_scene(*args)
+
+
+def write_chunk(filename, projects, results, param_names):
+    """Write the results of a chunk of scenes into filename as one array per column.
+
+    Quantities of each parameter are stored as arrays with one column (or one row and column,
+    for the covariance) per entry of param_names, which is the same for all chunks. Parameters
+    that a scene does not have are NaN.
+    """
+    position = {name: i for i, name in enumerate(param_names)}
+    num_rows, num_params = len(results), len(param_names)
+    values = np.full((num_rows, num_params), np.nan)
+    biases = np.full((num_rows, num_params), np.nan)
+    covariances = np.full((num_rows, num_params, num_params), np.nan)
+
+    for row, result in enumerate(results):
+        idx = [position[name] for name in result['names']]
+        values[row, idx] = result['values']
+        biases[row, idx] = result['biases']
+        covariances[row][np.ix_(idx, idx)] = result['covariance']
+
+    np.savez(filename,
+             project=np.array(projects),
+             param_names=np.array(param_names),
+             failed=np.array([result['failed'] for result in results]),
+             condition_number=np.array([result['condition_number'] for result in results], dtype=float),
+             snrs=np.array([result['snrs'] for result in results], dtype=float),
+             values=values,
+             biases=biases,
+             sigmas=np.sqrt(np.diagonal(covariances, axis1=1, axis2=2)),
+             covariances=covariances)
+
+
+def read_forecast(directory):
+    """Return dictionary with the columns of all the chunks of the forecast in directory
+    concatenated."""
+    columns = {}
+    for filename in sorted(Path(directory).glob(CHUNK_BASENAME + '*.npz')):
+        with np.load(filename.as_posix()) as chunk:
+            columns['param_names'] = list(chunk['param_names'])
+            for column in chunk.files:
+                if column != 'param_names':
+                    columns.setdefault(column, []).append(chunk[column])
+    return {column: (value if column == 'param_names' else np.concatenate(value))
+            for column, value in columns.items()}
+
+
+def get_shear_bias(true_values, biases):
+    """Fit the linear relation bias = m * true_value + c and return the multiplicative and
+    additive shear biases (m, c). Returns NaN if there are not enough distinct values."""
+    mask = np.isfinite(true_values) & np.isfinite(biases)
+    if np.unique(true_values[mask]).size < 2:
+        return np.nan, np.nan
+    m, c = np.polyfit(true_values[mask], biases[mask], 1)
+    return m, c
+
+
+def get_summary(columns):
+    """Return dictionary with summaries of the population in columns (see :func:`read_forecast`)."""
+    names = columns['param_names']
+    ok = ~columns['failed']
+    summary = {
+        'num_rows': int(columns['failed'].size),
+        'num_failed': int(columns['failed'].sum()),
+        'failure_rate': float(columns['failed'].mean()) if columns['failed'].size else math.nan,
+        'mean_biases': {},
+        'mean_sigmas': {},
+        'shear_bias': {},
+    }
+
+    for i, name in enumerate(names):
+        summary['mean_biases'][name] = float(np.nanmean(columns['biases'][ok, i])) if ok.any() else math.nan
+        summary['mean_sigmas'][name] = float(np.nanmean(columns['sigmas'][ok, i])) if ok.any() else math.nan
+
+    # multiplicative and additive bias of each shear component, over all the galaxies.
+    for component in ('g1', 'g2', 'e1', 'e2'):
+        idx = [i for i, name in enumerate(names) if name.rsplit('_', 1)[0] == component]
+        if idx:
+            true_values = columns['values'][ok][:, idx].ravel()
+            biases = columns['biases'][ok][:, idx].ravel()
+            m, c = get_shear_bias(true_values, biases)
+            summary['shear_bias'][component] = {'m': float(m), 'c': float(c)}
+
+    return summary
+
+
+def run_forecast(scenes, directory, pixel_scale=defaults.PIXEL_SCALE, slen=41, snr=20.,
+                 max_condition=1e10, chunk_size=1000, processes=None):
+    """Compute the fisher forecast of every scene and write it into directory.
+
+    Args:
+        scenes(dict): Output of :func:`batchgenerate.validate_catalog`.
+        directory(str): Directory where the chunks and the summary are written.
+        pixel_scale(float): Pixel scale of the images.
+        slen(int): Size of the side of the images, in pixels.
+        snr(float): S/N ratio of the (first) galaxy in each scene.
+        max_condition(float): Scenes whose fisher matrix has a larger condition number are
+            counted as failed.
+        chunk_size(int): Number of scenes written into each file.
+        processes(int): Number of processes in the pool, by default the number of cpus.
+
+    Returns:
+        The summary (dict) of the forecast.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for filename in directory.glob(CHUNK_BASENAME + '*.npz'):
+        filename.unlink()  # chunks of a previous forecast.
+
+    projects = sorted(scenes)
+    param_names = []
+    for project in projects:
+        for name in gparameters.GParameters(id_params=get_id_params(scenes[project])).ordered_fit_names:
+            if name not in param_names:
+                param_names.append(name)
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for number, start in enumerate(range(0, len(projects), chunk_size)):
+            chunk = projects[start:start + chunk_size]
+            args = [(scenes[project], pixel_scale, slen, snr, max_condition) for project in chunk]
+            results = list(executor.map(_forecast_scene_args, args, chunksize=max(1, len(args) // 64)))
+            write_chunk(directory.joinpath(f'{CHUNK_BASENAME}{number:05d}.npz').as_posix(),
+                        chunk, results, param_names)
+
+    summary = get_summary(read_forecast(directory))
+    with open(directory.joinpath(SUMMARY_FILE), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fisher forecast of every scene in a catalog of galaxies.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('catalog', type=str,
+                        help='Catalog (.csv or .npy) in the format taken by batchgenerate.')
+
+    parser.add_argument('-o', '--output', default=defaults.FORECAST_DIR,
+                        type=str,
+                        help='Directory where the forecast is written.')
+
+    parser.add_argument('--snr', default=20.,
+                        type=float,
+                        help='Signal to noise ratio of the first galaxy of each scene.')
+
+    parser.add_argument('--slen', default=41,
+                        type=int,
+                        help='The size to use for the image in which to draw the galaxies.')
+
+    parser.add_argument('--pixel-scale', default=defaults.PIXEL_SCALE,
+                        type=float,
+                        help='Pixel scale of the image.')
+
+    parser.add_argument('--max-condition', default=1e10,
+                        type=float,
+                        help='Rows with a fisher matrix of larger condition number count as failed.')
+
+    parser.add_argument('--chunk-size', default=1000,
+                        type=int,
+                        help='Number of rows written into each output file.')
+
+    parser.add_argument('-j', '--processes', default=None,
+                        type=int,
+                        help='Number of processes to use, by default the number of cpus.')
+
+    args = parser.parse_args()
+
+    scenes = validate_catalog(read_catalog(args.catalog))
+    summary = run_forecast(scenes, args.output, pixel_scale=args.pixel_scale, slen=args.slen, snr=args.snr,
+                           max_condition=args.max_condition, chunk_size=args.chunk_size,
+                           processes=args.processes)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
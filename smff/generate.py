@@ -3,12 +3,11 @@
 """Generate a galaxy(ies) as specified by the user and saves it to a csv file."""
 import argparse
 import csv
-import os
 import shutil
 from pathlib import Path
 
 from . import defaults
-from .analysis import models
+from .analysis import registry
 
 
 def csv_is_empty(filename):
@@ -22,6 +21,19 @@ def csv_is_empty(filename):
         return True
 
 
+def write_galaxy_file(galaxy_file, rows):
+    """Write rows (dictionaries of galaxy parameters) to galaxy_file.
+
+    The rows are first written to a temporary file in the same directory that then replaces
+    galaxy_file, so galaxy_file is never left partially written.
+    """
+    with defaults.atomic_file(galaxy_file) as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=registry.get_fieldnames())
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+
 def main():
     parser = argparse.ArgumentParser(description=('Generate galaxies'
                                                   'specified by the user that'
@@ -41,24 +53,31 @@ def main():
                               'file.'))
 
     parser.add_argument('--galaxy-model', required=True,
-                        type=str, choices=models.get_all_models(),
+                        type=str, choices=registry.get_all_models(),
                         help='Change the galaxy\'s model.')
 
     parser.add_argument('--psf_model',
-                        type=str, choices=models.get_all_psf_models(),
+                        type=str, choices=registry.get_all_psf_models(),
                         help='Change the psf model.')
 
     parser.add_argument('--snr', type=float,
-                        help='Value of noise bias (standard deviation). If'
-                             'given an info file with fisher analysis is created.')
+                        help='S/N ratio of the first galaxy. If given, the fisher analysis of the '
+                             'galaxies in the project is computed and summarized in an info file '
+                             'that runfits and readfits reuse.')
+
+    parser.add_argument('--slen', default=None,
+                        type=int,
+                        help='The size of the image of the fisher analysis, needed with --snr.')
 
     # add all parameter arguments to the parser.
-    for name in models.get_all_parameters():
+    for name in registry.get_all_parameters():
         parser.add_argument('--' + name, default=None,
                             type=float,
                             help='Add a value for the parameter ' + name + '.')
 
     args = parser.parse_args()
+    if args.snr is not None and args.slen is None:
+        parser.error('--slen is needed to compute the fisher analysis.')
     assert args.id == 1 or args.id == 2, "Only support two galaxies. "
 
     project_path = Path(args.project)
@@ -66,37 +85,38 @@ def main():
         shutil.rmtree(project_path.as_posix())
     project_path.mkdir(exist_ok=True)
 
-    # create file for galaxies if it does not exist.
     galaxy_file = project_path.joinpath(defaults.GALAXY_FILE)
-    temp_file = project_path.joinpath('temp.csv')
 
+    # extract appropriate entries from dictionary of args.
+    args_dict = vars(args)
+    row_to_write = {k: v for (k, v) in args_dict.items() if k in registry.get_fieldnames()}
+
+    # keep the galaxies with other ids already in the file.
+    rows = []
     if galaxy_file.exists():
-        # creat a copy to read from and compare.
-        shutil.copyfile(galaxy_file, temp_file)
-
-    # write galaxy data to a filename.
-    with open(galaxy_file, 'w') as csvfile:
-
-        writer = csv.DictWriter(csvfile, fieldnames=models.get_fieldnames())
-        args_dict = vars(args)
-
-        # extract appropriate entries from dictionary of args.
-        row_to_write = {k: v for (k, v) in args_dict.items() if k in models.get_fieldnames()}
-
-        if not temp_file.exists():
-            writer.writeheader()
-            writer.writerow(row_to_write)
-
-        # otherwise more complicated comparison with previous entry.
-        else:
-            with open(temp_file, 'r') as tempfile:
-                reader = csv.DictReader(tempfile)
-                writer.writeheader()
-                for row in reader:
-                    if int(row['id']) != args.id:
-                        writer.writerow(row)
-                writer.writerow(row_to_write)
-            os.remove(temp_file)
+        with open(galaxy_file, 'r') as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                if int(row['id']) != args.id:
+                    rows.append(row)
+    rows.append(row_to_write)
+
+    write_galaxy_file(galaxy_file, rows)
+
+    if args.snr is not None:
+        write_fisher_info(project_path, args.snr, args.slen)
+
+
+def write_fisher_info(project_path, snr, slen):
+    """Compute the fisher analysis of the galaxies of the project (stored in its fisher directory)
+    and write its summary to the info file of the project, see :func:`analysis.store.get_fisher_info`."""
+    from .analysis import gparameters
+    from .analysis import images
+    from .analysis import store
+
+    g_parameters = gparameters.GParameters(project_path.as_posix())
+    image_renderer = images.ImageRenderer(pixel_scale=defaults.PIXEL_SCALE, nx=slen, ny=slen)
+    return store.get_fisher_info(g_parameters, image_renderer, snr)
 
 
 if __name__ == '__main__':
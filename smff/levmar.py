@@ -0,0 +1,187 @@
+"""Bounded Levenberg-Marquardt minimization of a sum of squares on plain numpy arrays.
+
+Used by :func:`runfits.perform_fit` as an alternative to lmfit for the small (6 to 14 parameter)
+problems of this package, where the overhead of lmfit's parameter handling is comparable to the
+cost of the fit. The result has the same summary fields that :func:`runfits.write_results`
+writes for an lmfit result, so both can be compared directly.
+"""
+import numpy as np
+
+# the minimization fails when the damping needed to reduce chi2 grows above this value.
+MAX_DAMPING = 1e12
+
+
+class Parameter(object):
+    """Fitted value (and its error, if available) of a parameter, as in lmfit."""
+
+    def __init__(self, name, value, stderr=None):
+        self.name = name
+        self.value = value
+        self.stderr = stderr
+
+
+class FitResult(object):
+    """Result of :func:`minimize` with the same summary attributes as :class:`lmfit.MinimizerResult`.
+
+    Attributes:
+        params(dict): :class:`Parameter` of each parameter.
+        chisqr(float): Sum of the squares of the residuals at the solution.
+        success(bool): Whether the minimization converged.
+        errorbars(bool): Whether the errors of the parameters could be estimated.
+        nfev(int): Number of evaluations of the residuals (including those for the Jacobian).
+        nvarys(int): Number of parameters.
+        ndata(int): Number of residuals.
+        nfree(int): Degrees of freedom.
+        redchi(float): Reduced chi2.
+        message(str): Reason the minimization stopped.
+        covar(:class:`np.array`): Estimated covariance of the parameters, None if not available.
+    """
+
+    def __init__(self, names, x, chisqr, success, nfev, ndata, message, covar):
+        self.nvarys = len(names)
+        self.ndata = ndata
+        self.nfree = ndata - self.nvarys
+        self.chisqr = chisqr
+        self.redchi = chisqr / self.nfree
+        self.success = success
+        self.nfev = nfev
+        self.message = message
+        self.covar = covar
+        self.errorbars = covar is not None
+
+        stderrs = np.sqrt(np.diag(covar) * self.redchi) if covar is not None else [None] * len(names)
+        self.params = {name: Parameter(name, value, stderr) for name, value, stderr in zip(names, x, stderrs)}
+
+
+def minimize(residuals, x0, lower, upper, names, steps=None, jacobian=None, max_nfev=2000, ftol=1.5e-8,
+             xtol=1.5e-8, lambda0=1e-3):
+    """Minimize the sum of squares of residuals(x) with x inside the box [lower, upper].
+
+    Steps that leave the box are projected back into it. The Jacobian is only recomputed after
+    an accepted step, rejected steps (including those with non-finite residuals or residuals
+    that raise an ArithmeticError or ValueError) reuse it with a larger damping. The
+    minimization converged when a step changes chi2 by less than ftol or the parameters by less
+    than xtol, and fails (success is False) if the damping grows above :data:`MAX_DAMPING`
+    before that.
+
+    Args:
+        residuals(callable): Function of the parameter vector returning the array of residuals.
+        x0(list): Initial values of the parameters.
+        lower(list): Lower bounds of the parameters.
+        upper(list): Upper bounds of the parameters.
+        names(list): Names of the parameters.
+        steps(list): Step of each parameter used for the forward differences of the Jacobian,
+            only needed without jacobian.
+        jacobian(callable): optional, function of the parameter vector returning the Jacobian of
+            the residuals, an array of shape (number of residuals, number of parameters). Its
+            calls are not counted in nfev.
+        max_nfev(int): Maximum number of evaluations of residuals.
+        ftol(float): Relative reduction of chi2 below which the minimization converged.
+        xtol(float): Relative size of the step below which the minimization converged.
+        lambda0(float): Initial damping.
+
+    Returns:
+        A :class:`FitResult`
+    """
+    if steps is None and jacobian is None:
+        raise ValueError('Need to specify the steps of the finite differences or a jacobian.')
+
+    lower = np.asarray(lower, dtype=float)
+    upper = np.asarray(upper, dtype=float)
+    x = np.clip(np.asarray(x0, dtype=float), lower, upper)
+    nfev = 0
+    ndata = None
+
+    def evaluate(x):
+        nonlocal nfev, ndata
+        nfev += 1
+        try:
+            r = np.asarray(residuals(x), dtype=float).ravel()
+        except (ArithmeticError, ValueError):
+            # models that can not be drawn (e.g. a galaxy of zero size at the bound of its radius)
+            # are rejected like non-finite residuals, except at the initial values.
+            if ndata is None:
+                raise
+            return np.full(ndata, np.nan)
+        ndata = r.size
+        return r
+
+    def get_jacobian(x, r):
+        if jacobian is not None:
+            return np.asarray(jacobian(x), dtype=float).reshape(r.size, x.size)
+
+        columns = []
+        for i in range(x.size):
+            # step away from the closest bound so the shifted parameters stay inside the box.
+            step = steps[i] if upper[i] - x[i] >= x[i] - lower[i] else -steps[i]
+            shifted = x.copy()
+            shifted[i] += step
+            columns.append((evaluate(shifted) - r) / step)
+        return np.array(columns).T
+
+    r = evaluate(x)
+    chi2 = r @ r
+    damping = lambda0
+    success = False
+    message = 'Maximum number of evaluations reached.'
+
+    jac = None
+    if not np.isfinite(chi2):
+        message = 'Failed, the residuals are not finite at the initial values.'
+    else:
+        jac = get_jacobian(x, r)
+
+    while np.isfinite(chi2) and nfev < max_nfev:
+        jtj = jac.T @ jac
+        gradient = jac.T @ r
+        diagonal = np.diag(np.maximum(np.diag(jtj), 1e-30))
+        try:
+            step = -np.linalg.solve(jtj + damping * diagonal, gradient)
+        except np.linalg.LinAlgError:
+            step = None
+            reason = 'the damped normal equations are singular'
+
+        if step is not None:
+            x_new = np.clip(x + step, lower, upper)
+            r_new = evaluate(x_new)
+            chi2_new = r_new @ r_new
+
+            if np.isfinite(chi2_new) and chi2_new < chi2:
+                converged_f = (chi2 - chi2_new) <= ftol * chi2
+                converged_x = np.all(np.abs(x_new - x) <= xtol * (np.abs(x) + xtol))
+                x, r, chi2 = x_new, r_new, chi2_new
+                damping = max(damping / 10, 1e-12)
+                if converged_f or converged_x:
+                    success = True
+                    message = 'Converged.'
+                    break
+                jac = get_jacobian(x, r)
+                continue
+
+            if not np.isfinite(chi2_new):
+                reason = 'the residuals are not finite'
+            elif np.all(np.abs(x_new - x) <= xtol * (np.abs(x) + xtol)):
+                # already at the minimum within xtol, as far as the jacobian can tell.
+                success = True
+                message = 'Converged, no step larger than xtol reduces chi2.'
+                break
+            else:
+                reason = 'no step reduces chi2'
+
+        # rejected step, retry with a shorter one closer to the gradient direction.
+        damping *= 10
+        if damping > MAX_DAMPING:
+            message = f'Failed, damping above {MAX_DAMPING:g} and {reason}.'
+            break
+
+    covar = None
+    if jac is not None:
+        try:
+            covar = np.linalg.inv(jac.T @ jac)
+            if not np.all(np.isfinite(covar)) or np.any(np.diag(covar) <= 0):
+                covar = None
+        except np.linalg.LinAlgError:
+            covar = None
+
+    return FitResult(names, x, chisqr=chi2, success=success, nfev=nfev, ndata=r.size, message=message,
+                     covar=covar)
@@ -4,58 +4,161 @@
 writes results to a csv file that can be read from using gparameters.py
 """
 import csv
-import math
 import os
 import sys
-
-import lmfit
-import numpy as np
+import time
 
 from . import defaults
-from .analysis import fisher
-from .analysis import gparameters
-from .analysis import images
+from . import telemetry
+
+# method of perform_fit that uses the numpy Levenberg-Marquardt fitter of :mod:`levmar` instead of lmfit.
+NUMPY_METHOD = 'numpy_lm'
+
+# fraction of the fisher derivative steps used for the finite differences of the Jacobian in the
+# numpy fitter, the fisher steps are too large to give the gradient at the minimum accurately.
+JACOBIAN_STEP_FRACTION = .01
+
+# lmfit, galsim and numpy are imported inside the functions that use them, so the script starts
+# (and checks its arguments) quickly.
 
 
 def obj_func(fit_params, image_renderer, data, variance_noise, **kwargs):
+    """Return the residuals of the model with the parameters in fit_params (and the fixed ones in
+    kwargs, see :func:`analysis.gparameters.get_galaxies_models`) drawn by image_renderer, with
+    respect to data (a :class:`galsim.Image`), in units of the standard deviation of the noise."""
+    import numpy as np
+
+    from .analysis import gparameters
+
     gal_model = gparameters.get_galaxies_models(fit_params=fit_params.valuesdict(), **kwargs)
     model = image_renderer.get_image(gal_model)
-    return ((model - data).array.ravel()) / math.sqrt(variance_noise)
-
+    return ((model - data).array.ravel()) / np.sqrt(np.ravel(variance_noise))
+
+
+def evaluator_obj_func(fit_params, evaluator, data, sqrt_weight):
+    """Return the residuals of the fit, evaluator is a :class:`analysis.gparameters.ModelEvaluator`
+    with the names of fit_params in order, data the flattened array of the noisy image and
+    sqrt_weight the inverse of the standard deviation of the noise (float or flattened map)."""
+    vector = [param.value for param in fit_params.values()]
+    return (evaluator(vector).ravel() - data) * sqrt_weight
+
+
+def perform_fit(g_parameters, image_renderer, snr=20., noise_seed=None, method='leastsq',
+                noise_engine=None, seed=0, var_noise=None, init_values=None):
+    """Fit the galaxies in g_parameters to one noise realization of their image.
+
+    The result has a telemetry attribute (see :func:`telemetry.get_fit_telemetry`) with the
+    time taken, the number of images drawn, why the fit ended and the parameters on a bound.
+
+    The noise and the initial values of the fit come from the streams of the seed of the noise
+    engine with index noise_seed (see :func:`analysis.images.get_stream_key`), so a fit can be
+    reproduced from (seed, noise_seed) alone.
+
+    Args:
+        snr(float): S/N ratio of the first galaxy, which sets the noise of the fit as in the fisher
+            analysis (see :func:`analysis.gparameters.get_var_noise`), only used when neither
+            noise_engine nor var_noise are given.
+        noise_seed(int): Index of the noise realization drawn from noise_engine, and of the
+            initial values, random if None.
+        method(str): Method passed on to lmfit, or :data:`NUMPY_METHOD` to fit with
+            :func:`levmar.minimize` instead.
+        noise_engine(:class:`analysis.images.NoiseEngine`): optional, engine that produces the noise
+            realizations of the image. Pass the same one to all the fits of a project so the variance
+            of the noise is only computed once.
+        seed(int): Seed of the set of fits, only used when noise_engine is not given.
+        var_noise(float or :class:`np.array`): optional, variance (or variance map) of the noise
+            used instead of snr, only used when noise_engine is not given.
+        init_values(dict): optional, initial values of the fit parameters used instead of the
+            random ones (e.g. to warm start the fit).
+    """
+    import numpy as np
+
+    from .analysis import gparameters
+    from .analysis import images
 
-def perform_fit(g_parameters, image_renderer, snr=20., noise_seed=None, method='leastsq'):
     if noise_seed is None:
         noise_seed = np.random.randint(99999999999999)
 
-    fish = fisher.Fisher(g_parameters=g_parameters, image_renderer=image_renderer, snr=snr)
-    orig_image = fish.image
+    if noise_engine is None:
+        image = image_renderer.get_image(gparameters.get_galaxies_models(g_parameters=g_parameters))
+        if var_noise is None:
+            var_noise = gparameters.get_var_noise(g_parameters, image_renderer, snr)
+        noise_engine = images.NoiseEngine(image, var_noise=var_noise, seed=seed)
+    orig_image = noise_engine.image
 
     mins = defaults.get_minimums(g_parameters, orig_image)
     maxs = defaults.get_maximums(g_parameters, orig_image)
-    init_values = defaults.get_initial_values_fit(g_parameters)
-    nfit_params = g_parameters.nfit_params
-    noisy_image, variance_noise = images.add_noise(orig_image, snr, noise_seed)
-
-    fit_params = lmfit.Parameters()
-    for param in g_parameters.fit_params:
-        fit_params.add(param,
-                       value=init_values[param],
-                       min=mins[param],
-                       max=maxs[param])
-
-    results = lmfit.minimize(obj_func, fit_params, method=method, kws=dict(image_renderer=image_renderer,
-                                                                           data=noisy_image,
-                                                                           variance_noise=variance_noise,
-                                                                           **nfit_params))
+    if init_values is None:
+        init_rng = images.get_stream_rng(noise_engine.seed, images.INIT_STREAM, noise_seed)
+        init_values = defaults.get_initial_values_fit(g_parameters, rng=init_rng)
+    noisy_image = noise_engine.get_noisy_image(noise_seed)
+    data = noisy_image.array.ravel()
+    sqrt_weight = np.sqrt(images.get_weight(noise_engine.var_noise))
+    if np.ndim(sqrt_weight):
+        sqrt_weight = sqrt_weight.ravel()
+
+    # the fit parameters are in the order of the vectors of the evaluator for both fitters.
+    evaluator = gparameters.ModelEvaluator(g_parameters, image_renderer)
+    start_time = time.time()
+    start = time.perf_counter()
+
+    if method == NUMPY_METHOD:
+        results = _perform_numpy_fit(g_parameters, image_renderer, evaluator, data, sqrt_weight, init_values)
+
+    else:
+        import lmfit
+
+        fit_params = lmfit.Parameters()
+        for param in evaluator.names:
+            fit_params.add(param,
+                           value=init_values[param],
+                           min=mins[param],
+                           max=maxs[param])
+
+        results = lmfit.minimize(evaluator_obj_func, fit_params, method=method,
+                                 kws=dict(evaluator=evaluator, data=data, sqrt_weight=sqrt_weight))
+
+    results.telemetry = telemetry.get_fit_telemetry(results, start_time, time.perf_counter() - start,
+                                                    evaluator.num_calls, mins, maxs)
     return results
 
 
+def _perform_numpy_fit(g_parameters, image_renderer, evaluator, data, sqrt_weight, init_values):
+    """Fit with :func:`levmar.minimize`, drawing the galaxies straight from the parameter vector
+    and the Jacobian with :meth:`analysis.gparameters.ModelEvaluator.get_jacobian`."""
+    import numpy as np
+
+    from . import levmar
+    from .analysis import gparameters
+
+    index = gparameters.ParameterIndex(g_parameters, image_renderer)
+    steps = index.steps * JACOBIAN_STEP_FRACTION
+
+    def residuals(vector):
+        return (evaluator(vector).ravel() - data) * sqrt_weight
+
+    def jacobian(vector):
+        # step away from the closest bound so the shifted parameters stay inside the box.
+        signs = np.where(index.maxs - vector >= vector - index.mins, 1., -1.)
+        derivatives = evaluator.get_jacobian(vector, signs * steps)
+        return (derivatives.reshape(len(vector), -1) * sqrt_weight).T
+
+    x0 = [init_values[name] for name in index.names]
+    return levmar.minimize(residuals, x0, index.mins, index.maxs, index.names, jacobian=jacobian)
+
+
 def main(argv):
     current_fit_number, snr, project, existing_fits, slen = (
         int(argv[1]), float(argv[2]), argv[3], int(argv[4]), int(argv[5]))
 
+    method = argv[6] if len(argv) > 6 else 'leastsq'
+    seed = int(argv[7]) if len(argv) > 7 else 0
+
     assert slen % 2 == 1, "slen should be odd otherwise fit will fail. "
 
+    from .analysis import gparameters
+    from .analysis import images
+
     noise_seed = existing_fits + current_fit_number
 
     if not os.path.isdir(os.path.join(project, defaults.RESULTS_DIR)):
@@ -63,30 +166,75 @@ def main(argv):
 
     g_parameters = gparameters.GParameters(project)
     image_renderer = images.ImageRenderer(pixel_scale=defaults.PIXEL_SCALE, nx=slen, ny=slen)
-    results = perform_fit(g_parameters, image_renderer, snr=snr)
 
-    filename = ''.join([defaults.RESULTS_DIR, str(noise_seed), '.csv'])
-    result_filename = os.path.join(project, defaults.RESULTS_DIR, filename)
+    noise_engine = get_noise_engine(project, g_parameters, image_renderer, snr, seed=seed)
+    results = perform_fit(g_parameters, image_renderer, noise_seed=noise_seed, method=method,
+                          noise_engine=noise_engine)
+    write_results(results, project, noise_seed, seed=seed)
+
+
+def get_noise_engine(project, g_parameters, image_renderer, snr, seed=0):
+    """Return the :class:`analysis.images.NoiseEngine` of the fits of the galaxies of project.
+
+    The variance of the noise is read from the fisher info file of the project if generate.py
+    wrote it for these inputs, and computed otherwise. Both follow the convention of
+    :func:`analysis.gparameters.get_var_noise`, so the noise realizations are the same either way.
+    """
+    from .analysis import gparameters
+    from .analysis import images
+    from .analysis import store
+
+    info = store.load_fisher_info(project, g_parameters, image_renderer, snr)
+    if info is not None:
+        var_noise = info.var_noise
+    else:
+        var_noise = gparameters.get_var_noise(g_parameters, image_renderer, snr)
 
+    image = image_renderer.get_image(gparameters.get_galaxies_models(g_parameters=g_parameters))
+    return images.NoiseEngine(image, var_noise=var_noise, seed=seed)
+
+
+def write_results(results, project, fit_number, seed=0):
+    """Write the fitted values and the summary of the fit in results to the results file of project
+    with number fit_number.
+
+    The seed and fit_number (the index of the random streams the fit used) are written as well so
+    the noise realization and initial values of the fit can be regenerated.
+    """
+    write_row(get_results_row(results, fit_number, seed=seed), project, fit_number)
+
+
+def get_results_row(results, fit_number, seed=0):
+    """Return dictionary with the columns that :func:`write_results` writes for results."""
     # obtain dictionary of the result values that can be written to the csv file.
-    results_values = dict()
+    row = dict()
     for param in results.params:
-        results_values[param] = results.params[param].value
+        row[param] = results.params[param].value
+
+    row['chi2'] = results.chisqr
+    row['success'] = results.success
+    row['errorbars'] = results.errorbars
+    row['nfev'] = results.nfev
+    row['nvarys'] = results.nvarys
+    row['ndata'] = results.ndata
+    row['nfree'] = results.nfree
+    row['redchi'] = results.redchi
+    row['seed'] = seed
+    row['stream'] = fit_number
+    row.update(getattr(results, 'telemetry', {}))
+    return row
+
+
+def write_row(row, project, fit_number):
+    """Write row (dictionary from column name to value) to the results file of project with
+    number fit_number."""
+    filename = ''.join([defaults.RESULTS_DIR, str(fit_number), '.csv'])
+    result_filename = os.path.join(project, defaults.RESULTS_DIR, filename)
 
-        # write results of fits into a file,
     with open(result_filename, 'w') as csvfile:
-        row_to_write = results_values
-        row_to_write['chi2'] = results.chisqr
-        row_to_write['success'] = results.success
-        row_to_write['errorbars'] = results.errorbars
-        row_to_write['nfev'] = results.nfev
-        row_to_write['nvarys'] = results.nvarys
-        row_to_write['ndata'] = results.ndata
-        row_to_write['nfree'] = results.nfree
-        row_to_write['redchi'] = results.redchi
-        writer = csv.DictWriter(csvfile, fieldnames=list(row_to_write.keys()))
+        writer = csv.DictWriter(csvfile, fieldnames=list(row.keys()))
         writer.writeheader()
-        writer.writerow(row_to_write)
+        writer.writerow(row)
 
 
 if __name__ == '__main__':
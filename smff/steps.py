@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""Report the convergence of the fisher analysis of a project with the steps of the numerical
+derivatives (see :class:`analysis.convergence.StepLadder`).
+
+For each factor of the ladder it reports the largest relative difference of the fisher matrix
+elements and the largest difference of the biases (in units of the fisher predicted errors) with
+the Richardson extrapolated analysis, and for each parameter the largest step whose derivatives
+are within rtol of the extrapolated ones.
+"""
+import argparse
+import json
+
+from . import defaults
+from .analysis import convergence
+from .analysis import gparameters
+from .analysis import images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=('Report the errors of the fisher analysis of a project with a '
+                                                  'ladder of derivative steps and the largest safe step of each '
+                                                  'parameter.'),
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-p', '--project', default=defaults.PROJECT,
+                        type=str,
+                        help='Project with the galaxies to use.')
+
+    parser.add_argument('--snr', default=20.,
+                        type=float,
+                        help='Signal to noise ratio of the first galaxy.')
+
+    parser.add_argument('--slen', default=41,
+                        type=int,
+                        help='The size to use for the image in which to draw the galaxy model.')
+
+    parser.add_argument('--factors', nargs='+', default=[2., 1., .5, .25],
+                        type=float,
+                        help='Factors multiplying the default steps, each half the previous one.')
+
+    parser.add_argument('--rtol', default=1e-3,
+                        type=float,
+                        help='Largest relative error of the derivatives with a safe step.')
+
+    parser.add_argument('--json', action='store_true',
+                        help='Print the whole report as json instead of a table.')
+
+    args = parser.parse_args()
+
+    g_parameters = gparameters.GParameters(args.project)
+    image_renderer = images.ImageRenderer(pixel_scale=defaults.PIXEL_SCALE, nx=args.slen, ny=args.slen)
+    ladder = convergence.StepLadder(g_parameters, image_renderer, args.snr, factors=args.factors)
+    report = ladder.report(rtol=args.rtol)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f'{"factor":>8}{"fisher rel":>12}{"bias/sigma":>12}')
+    for rung in report['rungs']:
+        print(f'{rung["factor"]:>8g}{rung["errors"]["fisher"]:>12.2e}{rung["errors"]["biases"]:>12.2e}')
+
+    errors = report['extrapolated']['errors']
+    if errors is not None:
+        print(f'extrapolation of factors {report["extrapolated"]["factors"]}, error estimate: '
+              f'fisher rel {errors["fisher"]:.2e}, bias/sigma {errors["biases"]:.2e}')
+
+    print(f'\n{"param":<12}{"safe step":>12}  (rtol {report["rtol"]:g})')
+    for param, step in report['safe_steps'].items():
+        print(f'{param:<12}{"none" if step is None else format(step, ".3g"):>12}')
+
+    print(f'\n{report["num_renders"]} images rendered ({report["num_renders_separate"]} with a separate '
+          'analysis at each factor).')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""Telemetry of the fits: how long each fit took, how many images it drew, why it ended, which
+parameters ended on a bound of the fit and where it ran.
+
+:func:`get_fit_telemetry` is used by :func:`runfits.perform_fit` and the values are written with
+each fit result. Running this module summarizes the results of a project: the throughput of the
+fits, the distribution of the number of evaluations and the slowest fits.
+"""
+import argparse
+import json
+import math
+import os
+import socket
+from collections import Counter
+from pathlib import Path
+
+from . import defaults
+
+# columns written to the result files by runfits.write_results.
+COLUMNS = ['start_time', 'wall_time', 'renders', 'end_reason', 'bound_hits', 'host', 'pid']
+
+# a parameter is on a bound if it is closer to it than this (relative to the bound if it is larger
+# than one).
+BOUND_TOLERANCE = 1e-6
+
+
+def get_bound_hits(values, mins, maxs):
+    """Return the names of the parameters in values (dict) that are on one of their bounds."""
+    hits = []
+    for param, value in values.items():
+        for bound in (mins.get(param), maxs.get(param)):
+            if bound is None or math.isinf(bound):
+                continue
+            if abs(value - bound) <= BOUND_TOLERANCE * max(abs(bound), 1.):
+                hits.append(param)
+                break
+    return hits
+
+
+def get_fit_telemetry(results, start_time, wall_time, renders, mins, maxs):
+    """Return dictionary with the telemetry of a fit, with the keys in :data:`COLUMNS`.
+
+    Args:
+        results: Result of the fit (lmfit or :class:`levmar.FitResult`).
+        start_time(float): Time (since the epoch) the fit started.
+        wall_time(float): Seconds taken by the fit.
+        renders(int): Number of images drawn during the fit.
+        mins(dict): Lower bounds of the fit parameters.
+        maxs(dict): Upper bounds of the fit parameters.
+    """
+    values = {param: results.params[param].value for param in results.params}
+    return {
+        'start_time': start_time,
+        'wall_time': wall_time,
+        'renders': renders,
+        'end_reason': ' '.join(str(results.message).split()),
+        'bound_hits': ';'.join(get_bound_hits(values, mins, maxs)),
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+    }
+
+
+def get_distribution(values):
+    import numpy as np
+
+    values = np.asarray(values, dtype=float)
+    return {
+        'min': float(values.min()),
+        'mean': float(values.mean()),
+        'p50': float(np.percentile(values, 50)),
+        'p90': float(np.percentile(values, 90)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max()),
+    }
+
+
+def summarize(rows, num_slowest=10):
+    """Return dictionary summarizing the telemetry of the fit results in rows (see
+    :func:`analysis.readfits.read_result_rows`).
+
+    Results written before the telemetry was recorded only count towards the number of fits, the
+    success rate and the distribution of nfev.
+
+    Returns:
+        A dictionary with the number of fits, the fits per second (over the elapsed time between
+        the first start and the last end, and per worker), the total time per host, the success
+        rate, the distributions of nfev, renders and wall time, the reasons the fits ended, how
+        often each parameter ended on a bound and the num_slowest slowest fits.
+    """
+    timed = [row for row in rows if row.get('wall_time')]
+    summary = {
+        'num_fits': len(rows),
+        'num_timed': len(timed),
+        'success_rate': (sum(row['success'] == 'True' for row in rows) / len(rows)) if rows else None,
+        'nfev': get_distribution([float(row['nfev']) for row in rows]) if rows else None,
+    }
+    if not timed:
+        return summary
+
+    starts = [float(row['start_time']) for row in timed]
+    ends = [float(row['start_time']) + float(row['wall_time']) for row in timed]
+    wall_times = [float(row['wall_time']) for row in timed]
+    elapsed = max(ends) - min(starts)
+
+    hosts = {}
+    for row in timed:
+        host = hosts.setdefault(row['host'], {'fits': 0, 'wall_time': 0., 'workers': set()})
+        host['fits'] += 1
+        host['wall_time'] += float(row['wall_time'])
+        host['workers'].add(row['pid'])
+    for host in hosts.values():
+        host['workers'] = len(host['workers'])
+
+    bound_hits = Counter(param for row in timed for param in row['bound_hits'].split(';') if param)
+
+    slowest = sorted(timed, key=lambda row: float(row['wall_time']), reverse=True)[:num_slowest]
+    summary.update({
+        'elapsed': elapsed,
+        'fits_per_second': len(timed) / elapsed if elapsed > 0 else None,
+        'fits_per_second_per_worker': len(timed) / sum(wall_times),
+        'hosts': hosts,
+        'wall_time': get_distribution(wall_times),
+        'renders': get_distribution([float(row['renders']) for row in timed]),
+        'end_reasons': dict(Counter(row['end_reason'] for row in timed).most_common()),
+        'fits_on_bound': sum(bool(row['bound_hits']) for row in timed),
+        'bound_hits': dict(bound_hits.most_common()),
+        'slowest': [{k: row.get(k) for k in ('stream', 'wall_time', 'nfev', 'renders', 'end_reason',
+                                              'bound_hits', 'host', 'pid')} for row in slowest],
+    })
+    return summary
+
+
+def _print_summary(summary):
+    print(f'fits: {summary["num_fits"]} ({summary["num_timed"]} with telemetry)')
+    if summary['num_fits']:
+        print(f'success rate: {summary["success_rate"]:.3f}')
+        print('nfev: ' + ', '.join(f'{k} {v:.1f}' for k, v in summary['nfev'].items()))
+    if not summary['num_timed']:
+        return
+
+    if summary['fits_per_second'] is not None:
+        print(f'fits per second: {summary["fits_per_second"]:.3f} over {summary["elapsed"]:.1f}s elapsed')
+    print(f'fits per second per worker: {summary["fits_per_second_per_worker"]:.3f}')
+    for name, host in summary['hosts'].items():
+        print(f'  {name}: {host["fits"]} fits, {host["workers"]} workers, {host["wall_time"]:.1f}s')
+    print('wall time (s): ' + ', '.join(f'{k} {v:.3f}' for k, v in summary['wall_time'].items()))
+    print('renders: ' + ', '.join(f'{k} {v:.1f}' for k, v in summary['renders'].items()))
+    print(f'fits ending on a bound: {summary["fits_on_bound"]} {summary["bound_hits"]}')
+    print('end reasons:')
+    for reason, count in summary['end_reasons'].items():
+        print(f'  {count:>6} {reason}')
+    print('slowest fits:')
+    print(f'{"stream":>8}{"seconds":>10}{"nfev":>8}{"renders":>9}  {"host":<16}{"bound hits"}')
+    for fit in summary['slowest']:
+        print(f'{fit["stream"] or "":>8}{float(fit["wall_time"]):>10.3f}{fit["nfev"]:>8}{fit["renders"]:>9}'
+              f'  {fit["host"]:<16}{fit["bound_hits"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize the throughput and telemetry of the fits of a project.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-p', '--project', default=defaults.PROJECT,
+                        type=str,
+                        help='Project whose fit results are summarized.')
+
+    parser.add_argument('--results', default=None,
+                        type=str,
+                        help='Directory or zip/tar archive with the fit results, by default the results '
+                             'directory of the project.')
+
+    parser.add_argument('--slowest', default=10,
+                        type=int,
+                        help='Number of slowest fits to list.')
+
+    parser.add_argument('--json', action='store_true',
+                        help='Print the summary as json.')
+
+    args = parser.parse_args()
+
+    from .analysis import readfits
+
+    results_dir = args.results or Path(args.project).joinpath(defaults.RESULTS_DIR)
+    if not Path(results_dir).exists():
+        raise OSError(f'There are no results in {results_dir}.')
+
+    summary = summarize(readfits.read_result_rows(results_dir), num_slowest=args.slowest)
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        _print_summary(summary)
+
+
+if __name__ == '__main__':
+    main()
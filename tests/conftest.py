@@ -0,0 +1,31 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from smff.analysis import gparameters
+
+ROOT = Path(__file__).resolve().parents[1]
+
+GALAXIES = [
+    ['-gal', '1', '--x0', '0', '--y0', '0', '--e1', '0.1', '--e2', '0'],
+    ['-gal', '2', '--x0', '1.5', '--y0', '0', '--e1', '0', '--e2', '0.1'],
+]
+
+
+def make_project(path):
+    """Write a project with a blend of two gaussian galaxies into path."""
+    for galaxy in GALAXIES:
+        subprocess.run([sys.executable, '-m', 'smff.generate', '-p', str(path), '--galaxy-model', 'gaussian',
+                        '--psf_model', 'gaussianpsf', '--flux', '1', '--hlr', '0.5', '--psf_flux', '1',
+                        '--psf_fwhm', '0.7', *galaxy], cwd=ROOT, check=True, capture_output=True)
+    return gparameters.GParameters(str(path))
+
+
+@pytest.fixture
+def project(tmp_path):
+    """Path of a project with a blend of two gaussian galaxies."""
+    path = tmp_path.joinpath('project')
+    make_project(path)
+    return path
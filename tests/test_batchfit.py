@@ -0,0 +1,47 @@
+import csv
+
+import numpy as np
+
+from smff import batchfit
+from smff import defaults
+from smff import runfits
+from smff.analysis import fisher
+from smff.analysis import gparameters
+from smff.analysis import images
+
+SNR = 20.
+SLEN = 21
+NUM_FITS = 4
+
+
+def test_batch_fit_agrees_with_perform_fit(project):
+    g_parameters = gparameters.GParameters(str(project))
+    image_renderer = images.ImageRenderer(pixel_scale=defaults.PIXEL_SCALE, nx=SLEN, ny=SLEN)
+    fish = fisher.Fisher(g_parameters, image_renderer, SNR)
+    noise_engine = images.NoiseEngine(fish.image, var_noise=fish.var_noise)
+
+    batch = batchfit.perform_batch_fit(g_parameters, image_renderer, SNR, num_fits=NUM_FITS, fish=fish,
+                                       noise_engine=noise_engine)
+    quadratic = ~batch.fallback
+    assert quadratic.any()
+    assert np.isnan(batch.chi2[quadratic]).all() and (batch.nfev[quadratic] == 0).all()
+    assert np.isfinite(batch.chi2[batch.fallback]).all() and (batch.nfev[batch.fallback] > 0).all()
+
+    errors = np.sqrt(np.diag(fish.matrix_to_numpy_array(fish.covariance_matrix)))
+    for k in np.flatnonzero(quadratic):
+        noise_seed = batch.noise_seeds[k]
+        # lmfit started at the solution of the quadratic model stays there (leastsq started at
+        # random values can stop a few tenths of an error short of the minimum).
+        results = runfits.perform_fit(g_parameters, image_renderer, noise_seed=int(noise_seed),
+                                      noise_engine=noise_engine, init_values=batch.get_values_dict(k))
+        values = np.array([results.params[param].value for param in batch.param_names])
+        np.testing.assert_array_less(np.abs(values - batch.values[k]) / errors, .05)
+        assert np.isclose(batch.model_chi2[k], results.chisqr, rtol=1e-2)
+
+    batchfit.write_results(batch, project)
+    for k, noise_seed in enumerate(batch.noise_seeds):
+        filename = project.joinpath(defaults.RESULTS_DIR, f'{defaults.RESULTS_DIR}{noise_seed}.csv')
+        with open(filename) as f:
+            row, = csv.DictReader(f)
+        assert row['quadratic_model'] == str(quadratic[k])
+        assert int(row['stream']) == noise_seed
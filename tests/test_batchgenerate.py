@@ -0,0 +1,41 @@
+import pytest
+
+from smff import batchgenerate
+from smff.analysis import gparameters
+
+GALAXY = {'galaxy_model': 'gaussian', 'flux': '1', 'hlr': '0.5', 'x0': '0', 'y0': '0', 'e1': '0.1', 'e2': '0'}
+PSF = {'psf_model': 'gaussianpsf', 'psf_flux': '1', 'psf_fwhm': '0.7'}
+
+
+def get_rows():
+    return [dict(GALAXY, project='blend', id='1', **PSF),
+            dict(GALAXY, project='blend', id='2', x0='1.5', **PSF),
+            dict(GALAXY, project='single', id='1')]
+
+
+def test_write_projects(tmp_path):
+    scenes = batchgenerate.validate_catalog(get_rows())
+    assert sorted(scenes) == ['blend', 'single']
+    batchgenerate.write_projects(scenes, tmp_path)
+
+    g_parameters = gparameters.GParameters(str(tmp_path.joinpath('blend')))
+    assert g_parameters.num_galaxies == 2
+    assert g_parameters.params['x0_2'] == 1.5
+
+
+@pytest.mark.parametrize('change, message', [
+    ({'n_b': '1'}, 'not of the models gaussian'),
+    ({'psf_beta': '3'}, 'not of the models gaussian and gaussianpsf'),
+    ({'hlr': None}, 'hlr or sigma'),
+    ({'psf_fwhm': None}, 'psf_fwhm of the models'),
+    ({'psf_model': 'moffatpsf'}, 'psf_beta'),
+    ({'psf_model': None}, 'psf parameters but no psf_model'),
+    ({'galaxy_model': 'sersic'}, 'unknown galaxy model'),
+    ({'flux': 'bright'}, 'non-numeric value for flux'),
+])
+def test_bad_catalog(change, message):
+    rows = get_rows()
+    rows[0].update(change)
+    rows[0] = {k: v for k, v in rows[0].items() if v is not None}
+    with pytest.raises(ValueError, match=message):
+        batchgenerate.validate_catalog(rows)
@@ -0,0 +1,25 @@
+
+from smff import defaults
+from smff.analysis import blends
+from smff.analysis import gparameters
+from smff.analysis import images
+
+SNR = 20.
+SLEN = 21
+
+
+def test_scan_matches_rendered_analysis(project):
+    g_parameters = gparameters.GParameters(str(project))
+    image_renderer = images.ImageRenderer(pixel_scale=defaults.PIXEL_SCALE, nx=SLEN, ny=SLEN)
+    scan = blends.SeparationScan(g_parameters, image_renderer, snr=SNR)
+    assert max(scan.interpolation_errors.values()) < 1e-3
+
+    gal_id = list(g_parameters.id_params)[1]
+    offsets = [.8, 1.13, 2.]
+    fishers = scan.scan(gal_id, offsets)
+    assert [fish.g_parameters.id_params[gal_id]['x0'] for fish in fishers] == offsets
+    assert fishers[0].param_names == scan.param_names
+
+    for offset in offsets[:2]:
+        errors = scan.check({gal_id: (offset, 0.)})
+        assert errors['fisher'] < 1e-3 and errors['biases'] < 1e-2
@@ -0,0 +1,33 @@
+import math
+
+import numpy as np
+
+from smff import campaign
+from smff import defaults
+
+SNR = 20.
+SLEN = 21
+
+
+def test_running_statistics():
+    values = np.random.default_rng(0).normal(1., 2., size=50)
+    statistics = campaign.RunningStatistics(['a'], {'a': .5}, {'a': 2.})
+    for value in values:
+        statistics.add({'a': value})
+    assert np.isclose(statistics.get_bias('a'), values.mean() - .5)
+    assert np.isclose(statistics.get_bias_error('a'), values.std(ddof=1) / math.sqrt(values.size))
+    assert np.isclose(statistics.get_pull_mean('a'), (values.mean() - .5) / 2.)
+
+
+def test_campaign_stops_at_target(project):
+    # a loose target is reached after the first batch.
+    report = campaign.run_campaign(project, SNR, SLEN, max_fits=9, batch_size=3, target_error=1.,
+                                   params=['flux_1'], verbose=False)
+    assert report['reached'] and report['num_fits'] == 3 and report['fits_saved'] == 6
+    assert len(list(project.joinpath(defaults.RESULTS_DIR).glob('*.csv'))) == 3
+
+    # the existing fits count towards the target, a tight one runs until max_fits.
+    report = campaign.run_campaign(project, SNR, SLEN, max_fits=6, batch_size=2, target_error=1e-9,
+                                   params=['flux_1'], verbose=False)
+    assert not report['reached'] and report['num_fits'] == 6
+    assert len(list(project.joinpath(defaults.RESULTS_DIR).glob('*.csv'))) == 6
@@ -0,0 +1,30 @@
+import numpy as np
+
+from smff import defaults
+from smff.analysis import convergence
+from smff.analysis import gparameters
+from smff.analysis import images
+
+SNR = 20.
+SLEN = 21
+
+
+def test_step_ladder_converges(project):
+    g_parameters = gparameters.GParameters(str(project))
+    image_renderer = images.ImageRenderer(pixel_scale=defaults.PIXEL_SCALE, nx=SLEN, ny=SLEN)
+    ladder = convergence.StepLadder(g_parameters, image_renderer, SNR, factors=[2., 1., .5, .25])
+    report = ladder.report(rtol=1e-3)
+
+    # central differences: halving the steps divides the errors of the fisher matrix by about four,
+    # and the extrapolation beats the finest rung.
+    errors = [rung['errors']['fisher'] for rung in report['rungs']]
+    np.testing.assert_allclose(np.array(errors[:-1]) / errors[1:], 4., rtol=.1)
+    extrapolated = report['extrapolated']['errors']
+    assert extrapolated['fisher'] < errors[-1]
+    assert extrapolated['biases'] < report['rungs'][0]['errors']['biases']
+
+    assert set(report['safe_steps']) == set(g_parameters.fit_params)
+    for param, step in report['safe_steps'].items():
+        rung = next(rung for rung in report['rungs'] if rung['steps'][param] == step)
+        assert rung['derivative_errors'][param] < report['rtol']
+    assert report['num_renders'] < report['num_renders_separate']
@@ -0,0 +1,50 @@
+import json
+
+import numpy as np
+
+from smff import batchgenerate
+from smff import defaults
+from smff import forecast
+from smff.analysis import fisher
+from smff.analysis import gparameters
+from smff.analysis import images
+
+SNR = 20.
+SLEN = 21
+
+GALAXY = {'galaxy_model': 'gaussian', 'flux': '1', 'hlr': '0.5', 'x0': '0', 'y0': '0', 'e2': '0',
+          'psf_model': 'gaussianpsf', 'psf_flux': '1', 'psf_fwhm': '0.7'}
+
+
+def test_forecast_matches_fisher(tmp_path):
+    rows = [dict(GALAXY, project=f'single{i}', id='1', e1=str(e1)) for i, e1 in enumerate((-.2, 0., .2))]
+    rows += [dict(GALAXY, project='blend', id='1', e1='0.1'), dict(GALAXY, project='blend', id='2', x0='1.5', e1='0')]
+    scenes = batchgenerate.validate_catalog(rows)
+
+    summary = forecast.run_forecast(scenes, tmp_path, slen=SLEN, snr=SNR, chunk_size=3, processes=1)
+    assert len(list(tmp_path.glob(forecast.CHUNK_BASENAME + '*.npz'))) == 2
+    with open(tmp_path.joinpath(forecast.SUMMARY_FILE)) as f:
+        assert json.load(f)['mean_biases'] == summary['mean_biases']
+    assert summary['num_rows'] == 4 and summary['num_failed'] == 0
+    assert np.isnan(summary['shear_bias']['e2']['m'])  # e2 is the same for every galaxy.
+
+    columns = forecast.read_forecast(tmp_path)
+    row = list(columns['project']).index('blend')
+    g_parameters = gparameters.GParameters(id_params=forecast.get_id_params(scenes['blend']))
+    image_renderer = images.ImageRenderer(pixel_scale=defaults.PIXEL_SCALE, nx=SLEN, ny=SLEN)
+    fish = fisher.Fisher(g_parameters, image_renderer, SNR)
+    idx = [columns['param_names'].index(name) for name in fish.param_names]
+    np.testing.assert_allclose(columns['biases'][row, idx], [fish.biases[name] for name in fish.param_names])
+    np.testing.assert_allclose(columns['covariances'][row][np.ix_(idx, idx)],
+                               fish.matrix_to_numpy_array(fish.covariance_matrix))
+
+    # the single galaxies only have the parameters of the first one.
+    single = list(columns['project']).index('single0')
+    assert np.isnan(columns['biases'][single, columns['param_names'].index('e1_2')])
+
+
+def test_shear_bias():
+    true_values = np.array([-.2, 0., .2, np.nan])
+    m, c = forecast.get_shear_bias(true_values, .01 * true_values + .003)
+    assert np.isclose(m, .01) and np.isclose(c, .003)
+    assert np.isnan(forecast.get_shear_bias(np.zeros(3), np.ones(3))).all()
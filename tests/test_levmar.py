@@ -0,0 +1,78 @@
+import lmfit
+import numpy as np
+import pytest
+
+from smff import defaults
+from smff import levmar
+from smff import runfits
+from smff.analysis import gparameters
+from smff.analysis import images
+
+SNR = 20.
+SLEN = 21
+
+T = np.linspace(0., 4., 40)
+DATA = 3. * np.exp(-1.3 * T) + .5 + np.random.default_rng(0).normal(0., .02, T.size)
+
+
+def residuals(x):
+    return x[0] * np.exp(-x[1] * T) + x[2] - DATA
+
+
+def jacobian(x):
+    return np.array([np.exp(-x[1] * T), -x[0] * T * np.exp(-x[1] * T), np.ones(T.size)]).T
+
+
+def test_minimize_agrees_with_lmfit():
+    params = lmfit.Parameters()
+    for name, value in zip('abc', (1., 1., 0.)):
+        params.add(name, value=value, min=-10., max=10.)
+    expected = lmfit.minimize(lambda p: residuals([p[name].value for name in 'abc']), params, method='leastsq')
+    expected_values = [expected.params[name].value for name in 'abc']
+
+    for kwargs in (dict(steps=[1e-7] * 3), dict(jacobian=jacobian)):
+        result = levmar.minimize(residuals, [1., 1., 0.], [-10.] * 3, [10.] * 3, list('abc'), **kwargs)
+        assert result.success
+        np.testing.assert_allclose([result.params[name].value for name in 'abc'], expected_values, rtol=1e-5)
+        np.testing.assert_allclose([result.params[name].stderr for name in 'abc'],
+                                   [expected.params[name].stderr for name in 'abc'], rtol=1e-3)
+        assert result.chisqr <= expected.chisqr * (1 + 1e-8)
+
+
+def test_minimize_bounds_and_failures():
+    result = levmar.minimize(residuals, [1., 1., 0.], [-10., -10., -10.], [10., 10., .3], list('abc'),
+                             jacobian=jacobian)
+    assert result.params['c'].value == .3
+
+    def no_jacobian(x):
+        raise AssertionError('the jacobian is not needed without finite residuals.')
+
+    result = levmar.minimize(lambda x: np.full(T.size, np.nan), [1., 1., 0.], [-10.] * 3, [10.] * 3,
+                             list('abc'), jacobian=no_jacobian)
+    assert not result.success and 'not finite' in result.message
+
+    with pytest.raises(ValueError):
+        levmar.minimize(residuals, [1., 1., 0.], [-10.] * 3, [10.] * 3, list('abc'))
+
+
+def test_numpy_fit_of_galaxies(project):
+    g_parameters = gparameters.GParameters(str(project))
+    image_renderer = images.ImageRenderer(pixel_scale=defaults.PIXEL_SCALE, nx=SLEN, ny=SLEN)
+
+    # the jacobian of the evaluator agrees with forward differences of the whole image.
+    evaluator = gparameters.ModelEvaluator(g_parameters, image_renderer)
+    index = gparameters.ParameterIndex(g_parameters, image_renderer)
+    steps = index.steps * runfits.JACOBIAN_STEP_FRACTION
+    derivatives = evaluator.get_jacobian(index.values, steps)
+    image = evaluator(index.values).copy()
+    for i in range(index.num_params):
+        differences = (evaluator(index.values + index.get_shift(i) * runfits.JACOBIAN_STEP_FRACTION) - image) / steps[i]
+        np.testing.assert_allclose(derivatives[i], differences, atol=2e-3 * np.abs(differences).max())
+
+    noise_engine = runfits.get_noise_engine(project, g_parameters, image_renderer, SNR)
+    for noise_seed in (0, 1):
+        expected = runfits.perform_fit(g_parameters, image_renderer, noise_seed=noise_seed, noise_engine=noise_engine)
+        result = runfits.perform_fit(g_parameters, image_renderer, noise_seed=noise_seed, noise_engine=noise_engine,
+                                     method=runfits.NUMPY_METHOD)
+        assert result.success
+        assert result.chisqr <= expected.chisqr + 1e-6
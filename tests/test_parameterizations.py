@@ -0,0 +1,73 @@
+import copy
+
+import numpy as np
+import pytest
+
+from smff import defaults
+from smff.analysis import fisher
+from smff.analysis import gparameters
+from smff.analysis import images
+from smff.analysis import parameterizations
+
+SNR = 20.
+SLEN = 21
+
+
+def get_e_of_g(g):
+    """Closed forms of e = 2 g / (1 + |g|^2) and of its jacobian and hessian with respect to g."""
+    eye = np.eye(2)
+    d = 1 + g @ g
+    jacobian = 2 * eye / d - 4 * np.outer(g, g) / d ** 2
+    hessian = (-4 * (np.einsum('ia,b->iab', eye, g) + np.einsum('ib,a->iab', eye, g) +
+                     np.einsum('ab,i->iab', eye, g)) / d ** 2 + 16 * np.einsum('i,a,b->iab', g, g, g) / d ** 3)
+    return 2 * g / d, jacobian, hessian
+
+
+@pytest.mark.parametrize('g', [[.2, -.1], [.3, .05], [1e-5, 2e-5], [0., 0.]])
+def test_jacobian_hessian_closed_form(g):
+    g = np.array(g)
+    e, jacobian, hessian = get_e_of_g(g)
+    np.testing.assert_allclose(parameterizations.convert('g', 'e', g), e, atol=1e-15)
+    new_jacobian, new_hessian = parameterizations.get_jacobian_hessian('e', 'g', g)
+    np.testing.assert_allclose(new_jacobian, jacobian, rtol=1e-12, atol=1e-14)
+    np.testing.assert_allclose(new_hessian, hessian, rtol=1e-10, atol=1e-12)
+
+    # the conversion back has the inverse jacobian.
+    old_jacobian, _ = parameterizations.get_jacobian_hessian('g', 'e', e)
+    np.testing.assert_allclose(old_jacobian @ new_jacobian, np.eye(2), atol=1e-12)
+
+
+def test_size_and_round_galaxies():
+    jacobian, hessian = parameterizations.get_jacobian_hessian('hlr', 'sigma', [.3])
+    assert np.isclose(jacobian[0, 0], parameterizations.HLR_PER_SIGMA) and not hessian.any()
+
+    with pytest.raises(ValueError):
+        parameterizations.get_jacobian_hessian('qbeta', 'e', [0., 0.])
+    with pytest.raises(ValueError):
+        parameterizations.get_jacobian_hessian('hlr', 'e', [.1, 0.])
+
+
+@pytest.mark.parametrize('mapping', [{'hlr': 'sigma'}, {'e': 'g'}, {'e': 'qbeta', 'hlr': 'sigma'}])
+def test_reparameterize(project, mapping):
+    """The reparameterized analysis agrees with the one of the galaxies given in the new
+    parameters, up to the errors of the numerical derivatives of the latter."""
+    g_parameters = gparameters.GParameters(str(project))
+    image_renderer = images.ImageRenderer(pixel_scale=defaults.PIXEL_SCALE, nx=SLEN, ny=SLEN)
+    fish = fisher.Fisher(g_parameters, image_renderer, SNR)
+
+    id_params = copy.deepcopy(g_parameters.id_params)
+    for params in id_params.values():
+        for old, new in mapping.items():
+            old_values = [params.pop(name) for name in parameterizations.FAMILIES[old]]
+            params.update(zip(parameterizations.FAMILIES[new], parameterizations.convert(old, new, old_values)))
+    expected = fisher.Fisher(gparameters.GParameters(id_params=id_params), image_renderer, SNR, var_noise=fish.var_noise)
+
+    result = fish.reparameterize(mapping)
+    assert result.param_names == expected.param_names
+    expected_matrix = expected.matrix_to_numpy_array(expected.fisher_matrix)
+    np.testing.assert_allclose(result.matrix_to_numpy_array(result.fisher_matrix), expected_matrix,
+                               atol=1e-3 * np.abs(expected_matrix).max())
+    sigmas = np.sqrt(np.diag(expected.matrix_to_numpy_array(expected.covariance_matrix)))
+    biases = np.array([result.biases[param] for param in expected.param_names])
+    np.testing.assert_allclose(biases / sigmas, [expected.biases[param] / sigma for param, sigma
+                                                 in zip(expected.param_names, sigmas)], atol=1e-2)
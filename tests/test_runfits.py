@@ -0,0 +1,52 @@
+import lmfit
+import numpy as np
+
+from smff import defaults
+from smff import generate
+from smff import runfits
+from smff.analysis import gparameters
+from smff.analysis import images
+from smff.analysis import store
+
+SNR = 20.
+SLEN = 21
+
+
+def test_noise_with_and_without_fisher_info(project):
+    g_parameters = gparameters.GParameters(str(project))
+    image_renderer = images.ImageRenderer(pixel_scale=defaults.PIXEL_SCALE, nx=SLEN, ny=SLEN)
+
+    generate.write_fisher_info(project, SNR, SLEN)
+    info = store.load_fisher_info(project, g_parameters, image_renderer, SNR)
+    assert info is not None
+    with_info = runfits.get_noise_engine(project, g_parameters, image_renderer, SNR, seed=3)
+    assert with_info.var_noise == info.var_noise
+
+    project.joinpath(defaults.FISHER_INFO_FILE).unlink()
+    without_info = runfits.get_noise_engine(project, g_parameters, image_renderer, SNR, seed=3)
+
+    # the noise of a blend gives the first galaxy alone the snr, not the whole image.
+    whole_image = images.get_var_noise(without_info.image, SNR)
+    assert not np.isclose(without_info.var_noise, whole_image)
+    assert without_info.var_noise == with_info.var_noise
+    for noise_seed in (1, 2):
+        np.testing.assert_array_equal(with_info.get_noisy_image(noise_seed).array,
+                                      without_info.get_noisy_image(noise_seed).array)
+
+
+def test_objective_functions_agree(project):
+    g_parameters = gparameters.GParameters(str(project))
+    image_renderer = images.ImageRenderer(pixel_scale=defaults.PIXEL_SCALE, nx=SLEN, ny=SLEN)
+    noise_engine = runfits.get_noise_engine(project, g_parameters, image_renderer, SNR)
+    noisy_image = noise_engine.get_noisy_image(0)
+    evaluator = gparameters.ModelEvaluator(g_parameters, image_renderer)
+
+    fit_params = lmfit.Parameters()
+    for param in evaluator.names:
+        fit_params.add(param, value=g_parameters.params[param] * 1.01)
+
+    residuals = runfits.obj_func(fit_params, image_renderer, noisy_image, noise_engine.var_noise,
+                                 **g_parameters.nfit_params)
+    evaluator_residuals = runfits.evaluator_obj_func(fit_params, evaluator, noisy_image.array.ravel(),
+                                                     1 / np.sqrt(noise_engine.var_noise))
+    np.testing.assert_allclose(residuals, evaluator_residuals, atol=1e-4)
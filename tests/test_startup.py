@@ -0,0 +1,38 @@
+"""The command line entry points are run once per galaxy or fit by scripts, importing them must not
+load the heavy libraries (they are imported when a command needs them) and must stay fast."""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+HEAVY_MODULES = ('galsim', 'lmfit', 'numpy')
+
+# cumulative import time of an entry point module reported by -X importtime, in microseconds.
+IMPORT_BUDGET = 300000
+
+
+def run_python(*args):
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    return subprocess.run([sys.executable, *args], env=env, cwd=ROOT, capture_output=True, text=True, check=True)
+
+
+@pytest.mark.parametrize('module', ['smff.generate', 'smff.runfits'])
+def test_no_heavy_imports(module):
+    code = f'import sys, {module}; print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'
+    assert run_python('-c', code).stdout.strip() == ''
+
+
+@pytest.mark.parametrize('module', ['smff.generate', 'smff.runfits'])
+def test_import_time(module):
+    stderr = run_python('-X', 'importtime', '-c', f'import {module}').stderr
+    cumulative = {}
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, total, name = line.split('|')
+            if total.strip().isdigit():
+                cumulative[name.strip()] = int(total)
+    assert cumulative[module] < IMPORT_BUDGET
@@ -0,0 +1,40 @@
+import numpy as np
+
+from smff import defaults
+from smff.analysis import gparameters
+from smff.analysis import images
+from smff.analysis import surrogates
+
+SNR = 20.
+SLEN = 21
+SWEEP = {'x0_2': (1.5, 1.7)}
+SETTINGS = dict(rtol=1e-2, initial_nodes=3, processes=1)
+
+
+def test_interpolation_nodes():
+    nodes, _ = surrogates.get_lobatto_nodes(5)
+    np.testing.assert_allclose(nodes, np.cos(np.pi * np.arange(5) / 4)[::-1], atol=1e-15)
+
+    # a polynomial of the degree of the nodes is interpolated exactly.
+    patch = surrogates.Patch([0.], [2.], (nodes[:, None] + 1) ** 4, [0.])
+    points = np.array([[.3], [1.7]])
+    np.testing.assert_allclose(patch.evaluate(points)[:, 0], points[:, 0] ** 4, rtol=1e-12)
+
+
+def test_surrogate_matches_fisher(project):
+    g_parameters = gparameters.GParameters(str(project))
+    image_renderer = images.ImageRenderer(pixel_scale=defaults.PIXEL_SCALE, nx=SLEN, ny=SLEN)
+    surrogate = surrogates.get_surrogate(g_parameters, image_renderer, SNR, SWEEP, **SETTINGS)
+    assert surrogate.report()['converged']
+
+    point = 1.61
+    outputs = surrogates._analyze((g_parameters.id_params, list(SWEEP), [point], image_renderer, SNR))
+    interpolated = surrogate.evaluate(point)
+    values = np.array([interpolated[name] for name in surrogate.output_names])
+    np.testing.assert_allclose(values, outputs, atol=1e-2 * np.abs(outputs).max())
+
+    # the second time it is loaded from the project.
+    loaded = surrogates.get_surrogate(g_parameters, image_renderer, SNR, SWEEP, **SETTINGS)
+    assert len(list(project.joinpath(defaults.SURROGATE_DIR).iterdir())) == 1
+    assert loaded.num_analyses == surrogate.num_analyses
+    np.testing.assert_array_equal(loaded.get('sigma:x0_2', point), interpolated['sigma:x0_2'])